@@ -0,0 +1,332 @@
+import argparse
+import csv
+import pickle
+import random
+import re
+import time
+import unicodedata
+from array import array
+from collections import Counter
+
+INDEX_FORMAT = 'taxi-address-index'
+INDEX_VERSION = 2
+
+# Street types and city names riders put around the street name (Romanian and Russian, folded)
+NOISE_WORDS = {
+    'str', 'strada', 'stradela', 'str-la', 'bd', 'bul', 'bulevardul', 'sos', 'soseaua', 'pr', 'prospect',
+    'piata', 'aleea', 'drumul', 'mun', 'municipiul', 'or', 'orasul', 'chisinau', 'chisineu',
+    'ул', 'улица', 'бул', 'бульвар', 'пр', 'проспект', 'пер', 'переулок', 'шос', 'шоссе', 'пл', 'площадь',
+    'г', 'город', 'мун', 'кишинев', 'кишинэу'
+}
+
+# "23", "23a", "23/1", "23 б" at the end of the address
+HOUSE_NUMBER = re.compile(r'(?:^|[\s,])(\d+(?:\s*/\s*\d+)?(?:\s*[a-zа-я](?![a-zа-я]))?)\s*$')
+
+# Dataset columns (first one present wins)
+COLUMNS = {
+    'street': ('street', 'addr:street'),
+    'house': ('housenumber', 'addr:housenumber', 'house'),
+    'latitude': ('latitude', 'lat'),
+    'longitude': ('longitude', 'lon'),
+    'alt_names': ('alt_names', 'addr:street:ru', 'addr:street:ro')
+}
+
+
+# Fuzzy matching: postings of this many rarest query trigrams, exact score for this many best candidates
+FUZZY_TRIGRAMS = 8
+FUZZY_CANDIDATES = 16
+
+# Combining marks left by NFKD decomposition: ș -> s + comma below
+COMBINING_MARKS = {code_point: None for code_point in range(0x300, 0x370)}
+
+
+def fold(text: str) -> str:
+    # Chișinău == Chişinău == Chisinau, Кишинёв == Кишинев
+    return unicodedata.normalize('NFKD', text.casefold()).translate(COMBINING_MARKS)
+
+
+def normalize_street(street: str, folded: bool = False) -> str:
+    words = re.findall(r'\w+', street if folded else fold(street))
+    return ' '.join(word for word in words if word not in NOISE_WORDS)
+
+
+def normalize_house(house: str) -> str:
+    return re.sub(r'\s+', '', fold(house))
+
+
+def split_address(address: str, folded: bool = False) -> tuple:
+
+    """'bd. Dacia, 23/1' -> ('dacia', '23/1'), the house number is None when there is none."""
+    address = (address if folded else fold(address)).strip()
+    match = HOUSE_NUMBER.search(address)
+    if match is None:
+        return normalize_street(address, True), None
+    return normalize_street(address[:match.start()], True), re.sub(r'\s+', '', match.group(1))
+
+
+def trigrams(text: str) -> set:
+    padded = f'  {text} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def house_key(house: str) -> int:
+    digits = re.match(r'\d+', house)
+    return int(digits.group()) if digits else 0
+
+
+class AddressIndex:
+
+    def __init__(self, data: dict, min_score: float = 0.5):
+
+        if data.get('format') != INDEX_FORMAT or data.get('version') != INDEX_VERSION:
+            raise ValueError('Not an address index of a supported version')
+
+        self.min_score = min_score
+        # Street names as shown, with their houses: tuple of numbers and flat [lat, lon, lat, lon...]
+        self.streets = data.get('streets')
+        self.houses = data.get('houses')
+        self.centroids = data.get('centroids')
+        # Normalized name variants (street name and its translations) -> street
+        self.names = data.get('names')
+        self.name_streets = data.get('name_streets')
+        self.name_sizes = data.get('name_sizes')
+        self.postings = data.get('postings')
+        self.exact_names = {name: name_id for name_id, name in enumerate(self.names)}
+        self.name_trigrams = [frozenset(trigrams(name)) for name in self.names]
+
+    @classmethod
+    def load(cls, path: str, min_score: float = 0.5) -> 'AddressIndex':
+        with open(path, 'rb') as file:
+            return cls(pickle.load(file), min_score)
+
+    @staticmethod
+    def build(rows) -> dict:
+
+        """Builds the index data from rows of {'street', 'house', 'latitude', 'longitude', 'alt_names'}."""
+        street_ids = {}
+        streets = []
+        street_names = []
+        street_houses = []
+        # Sum of the latitudes, of the longitudes and the number of points of every street
+        street_points = []
+        for row in rows:
+            normalized = normalize_street(row.get('street'))
+            if not normalized:
+                continue
+            street_id = street_ids.get(normalized)
+            if street_id is None:
+                street_id = street_ids[normalized] = len(streets)
+                streets.append(row.get('street').strip())
+                street_names.append({normalized})
+                street_houses.append({})
+                street_points.append([0.0, 0.0, 0])
+            for alt_name in (row.get('alt_names') or '').split(';'):
+                if normalize_street(alt_name):
+                    street_names[street_id].add(normalize_street(alt_name))
+            if not row.get('latitude') or not row.get('longitude'):
+                continue
+            point = (float(row.get('latitude')), float(row.get('longitude')))
+            # Rows without a house number (the street itself, its segments) only count for the centroid
+            points = street_points[street_id]
+            points[0] += point[0]
+            points[1] += point[1]
+            points[2] += 1
+            house = normalize_house(row.get('house') or '')
+            if house:
+                street_houses[street_id][house] = point
+
+        # Streets without a single point can't be located, the geocoder has to resolve them
+        located = [street_id for street_id, points in enumerate(street_points) if points[2]]
+        streets = [streets[street_id] for street_id in located]
+        street_names = [street_names[street_id] for street_id in located]
+
+        houses = []
+        centroids = array('d')
+        for street_id in located:
+            numbers = street_houses[street_id]
+            ordered = sorted(numbers, key=lambda number: (house_key(number), number))
+            coordinates = array('d', [value for number in ordered for value in numbers[number]])
+            houses.append((tuple(ordered), coordinates))
+            latitude_sum, longitude_sum, count = street_points[street_id]
+            centroids.extend([latitude_sum / count, longitude_sum / count])
+
+        names = []
+        name_streets = array('I')
+        name_sizes = array('H')
+        postings = {}
+        for street_id, variants in enumerate(street_names):
+            for name in sorted(variants):
+                name_id = len(names)
+                names.append(name)
+                name_streets.append(street_id)
+                name_trigrams = trigrams(name)
+                name_sizes.append(len(name_trigrams))
+                for trigram in name_trigrams:
+                    postings.setdefault(trigram, array('I')).append(name_id)
+
+        return {
+            'format': INDEX_FORMAT,
+            'version': INDEX_VERSION,
+            'streets': streets,
+            'houses': houses,
+            'centroids': centroids,
+            'names': names,
+            'name_streets': name_streets,
+            'name_sizes': name_sizes,
+            'postings': postings
+        }
+
+    def lookup(self, address: str) -> dict | None:
+
+        """Coordinates of a typed address, None when the street isn't known (well enough).
+        Without a house number (or an unknown one) the street centroid / the closest house is returned."""
+        # A street named with a number ("31 August 1989") is tried as a whole first
+        folded = fold(address)
+        street, house = normalize_street(folded, True), None
+        name_id, score = self.exact_names.get(street), 1.0
+        if name_id is None:
+            street, house = split_address(folded, True)
+            name_id, score = self.match_street(street)
+            if name_id is None:
+                return None
+
+        street_id = self.name_streets[name_id]
+        numbers, coordinates = self.houses[street_id]
+        if house is None or not numbers:
+            position, exact = None, house is None
+        elif house in numbers:
+            position, exact = numbers.index(house), True
+        else:
+            target = house_key(house)
+            position, exact = min(range(len(numbers)), key=lambda index: abs(house_key(numbers[index]) - target)), False
+
+        if position is None:
+            latitude, longitude = self.centroids[2 * street_id], self.centroids[2 * street_id + 1]
+        else:
+            latitude, longitude = coordinates[2 * position], coordinates[2 * position + 1]
+        return {
+            'latitude': latitude,
+            'longitude': longitude,
+            'street': self.streets[street_id],
+            'house': numbers[position] if position is not None else None,
+            'score': score,
+            'exact': exact and score == 1.0
+        }
+
+    def match_street(self, street: str) -> tuple:
+
+        if not street:
+            return None, 0.0
+        name_id = self.exact_names.get(street)
+        if name_id is not None:
+            return name_id, 1.0
+
+        # Dice coefficient over trigrams. Candidates come from the postings of the rarest trigrams of the
+        # query (a typo only spoils the few around it), the ones sharing most of them are scored exactly
+        query_trigrams = trigrams(street)
+        rarest = sorted(query_trigrams, key=lambda trigram: len(self.postings.get(trigram, ())))
+        shared = Counter()
+        for trigram in rarest[:FUZZY_TRIGRAMS]:
+            shared.update(self.postings.get(trigram, ()))
+        candidates = [name_id for name_id, _ in shared.most_common(FUZZY_CANDIDATES)]
+
+        best_id, best_score = None, 0.0
+        for name_id in candidates:
+            score = 2 * len(query_trigrams & self.name_trigrams[name_id]) / (len(query_trigrams) + self.name_sizes[name_id])
+            if score > best_score:
+                best_id, best_score = name_id, score
+        if best_score < self.min_score:
+            return None, best_score
+        return best_id, best_score
+
+
+def read_rows(path: str):
+
+    with open(path, 'r', encoding='utf-8', newline='') as file:
+        reader = csv.DictReader(file)
+        columns = {field: next((name for name in names if name in reader.fieldnames), None)
+                   for field, names in COLUMNS.items()}
+        missing = [field for field in ('street', 'latitude', 'longitude') if columns.get(field) is None]
+        if missing:
+            raise ValueError(f'{path} has no column for {", ".join(missing)}')
+        for row in reader:
+            yield {field: row.get(column) if column else None for field, column in columns.items()}
+
+
+def build_index(csv_path: str, index_path: str) -> None:
+
+    started = time.perf_counter()
+    data = AddressIndex.build(read_rows(csv_path))
+    with open(index_path, 'wb') as file:
+        pickle.dump(data, file, protocol=pickle.HIGHEST_PROTOCOL)
+    house_count = sum(len(numbers) for numbers, _ in data.get('houses'))
+    print(f'{len(data.get("streets"))} streets ({len(data.get("names"))} names), {house_count} houses '
+          f'indexed in {time.perf_counter() - started:.2f}s -> {index_path}')
+
+
+def bench_queries(index: AddressIndex, count: int) -> list:
+
+    # What riders type: names with and without diacritics, street types, translations, typos
+    queries = []
+    random.seed(42)
+    for _ in range(count):
+        street_id = random.randrange(len(index.streets))
+        numbers, _ = index.houses[street_id]
+        name = index.streets[street_id]
+        variant = random.random()
+        if variant < 0.2:
+            name = fold(name)
+        elif variant < 0.4:
+            name = f'str. {name}'
+        elif variant < 0.6:
+            name_ids = [name_id for name_id, name_street in enumerate(index.name_streets) if name_street == street_id]
+            name = index.names[random.choice(name_ids)]
+        elif variant < 0.8 and len(name) > 5:
+            position = random.randrange(1, len(name) - 1)
+            name = name[:position] + name[position + 1:]
+        queries.append(f'{name} {random.choice(numbers)}' if numbers else name)
+    return queries
+
+
+def bench_index(index_path: str, count: int) -> None:
+
+    started = time.perf_counter()
+    index = AddressIndex.load(index_path)
+    print(f'loaded in {(time.perf_counter() - started) * 1000:.1f}ms')
+
+    queries = bench_queries(index, count)
+    hits = 0
+    started = time.perf_counter()
+    for query in queries:
+        if index.lookup(query) is not None:
+            hits += 1
+    elapsed = time.perf_counter() - started
+    print(f'{count} lookups: {count / elapsed:.0f} lookups/s, {elapsed / count * 1e6:.1f}µs per lookup, '
+          f'{hits / count:.1%} resolved')
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description='Offline street-address index.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help='CSV (street, housenumber, latitude, longitude[, alt_names]) -> index')
+    build.add_argument('csv_path')
+    build.add_argument('index_path')
+    bench = commands.add_parser('bench', help='lookups per second on generated rider-like queries')
+    bench.add_argument('index_path')
+    bench.add_argument('--queries', type=int, default=100000)
+    lookup = commands.add_parser('lookup', help='resolve one address')
+    lookup.add_argument('index_path')
+    lookup.add_argument('address')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        build_index(args.csv_path, args.index_path)
+    elif args.command == 'bench':
+        bench_index(args.index_path, args.queries)
+    else:
+        print(AddressIndex.load(args.index_path).lookup(args.address))
+
+
+if __name__ == '__main__':
+    main()
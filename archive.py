@@ -0,0 +1,143 @@
+import argparse
+import logging
+from datetime import datetime, timedelta
+from bson import ObjectId
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from config import SETTINGS
+from database import Database, FINISHED_STATUSES
+
+
+def archive_month(order: dict) -> str:
+    # Partition of an order: the month it was created in (time of its ObjectId)
+    return order.get('_id').generation_time.strftime('%Y_%m')
+
+
+class OrderArchive:
+
+    def __init__(self, db_orders_archive, archive_collection):
+
+        # Order ID -> monthly collection, the collections are taken with archive_collection(month)
+        self.db_orders_archive = db_orders_archive
+        self.archive_collection = archive_collection
+        # Monthly collections whose index was already ensured by this process
+        self.indexed_months = set()
+
+    def collection(self, month: str):
+
+        collection = self.archive_collection(month)
+        if month not in self.indexed_months:
+            collection.create_index([('order_id', 1)], unique=True)
+            self.indexed_months.add(month)
+        return collection
+
+    def store(self, orders: list) -> None:
+
+        """Copies the orders into their monthly collections and indexes them. Idempotent: orders
+        that are already there (a batch that is resumed) are skipped."""
+        orders_by_month = {}
+        for order in orders:
+            orders_by_month.setdefault(archive_month(order), []).append(order)
+        for month, month_orders in orders_by_month.items():
+            try:
+                self.collection(month).bulk_write([InsertOne(order) for order in month_orders], ordered=False)
+            except BulkWriteError as error:
+                if any(write_error.get('code') != 11000 for write_error in error.details.get('writeErrors')):
+                    raise
+        self.db_orders_archive.bulk_write([UpdateOne({'_id': order.get('order_id')},
+                                                     {'$set': {'month': archive_month(order)}}, upsert=True)
+                                           for order in orders], ordered=False)
+
+    def month_collections(self) -> list:
+        # Every monthly collection orders were moved into, oldest first
+        return [self.collection(month) for month in sorted(self.db_orders_archive.distinct('month'))]
+
+    def find_orders(self, order_ids: list) -> dict:
+
+        # Read-through for the orders that are not in taxi_orders anymore: one query per month
+        order_ids_by_month = {}
+        for location in self.db_orders_archive.find({'_id': {'$in': order_ids}}):
+            order_ids_by_month.setdefault(location.get('month'), []).append(location.get('_id'))
+        orders = {}
+        for month, month_order_ids in order_ids_by_month.items():
+            for order in self.collection(month).find({'order_id': {'$in': month_order_ids}}):
+                orders[order.get('order_id')] = order
+        return orders
+
+
+class OrderArchiver:
+
+    def __init__(self, db_orders, archive: OrderArchive, db_checkpoints, archive_after: float = 30,
+                 batch_size: int = 1000):
+
+        # Finished orders older than archive_after days are moved, batch by batch
+        self.db_orders = db_orders
+        self.archive = archive
+        self.db_checkpoints = db_checkpoints
+        self.archive_after = archive_after
+        self.batch_size = batch_size
+
+        self.logger = logging.getLogger(__name__)
+
+    def run(self, max_batches: int = None) -> int:
+
+        """Moves up to max_batches batches (all when None), returns the number of orders moved.
+        A batch interrupted half-way (copied, not deleted) is finished first."""
+        moved = self.resume()
+        created_before = ObjectId.from_datetime(datetime.utcnow() - timedelta(days=self.archive_after))
+        batches = 0
+        while max_batches is None or batches < max_batches:
+            orders = list(self.db_orders.find({'status': {'$in': FINISHED_STATUSES}, '_id': {'$lt': created_before}})
+                          .sort('_id', 1).limit(self.batch_size))
+            if not orders:
+                break
+            moved += self.move(orders)
+            batches += 1
+        if moved:
+            self.logger.info('Archived %d orders', moved)
+        return moved
+
+    def resume(self) -> int:
+
+        checkpoint = self.db_checkpoints.find_one({'_id': 'orders'})
+        if checkpoint is None or not checkpoint.get('batch'):
+            return 0
+        orders = list(self.db_orders.find({'_id': {'$in': checkpoint.get('batch')}}))
+        return self.move(orders)
+
+    def move(self, orders: list) -> int:
+
+        # The checkpoint names the batch before anything is copied, it is cleared once the batch is deleted
+        document_ids = [order.get('_id') for order in orders]
+        self.db_checkpoints.update_one({'_id': 'orders'}, {'$set': {'batch': document_ids,
+                                                                    'updated_at': datetime.utcnow()}}, upsert=True)
+        if orders:
+            self.archive.store(orders)
+            self.db_orders.delete_many({'_id': {'$in': document_ids}})
+        self.db_checkpoints.update_one({'_id': 'orders'}, {'$set': {'batch': [], 'last_id': max(document_ids, default=None)},
+                                                           '$inc': {'archived': len(orders)}})
+        return len(orders)
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description='Moves the finished orders into the monthly archive collections.')
+    parser.add_argument('--days', type=float, default=None, help='age of the orders to archive, settings.json when empty')
+    parser.add_argument('--batches', type=int, default=None, help='at most this many batches, all when empty')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    settings = SETTINGS.current
+    archive_after = settings.get('archive_after', 30)
+    archive_batch_size = settings.get('archive_batch_size', 1000)
+
+    database = Database()
+    archive = OrderArchive(database.db_orders_archive, database.archive_collection)
+    archiver = OrderArchiver(database.db_orders, archive, database.db_archive_checkpoints,
+                             archive_after if args.days is None else args.days, archive_batch_size)
+    print(f'{archiver.run(args.batches)} orders archived')
+
+
+if __name__ == '__main__':
+    main()
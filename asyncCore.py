@@ -0,0 +1,122 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from email.message import Message
+from http import HTTPStatus
+
+from webhook import WebhookServer
+
+
+class AsyncWebhookServer(WebhookServer):
+
+    """Webhook ingress on an asyncio event loop: connections, parsing and the per-user ordering are
+    coroutines. The handlers are not, they still run synchronously (PTB, pymongo, map.md over requests)
+    on a bounded thread pool."""
+
+    def __init__(self, listen: str, port: int, url: str, secret_token: str = None, workers: int = 32):
+
+        super().__init__(listen, port, url, secret_token)
+
+        # Connections and scheduling live on one event loop, blocking handlers get a bounded pool
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='handler')
+        self.loop = None
+        self.ready = threading.Event()
+        self.tasks = set()
+        # User ID -> [lock, updates waiting for it]
+        self.user_locks = {}
+
+    def start(self) -> None:
+
+        for path, (updater, allowed_updates) in self.routes.items():
+            updater.bot.set_webhook(url=f'{self.url}{path}',
+                                    allowed_updates=allowed_updates,
+                                    secret_token=self.secret_token)
+
+        thread = threading.Thread(target=self.run_loop, name='asyncio-webhook', daemon=True)
+        thread.start()
+        self.ready.wait()
+
+        print(f'ASYNC WEBHOOK listening on {self.listen}:{self.port}')
+
+    def stop(self) -> None:
+
+        if self.server is not None:
+            self.loop.call_soon_threadsafe(self.server.close)
+        self.executor.shutdown(wait=True)
+
+    def run_loop(self) -> None:
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.serve())
+
+    async def serve(self) -> None:
+
+        self.server = await asyncio.start_server(self.handle_connection, self.listen, self.port)
+        self.ready.set()
+        try:
+            await self.server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+
+        # Minimal HTTP/1.1 with keep-alive, Telegram only ever POSTs JSON updates
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+
+                headers = Message()
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip()] = value.strip()
+
+                body = await reader.readexactly(int(headers.get('Content-Length', 0)))
+                status = self.route(path, headers, body) if method == 'POST' else 405
+
+                writer.write(f'HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\nContent-Length: 0\r\n\r\n'.encode())
+                await writer.drain()
+                if headers.get('Connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def route(self, path: str, headers, body: bytes) -> int:
+
+        # The update is acknowledged right away and handled in the background
+        status, updater, update = self.parse(path, headers, body)
+        if update is not None:
+            task = self.loop.create_task(self.process(updater, update))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        return status
+
+    async def process(self, updater, update) -> None:
+
+        # Updates of one user are handled in order, different users run concurrently
+        user = update.effective_user or update.effective_chat
+        if user is None:
+            await self.loop.run_in_executor(self.executor, updater.dispatcher.process_update, update)
+            return
+
+        entry = self.user_locks.setdefault(user.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self.loop.run_in_executor(self.executor, updater.dispatcher.process_update, update)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.user_locks[user.id]
+
+
+if __name__ == '__main__':
+    print('Only for import!')
@@ -0,0 +1,167 @@
+import hashlib
+import logging
+import math
+import threading
+from datetime import datetime
+from pymongo.errors import OperationFailure, PyMongoError
+
+
+class BloomFilter:
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+
+        # Optimal size and number of hashes for the expected amount of items
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hash_count = max(int(self.size / capacity * math.log(2)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, item) -> list:
+        digest = hashlib.blake2b(str(item).encode(), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little')
+        return [(first + i * second) % self.size for i in range(self.hash_count)]
+
+    def add(self, item) -> None:
+        for position in self.positions(item):
+            self.bits[position // 8] |= 1 << (position % 8)
+
+    def __contains__(self, item) -> bool:
+        return all(self.bits[position // 8] & (1 << (position % 8)) for position in self.positions(item))
+
+
+class Blacklist:
+
+    def __init__(self, db_blacklist, refresh_interval: float = 30.0, bloom_threshold: int = 100000):
+
+        self.db_blacklist = db_blacklist
+        self.refresh_interval = refresh_interval
+        self.bloom_threshold = bloom_threshold
+
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.banned_ids = set()
+        # Document _id -> user_id (delete events only carry the _id)
+        self.document_ids = {}
+        self.bloom = None
+        self.last_update = None
+
+    def load(self) -> None:
+
+        banned_ids = set()
+        document_ids = {}
+        last_update = None
+        for document in self.db_blacklist.find({'banned': {'$ne': False}}, {'user_id': 1, 'updated_at': 1}):
+            banned_ids.add(document.get('user_id'))
+            document_ids[document.get('_id')] = document.get('user_id')
+            if document.get('updated_at') and (last_update is None or document.get('updated_at') > last_update):
+                last_update = document.get('updated_at')
+
+        with self.lock:
+            self.banned_ids = banned_ids
+            self.document_ids = document_ids
+            self.last_update = last_update or datetime.min
+            self.build_bloom()
+
+    def build_bloom(self) -> None:
+
+        # Only worth it for very large lists, a plain set is enough otherwise
+        if len(self.banned_ids) < self.bloom_threshold:
+            self.bloom = None
+            return
+        self.bloom = BloomFilter(len(self.banned_ids) * 2)
+        for user_id in self.banned_ids:
+            self.bloom.add(user_id)
+
+    def is_banned(self, user_id: str) -> bool:
+
+        bloom = self.bloom
+        if bloom is not None and user_id not in bloom:
+            return False
+        return user_id in self.banned_ids
+
+    def ban(self, user_id: str) -> None:
+
+        self.db_blacklist.update_one({'user_id': user_id},
+                                     {'$set': {'banned': True, 'updated_at': datetime.utcnow()}},
+                                     upsert=True)
+        self.apply(user_id, True)
+
+    def unban(self, user_id: str) -> None:
+
+        # Soft delete, so other processes can pick it up with the delta query
+        self.db_blacklist.update_one({'user_id': user_id},
+                                     {'$set': {'banned': False, 'updated_at': datetime.utcnow()}})
+        self.apply(user_id, False)
+
+    def apply(self, user_id: str, banned: bool, document_id=None) -> None:
+
+        with self.lock:
+            if document_id is not None:
+                self.document_ids[document_id] = user_id
+            if banned:
+                self.banned_ids.add(user_id)
+                if self.bloom is not None:
+                    self.bloom.add(user_id)
+            else:
+                self.banned_ids.discard(user_id)
+
+    def start(self, use_change_streams: bool = True) -> None:
+
+        self.load()
+        target = self.watch_changes if use_change_streams else self.poll_changes
+        thread = threading.Thread(target=target, name='blacklist-refresh', daemon=True)
+        thread.start()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+
+    def watch_changes(self) -> None:
+
+        while not self.stop_event.is_set():
+            try:
+                with self.db_blacklist.watch(full_document='updateLookup') as stream:
+                    # Changes made between the initial load and the stream opening
+                    self.refresh()
+                    for change in stream:
+                        self.apply_change(change)
+            except OperationFailure as error:
+                self.logger.warning('Change streams are not available (%s), refreshing every %ss',
+                                    error, self.refresh_interval)
+                self.poll_changes()
+                return
+            except PyMongoError as error:
+                self.logger.warning('Blacklist stream failed (%s), reopening', error)
+                self.stop_event.wait(self.refresh_interval)
+
+    def apply_change(self, change: dict) -> None:
+
+        document_id = change.get('documentKey').get('_id')
+        if change.get('operationType') == 'delete':
+            with self.lock:
+                user_id = self.document_ids.pop(document_id, None)
+            if user_id is not None:
+                self.apply(user_id, False)
+            return
+
+        document = change.get('fullDocument')
+        if document is not None:
+            self.apply(document.get('user_id'), document.get('banned') is not False, document_id)
+
+    def poll_changes(self) -> None:
+
+        while not self.stop_event.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except PyMongoError as error:
+                self.logger.warning('Blacklist refresh failed: %s', error)
+
+    def refresh(self) -> None:
+
+        # Delta query: only the documents changed since the last refresh (re-applying is harmless)
+        for document in self.db_blacklist.find({'updated_at': {'$gte': self.last_update}}).sort('updated_at', 1):
+            self.apply(document.get('user_id'), document.get('banned') is not False, document.get('_id'))
+            self.last_update = document.get('updated_at')
+
+
+if __name__ == '__main__':
+    print('Only for import!')
@@ -0,0 +1,169 @@
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import uuid
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from webhook import WebhookServer
+
+
+class LeaderLease:
+
+    def __init__(self, db_leases, name: str, lease_time: float = 10.0):
+
+        # One document per singleton duty, whoever holds an unexpired lease is the leader
+        self.db_leases = db_leases
+        self.name = name
+        self.lease_time = lease_time
+        self.holder = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+    def acquire(self) -> bool:
+
+        """Takes the lease if it is free or expired, renews it if it is already ours."""
+        now = datetime.utcnow()
+        try:
+            self.db_leases.find_one_and_update({'_id': self.name,
+                                                '$or': [{'holder': self.holder}, {'expires_at': {'$lte': now}}]},
+                                               {'$set': {'holder': self.holder,
+                                                         'expires_at': now + timedelta(seconds=self.lease_time)}},
+                                               upsert=True,
+                                               return_document=ReturnDocument.AFTER)
+        except DuplicateKeyError:
+            # The upsert collided with a lease held by somebody else
+            return False
+        return True
+
+    def release(self) -> None:
+        self.db_leases.update_one({'_id': self.name, 'holder': self.holder}, {'$set': {'expires_at': datetime.min}})
+
+
+class LeaderElection:
+
+    def __init__(self, lease: LeaderLease, on_elected, on_revoked, renew_interval: float = None):
+
+        self.lease = lease
+        self.on_elected = on_elected
+        self.on_revoked = on_revoked
+        # Renewing a few times per lease keeps a slow round trip from losing it
+        self.renew_interval = renew_interval or lease.lease_time / 3
+
+        self.logger = logging.getLogger(__name__)
+        self.stop_event = threading.Event()
+        self.is_leader = False
+        self.renewed_at = None
+
+    def start(self) -> None:
+
+        thread = threading.Thread(target=self.run, name=f'election-{self.lease.name}', daemon=True)
+        thread.start()
+
+    def stop(self) -> None:
+
+        self.stop_event.set()
+        if self.is_leader:
+            self.step_down()
+            self.lease.release()
+
+    def run(self) -> None:
+
+        while not self.stop_event.is_set():
+            now = datetime.utcnow()
+            try:
+                elected = self.lease.acquire()
+                if elected:
+                    self.renewed_at = now
+            except PyMongoError as error:
+                self.logger.warning('Lease %s could not be renewed: %s', self.lease.name, error)
+                # Without MongoDB nobody can take it over before it expires, so we keep it until then
+                elected = self.is_leader and now - self.renewed_at < timedelta(seconds=self.lease.lease_time)
+
+            if elected and not self.is_leader:
+                self.logger.warning('%s is now the leader of %s', self.lease.holder, self.lease.name)
+                self.is_leader = True
+                self.on_elected()
+            elif not elected and self.is_leader:
+                self.step_down()
+            self.stop_event.wait(self.renew_interval)
+
+    def step_down(self) -> None:
+
+        self.logger.warning('%s is no longer the leader of %s', self.lease.holder, self.lease.name)
+        self.is_leader = False
+        self.on_revoked()
+
+
+class ShardedWebhookServer(WebhookServer):
+
+    def __init__(self, listen: str, port: int, url: str, secret_token: str, queues: list):
+
+        super().__init__(listen, port, url, secret_token)
+
+        # Every user always lands on the same worker, so its conversation state stays in one process
+        self.queues = queues
+
+    def start_dispatchers(self) -> None:
+        # Updates are dispatched by the worker processes
+        pass
+
+    def route(self, path: str, headers, body: bytes) -> int:
+
+        status, _, update = self.parse(path, headers, body)
+        if update is not None:
+            self.queues[self.shard(update)].put((path, body))
+        return status
+
+    def shard(self, update) -> int:
+
+        user = update.effective_user or update.effective_chat
+        key = user.id if user is not None else update.update_id
+        return key % len(self.queues)
+
+
+class Cluster:
+
+    def __init__(self, workers: int, target):
+
+        # target(shard, queue) runs in each worker process. Spawned rather than forked: MongoDB
+        # clients and running threads don't survive a fork
+        self.context = multiprocessing.get_context('spawn')
+        self.queues = [self.context.Queue() for _ in range(workers)]
+        self.target = target
+
+        self.logger = logging.getLogger(__name__)
+        self.processes = [None] * workers
+
+    def start(self) -> None:
+        for shard in range(len(self.queues)):
+            self.spawn(shard)
+
+    def spawn(self, shard: int) -> None:
+
+        process = self.context.Process(target=self.target, args=(shard, self.queues[shard]),
+                                       name=f'worker-{shard}', daemon=True)
+        process.start()
+        self.processes[shard] = process
+
+    def supervise(self, interval: float = 1.0) -> None:
+
+        # A dead worker is replaced on the same queue, its users keep their shard
+        while True:
+            for shard, process in enumerate(self.processes):
+                process.join(interval / len(self.processes))
+                if not process.is_alive():
+                    self.logger.warning('Worker %s exited with %s, restarting', shard, process.exitcode)
+                    self.spawn(shard)
+
+    def stop(self) -> None:
+
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+
+
+if __name__ == '__main__':
+    print('Only for import!')
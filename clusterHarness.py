@@ -0,0 +1,165 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import queue
+import time
+from multiprocessing.managers import BaseManager
+from pymongo import MongoClient
+from telegram.ext import Updater
+
+from cluster import Cluster, LeaderElection, LeaderLease, ShardedWebhookServer
+
+HARNESS_TOKEN = '123456:cluster-harness'
+
+# The fake MongoDB: one mongomock collection living in a manager process, shared by all the workers
+FAKE_LEASES = None
+
+
+def fake_leases():
+
+    global FAKE_LEASES
+    if FAKE_LEASES is None:
+        import mongomock
+        FAKE_LEASES = mongomock.MongoClient().taxi_bot['taxi_leases']
+    return FAKE_LEASES
+
+
+class FakeMongoManager(BaseManager):
+    pass
+
+
+FakeMongoManager.register('leases', callable=fake_leases)
+
+
+class HarnessWorker:
+
+    def __init__(self, events, mongodb_connection: str, fake_address, lease_time: float):
+
+        # Picklable target(shard, queue) for the spawned workers, it reports what it sees into `events`
+        self.events = events
+        self.mongodb_connection = mongodb_connection
+        self.fake_address = fake_address
+        self.lease_time = lease_time
+
+    def __call__(self, shard: int, updates) -> None:
+
+        if self.mongodb_connection:
+            db_leases = MongoClient(self.mongodb_connection).taxi_bot['taxi_leases_harness']
+        else:
+            manager = FakeMongoManager(address=self.fake_address, authkey=b'harness')
+            manager.connect()
+            db_leases = manager.leases()
+
+        election = LeaderElection(LeaderLease(db_leases, 'notifier', self.lease_time),
+                                  lambda: self.events.put(('elected', shard, time.monotonic())),
+                                  lambda: self.events.put(('revoked', shard, time.monotonic())))
+        election.start()
+
+        while True:
+            _, body = updates.get()
+            message = json.loads(body).get('message')
+            self.events.put(('update', shard, message.get('from').get('id'), int(message.get('text'))))
+
+
+def synthetic_update(update_id: int, user_id: int, sequence: int) -> bytes:
+
+    user = {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'}
+    return json.dumps({
+        'update_id': update_id,
+        'message': {'message_id': update_id, 'date': int(time.time()), 'from': user,
+                    'chat': dict(user, type='private'), 'text': str(sequence)}
+    }).encode()
+
+
+def wait_for_event(events, kind: str, timeout: float, received: list) -> tuple | None:
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            event = events.get(timeout=deadline - time.monotonic())
+        except queue.Empty:
+            return None
+        received.append(event)
+        if event[0] == kind:
+            return event
+    return None
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description='Runs the cluster mode on one box: N worker processes, sharded '
+                                                 'ingress and leader failover, against MongoDB or a fake.')
+    parser.add_argument('--workers', type=int, default=3)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--updates', type=int, default=1000)
+    parser.add_argument('--lease-time', type=float, default=3.0)
+    parser.add_argument('--mongodb', default='', help='MongoDB connection string, an in-memory fake when empty')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    fake_address = None
+    if not args.mongodb:
+        manager = FakeMongoManager(address=('127.0.0.1', 0), authkey=b'harness')
+        manager.start()
+        fake_address = manager.address
+
+    events = multiprocessing.get_context('spawn').Queue()
+    cluster = Cluster(args.workers, HarnessWorker(events, args.mongodb, fake_address, args.lease_time))
+    cluster.start()
+
+    # Ingress: synthetic updates go through the same routing as the real webhook
+    webhook_server = ShardedWebhookServer('127.0.0.1', 0, 'https://harness', None, cluster.queues)
+    updater = Updater(token=HARNESS_TOKEN, use_context=True, workers=0)
+    webhook_server.add_bot(updater)
+    path = f'/{HARNESS_TOKEN}'
+    sequences = [0] * args.users
+    started = time.monotonic()
+    for update_id in range(args.updates):
+        user_index = update_id % args.users
+        sequences[user_index] += 1
+        webhook_server.route(path, {}, synthetic_update(update_id, 1000 + user_index, sequences[user_index]))
+
+    received = []
+    leader = wait_for_event(events, 'elected', args.lease_time * 3, received)
+    deadline = time.monotonic() + 30
+    while sum(1 for event in received if event[0] == 'update') < args.updates and time.monotonic() < deadline:
+        wait_for_event(events, 'update', deadline - time.monotonic(), received)
+    elapsed = time.monotonic() - started
+
+    # Every user on exactly one worker, its updates in the order they were sent
+    user_shards = {}
+    user_sequences = {}
+    for event in received:
+        if event[0] == 'update':
+            _, shard, user_id, sequence = event
+            user_shards.setdefault(user_id, set()).add(shard)
+            user_sequences.setdefault(user_id, []).append(sequence)
+    updates_received = sum(len(user_sequence) for user_sequence in user_sequences.values())
+    split_users = [user_id for user_id, shards in user_shards.items() if len(shards) > 1]
+    reordered_users = [user_id for user_id, user_sequence in user_sequences.items()
+                       if user_sequence != sorted(user_sequence)]
+    print(f'updates: {updates_received}/{args.updates} in {elapsed:.2f}s, '
+          f'users split between workers: {len(split_users)}, users reordered: {len(reordered_users)}')
+
+    # Failover: the leader dies, one of the standbys has to take the lease over
+    new_leader = None
+    if leader is None:
+        print('failover: no leader was elected')
+    else:
+        cluster.processes[leader[1]].terminate()
+        killed_at = time.monotonic()
+        new_leader = wait_for_event(events, 'elected', args.lease_time * 3, received)
+        if new_leader is None:
+            print(f'failover: worker {leader[1]} was killed, no standby took over')
+        else:
+            print(f'failover: worker {leader[1]} killed, worker {new_leader[1]} took over after '
+                  f'{new_leader[2] - killed_at:.2f}s (lease {args.lease_time}s)')
+
+    cluster.stop()
+    ok = updates_received == args.updates and not split_users and not reordered_users and new_leader is not None
+    print('OK' if ok else 'FAILED')
+
+
+if __name__ == '__main__':
+    main()
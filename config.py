@@ -0,0 +1,149 @@
+import json
+import logging
+import os
+import threading
+from collections.abc import Mapping
+from types import MappingProxyType
+
+
+def freeze(value):
+    # Nested objects become read-only mappings, arrays tuples
+    if isinstance(value, dict):
+        return MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+class Config(Mapping):
+
+    def __init__(self, data: dict):
+
+        # Immutable snapshot of settings.json, a reload makes a new one
+        self.data = freeze(data)
+
+    def __getitem__(self, key: str):
+        return self.data[key]
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __setattr__(self, name: str, value) -> None:
+        if name in self.__dict__:
+            raise AttributeError('Config is immutable')
+        super().__setattr__(name, value)
+
+    def changed_keys(self, other: 'Config') -> list:
+        return sorted(key for key in set(self) | set(other) if self.get(key) != other.get(key))
+
+
+class ConfigFile:
+
+    def __init__(self, path: str, compile_data=Config):
+
+        """A JSON file parsed (and compiled by compile_data) once, on first use. reload() swaps in the
+        new version when the file has changed and tells the subscribers; a broken file is logged and
+        the current version kept. Values read at startup (tokens, connections, pool sizes) still
+        need a restart, the ones read at use or by a subscriber change on the fly."""
+        self.path = path
+        self.compile_data = compile_data
+
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.value = None
+        self.modified_at = None
+        self.subscribers = []
+
+    @property
+    def current(self):
+        value = self.value
+        if value is None:
+            with self.lock:
+                if self.value is None:
+                    self.value, self.modified_at = self.read()
+                value = self.value
+        return value
+
+    def load(self, path: str = None):
+
+        # Another file (the load benchmark), or the same one again
+        with self.lock:
+            if path is not None:
+                self.path = path
+            self.value, self.modified_at = self.read()
+        return self.value
+
+    def read(self) -> tuple:
+
+        modified_at = os.stat(self.path).st_mtime_ns
+        with open(self.path, 'r', encoding='utf-8') as file:
+            value = self.compile_data(json.load(file))
+            file.close()
+        return value, modified_at
+
+    def reload(self) -> bool:
+
+        with self.lock:
+            modified_at = None
+            try:
+                modified_at = os.stat(self.path).st_mtime_ns
+                if self.value is not None and modified_at == self.modified_at:
+                    return False
+                previous = self.value
+                self.value, self.modified_at = self.read()
+            except (OSError, ValueError) as error:
+                # Logged once per version of the file, the next save is tried again
+                if self.value is not None and modified_at is not None:
+                    self.modified_at = modified_at
+                self.logger.error('%s was not reloaded: %s', self.path, error)
+                return False
+            subscribers = list(self.subscribers)
+
+        if isinstance(previous, Config):
+            self.logger.info('%s reloaded, changed: %s', self.path, ', '.join(self.value.changed_keys(previous)) or 'nothing')
+        else:
+            self.logger.info('%s reloaded', self.path)
+        for subscriber in subscribers:
+            try:
+                subscriber(self.value)
+            except Exception as error:
+                self.logger.exception('Reload of %s failed in %s: %s', self.path, subscriber, error)
+        return True
+
+    def subscribe(self, subscriber) -> None:
+        # subscriber(value) after every reload
+        with self.lock:
+            self.subscribers.append(subscriber)
+
+
+class ConfigWatcher:
+
+    def __init__(self, files: list, interval: float = 5.0):
+
+        # The files are checked for changes every `interval` seconds
+        self.files = files
+        self.interval = interval
+        self.stop_event = threading.Event()
+
+    def start(self) -> 'ConfigWatcher':
+        threading.Thread(target=self.run, name='config-watcher', daemon=True).start()
+        return self
+
+    def run(self) -> None:
+        while not self.stop_event.wait(self.interval):
+            for config_file in self.files:
+                config_file.reload()
+
+    def stop(self) -> None:
+        self.stop_event.set()
+
+
+# Settings of the process
+SETTINGS = ConfigFile('settings.json')
+
+
+if __name__ == '__main__':
+    print('Only for import!')
@@ -0,0 +1,176 @@
+import logging
+import threading
+import time
+from datetime import datetime
+from typing import NamedTuple
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+
+from metrics import REGISTRY
+
+# Events of the conversation: plain text and shared locations (menu buttons and callbacks are events too)
+TEXT = 'text'
+LOCATION = 'location'
+# Transitions taken from whatever step the user is in
+ANY_STEP = None
+
+FLUSH_SIZE = REGISTRY.histogram('conversation_flush_states', 'Conversation states written by one flush', (),
+                                (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+
+
+class ConversationState(NamedTuple):
+    step: str
+    order_id: str | int
+
+
+IDLE = ConversationState('', '')
+
+
+class Conversation:
+
+    def __init__(self, transitions: dict, save_state):
+
+        """Transition table of the wizard: (step, event) -> handler(user_id, state, *args), which returns
+        the next state (None to stay). (ANY_STEP, event) are taken from every step without their own."""
+        self.transitions = transitions
+        self.save_state = save_state
+
+    def handler(self, step: str, event: str):
+        handler = self.transitions.get((step, event))
+        if handler is None:
+            handler = self.transitions.get((ANY_STEP, event))
+        return handler
+
+    def dispatch(self, user_id: str, state: ConversationState, event: str, *args) -> bool:
+
+        # False when nothing handles the event in this step
+        handler = self.handler(state.step, event)
+        if handler is None:
+            return False
+        next_state = handler(user_id, state, *args)
+        if next_state is not None and next_state != state:
+            self.save_state(user_id, next_state)
+        return True
+
+
+class ConversationStore:
+
+    def __init__(self, db_user_info, process_id: str, flush_interval: float = 1.0, batch_size: int = 500,
+                 ttl: float = 600.0):
+
+        """Conversation states of the users of this process (users are sharded to one process), written
+        behind: the last state of every user is flushed in batches, so a step costs no round trip. After a
+        crash the states are loaded back from taxi_user_info, as of the last flush (at most flush_interval
+        of steps are lost, the wizard goes on from the step before)."""
+        self.db_user_info = db_user_info
+        self.process_id = process_id
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.ttl = ttl
+
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.flush_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.states = {}
+        self.touched_at = {}
+        # user_id -> state not written yet (the last one wins), kept until its write succeeds
+        self.unflushed = {}
+
+    def get(self, user_id: str, document: dict) -> ConversationState:
+
+        # In memory, or as last flushed (the user's document)
+        with self.lock:
+            state = self.states.get(user_id)
+            if state is None:
+                state = ConversationState(document.get('current_step') or '', document.get('current_order_id') or '')
+                self.states[user_id] = state
+            self.touched_at[user_id] = time.monotonic()
+            return state
+
+    def set(self, user_id: str, state: ConversationState) -> None:
+
+        with self.lock:
+            self.states[user_id] = state
+            self.touched_at[user_id] = time.monotonic()
+            self.unflushed[user_id] = state
+            if len(self.unflushed) >= self.batch_size:
+                self.flush_event.set()
+
+    def refresh(self, user_id: str, document: dict) -> None:
+
+        # A reloaded document (changed by another process, e.g. the stale steps reset) replaces a flushed state
+        with self.lock:
+            if user_id in self.states and user_id not in self.unflushed:
+                self.states[user_id] = ConversationState(document.get('current_step') or '',
+                                                         document.get('current_order_id') or '')
+
+    def forget(self, user_id: str) -> None:
+
+        with self.lock:
+            self.states.pop(user_id, None)
+            self.touched_at.pop(user_id, None)
+            self.unflushed.pop(user_id, None)
+
+    def start(self) -> 'ConversationStore':
+        threading.Thread(target=self.run, name='conversation-flush', daemon=True).start()
+        return self
+
+    def run(self) -> None:
+
+        while not self.stop_event.is_set():
+            self.flush_event.wait(self.flush_interval)
+            self.flush_event.clear()
+            self.flush()
+            self.expire()
+
+    def stop(self) -> None:
+
+        # The states changed since the last flush are written before leaving
+        self.stop_event.set()
+        self.flush_event.set()
+        self.flush()
+
+    def flush(self) -> int:
+
+        with self.lock:
+            batch = dict(self.unflushed)
+        if not batch:
+            return 0
+
+        # One unordered bulk write per flush, coalesced to the last state of every user
+        updated_at = datetime.utcnow()
+        requests_list = [UpdateOne({'user_id': user_id},
+                                   {'$set': {'current_step': state.step,
+                                             'current_order_id': state.order_id,
+                                             'updated_by': self.process_id,
+                                             'updated_at': updated_at}})
+                         for user_id, state in batch.items()]
+        try:
+            self.db_user_info.bulk_write(requests_list, ordered=False)
+        except PyMongoError as error:
+            # Kept for the next flush
+            self.logger.warning('%d conversation states were not flushed: %s', len(batch), error)
+            return 0
+        FLUSH_SIZE.labels().observe(len(batch))
+
+        with self.lock:
+            for user_id, state in batch.items():
+                # Not if the user has moved on while it was written
+                if self.unflushed.get(user_id) is state:
+                    del self.unflushed[user_id]
+        return len(batch)
+
+    def expire(self) -> None:
+
+        # Flushed states nobody has touched for a while are loaded again when needed
+        expired_before = time.monotonic() - self.ttl
+        with self.lock:
+            for user_id in [user_id for user_id, touched_at in self.touched_at.items()
+                            if touched_at < expired_before and user_id not in self.unflushed]:
+                del self.states[user_id]
+                del self.touched_at[user_id]
+
+
+if __name__ == '__main__':
+    print('Only for import!')
@@ -1,22 +1,274 @@
-import json
+import logging
+import threading
 import certifi
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument, monitoring
+from pymongo.errors import ConfigurationError, OperationFailure
+
+from config import SETTINGS
+from metrics import HANDLERS, REGISTRY
+
+# Orders in these statuses never change again, the archiver moves them into the monthly collections
+FINISHED_STATUSES = ['accepted', 'declined', 'expired']
+
+# Index specification for every query shape: collection -> [(keys, options)]
+INDEXES = {
+    'taxi_user_info': [
+        ([('user_id', 1)], {'unique': True}),
+        # Garbage collection only ever looks at the users stuck in the middle of a step
+        ([('updated_at', 1)], {'partialFilterExpression': {'current_step': {'$gt': ''}}}),
+        ([('current_order_id', 1)], {'partialFilterExpression': {'current_step': {'$gt': ''}}})
+    ],
+    'taxi_blacklist': [
+        ([('user_id', 1)], {'unique': True}),
+        ([('updated_at', 1)], {})
+    ],
+    'taxi_orders': [
+        ([('order_id', 1)], {'unique': True}),
+        ([('user_id', 1), ('status', 1)], {}),
+        # Orders declined together by one cancellation
+        ([('cancel_token', 1)], {'sparse': True}),
+        # Orders abandoned in the wizard and finished orders to archive, by creation time (the ObjectId)
+        ([('status', 1), ('_id', 1)], {})
+    ],
+    'taxi_outbox': [
+        ([('state', 1), ('available_at', 1)], {}),
+        ([('lease_token', 1)], {'sparse': True}),
+        # Delivered entries are kept a week as idempotency keys
+        ([('sent_at', 1)], {'expireAfterSeconds': 7 * 24 * 3600})
+    ],
+    'taxi_geocoding': [
+        ([('key', 1)], {'unique': True}),
+        # Reads skip entries older than geocoding_cache_ttl anyway, the TTL index only cleans them up
+        ([('created_at', 1)], {'expireAfterSeconds': 30 * 24 * 3600})
+    ],
+    'taxi_timers': [
+        ([('fire_at', 1)], {}),
+        ([('key', 1)], {})
+    ],
+    'taxi_driver_locations': [
+        ([('driver_id', 1)], {'unique': True}),
+        ([('location', '2dsphere')], {}),
+        # Drivers that stopped sharing their location are forgotten after a day
+        ([('updated_at', 1)], {'expireAfterSeconds': 24 * 3600})
+    ]
+}
+
+# Indexes of queries that are gone, dropped where they were created: collection -> [name]
+LEGACY_INDEXES = {
+    # The per-order notification flags, replaced by the outbox
+    'taxi_orders': ['status_1_drivers_notification_sent_1', 'status_1_drivers_notification_declined_sent_1',
+                    'status_1_user_notification_sent_1']
+}
+
+# Queries issued by the managers: (collection, filter, sort)
+QUERY_SHAPES = [
+    ('taxi_user_info', {'user_id': 1}, None),
+    ('taxi_user_info', {'current_step': {'$gt': ''}, 'updated_at': {'$lt': 0}}, None),
+    ('taxi_user_info', {'current_step': {'$gt': ''}, 'current_order_id': {'$in': [1]}}, None),
+    ('taxi_blacklist', {'user_id': 1}, None),
+    ('taxi_blacklist', {'updated_at': {'$gte': 0}}, [('updated_at', 1)]),
+    ('taxi_orders', {'order_id': 1}, None),
+    ('taxi_orders', {'order_id': 1, 'status': 'open'}, None),
+    ('taxi_orders', {'order_id': {'$exists': True}}, [('order_id', -1)]),
+    ('taxi_orders', {'user_id': 1, 'status': 'open'}, None),
+    ('taxi_orders', {'cancel_token': ''}, None),
+    ('taxi_orders', {'status': 'new', '_id': {'$lt': 0}}, None),
+    ('taxi_orders', {'status': {'$in': FINISHED_STATUSES}, '_id': {'$lt': 0}}, [('_id', 1)]),
+    ('taxi_outbox', {'state': 'pending', 'available_at': {'$lte': 0}}, [('available_at', 1)]),
+    ('taxi_outbox', {'lease_token': ''}, None),
+    ('taxi_geocoding', {'key': ''}, None),
+    ('taxi_timers', {'fire_at': {'$lte': 0}}, [('fire_at', 1)]),
+    ('taxi_timers', {'key': 1}, None),
+    ('taxi_driver_locations', {'driver_id': 1}, None)
+]
 
 
 class Database:
 
-    def __init__(self):
+    def __init__(self, client=None, name: str = 'taxi_bot'):
 
-        # Reading file and getting settings
-        with open('settings.json', 'r') as file:
-            file_data = json.load(file)
-            client = MongoClient(file_data.get('mongodb_connection'), tlsCAFile=certifi.where())
-            file.close()
+        # Getting settings
+        settings = SETTINGS.current
+        mongodb_connection = settings.get('mongodb_connection')
+        index_audit = settings.get('index_audit', False)
+        self.transactions = settings.get('transactions', True)
+
+        # A client can be given instead (the load benchmark runs on mongomock or a scratch database)
+        if client is None:
+            client = MongoClient(mongodb_connection, tlsCAFile=certifi.where())
+        self.client = client
+        self.name = name
+        database = client[name]
 
         # Getting all resources
-        self.db_user_info = client.taxi_bot['taxi_user_info']
-        self.db_orders = client.taxi_bot['taxi_orders']
-        self.db_blacklist = client.taxi_bot['taxi_blacklist']
+        self.db_user_info = database['taxi_user_info']
+        self.db_orders = database['taxi_orders']
+        self.db_blacklist = database['taxi_blacklist']
+        self.db_counters = database['taxi_counters']
+        self.db_geocoding = database['taxi_geocoding']
+        self.db_outbox = database['taxi_outbox']
+        self.db_leases = database['taxi_leases']
+        self.db_timers = database['taxi_timers']
+        # Finished orders are moved into monthly collections, this one maps order IDs to them
+        self.db_orders_archive = database['taxi_orders_archive']
+        self.db_archive_checkpoints = database['taxi_archive_checkpoints']
+        self.db_driver_locations = database['taxi_driver_locations']
+
+        # Indexes for all the query shapes (idempotent)
+        index_manager = IndexManager(database)
+        index_manager.ensure_indexes()
+        if index_audit:
+            index_manager.audit()
+
+    def archive_collection(self, month: str):
+        return self.client[self.name][f'taxi_orders_{month}']
+
+    def run_transaction(self, callback) -> None:
+
+        """Runs callback(session) in a transaction, or without one (session=None) where the
+        deployment doesn't support them (standalone mongod, local stand-ins)."""
+        if self.transactions:
+            try:
+                with self.client.start_session() as session:
+                    session.with_transaction(callback)
+                return
+            except (ConfigurationError, OperationFailure) as error:
+                # IllegalOperation: transactions need a replica set or mongos
+                if isinstance(error, OperationFailure) and error.code != 20:
+                    raise
+                logging.getLogger(__name__).warning('Transactions are not available (%s), writing without them', error)
+                self.transactions = False
+        callback(None)
+
+
+class IndexManager:
+
+    def __init__(self, database):
+
+        self.database = database
+        self.logger = logging.getLogger(__name__)
+
+    def ensure_indexes(self) -> None:
+
+        for collection_name, index_names in LEGACY_INDEXES.items():
+            existing = self.database[collection_name].index_information()
+            for index_name in index_names:
+                if index_name in existing:
+                    self.database[collection_name].drop_index(index_name)
+                    self.logger.info('Index %s on %s dropped', index_name, collection_name)
+
+        for collection_name, indexes in INDEXES.items():
+            collection = self.database[collection_name]
+            for keys, options in indexes:
+                try:
+                    collection.create_index(keys, **options)
+                except OperationFailure as error:
+                    # E.g. duplicates left in the collection for a unique index
+                    self.logger.warning('Index %s on %s was not created: %s', keys, collection_name, error)
+
+    def audit(self) -> None:
+
+        collection_scans = []
+        for collection_name, query, sort in QUERY_SHAPES:
+            cursor = self.database[collection_name].find(query)
+            if sort:
+                cursor = cursor.sort(sort)
+            winning_plan = cursor.explain().get('queryPlanner').get('winningPlan')
+            if 'COLLSCAN' in self.plan_stages(winning_plan):
+                collection_scans.append(f'{collection_name} {query}')
+
+        if collection_scans:
+            raise RuntimeError('Queries without an index: ' + '; '.join(collection_scans))
+        self.logger.info('Index audit passed for %d queries', len(QUERY_SHAPES))
+
+    def plan_stages(self, plan: dict) -> list:
+
+        stages = [plan.get('stage')]
+        if 'inputStage' in plan:
+            stages += self.plan_stages(plan.get('inputStage'))
+        for input_stage in plan.get('inputStages', []):
+            stages += self.plan_stages(input_stage)
+        # Newer servers wrap the plan produced by the slot-based engine
+        if 'queryPlan' in plan:
+            stages += self.plan_stages(plan.get('queryPlan'))
+        return stages
+
+
+class RoundTripCounter(monitoring.CommandListener):
+
+    def __init__(self):
+
+        # Commands by the (outermost) handler that made them, '' outside of the handlers (notifier, timers)
+        self.operations = REGISTRY.counter('mongo_operations_total', 'MongoDB commands',
+                                           ('handler', 'collection', 'operation'))
+
+    def report(self) -> dict:
+
+        # Average round trips per call of every handler
+        report = {}
+        for (name,), histogram in list(HANDLERS.round_trips.children.items()):
+            snapshot = histogram.snapshot()
+            report[name] = snapshot.get('sum') / snapshot.get('count')
+        return report
+
+    def started(self, event) -> None:
+        # Nested handlers (HANDLERS.track) are counted in the outer ones too
+        stack = HANDLERS.get_stack()
+        for frame in stack:
+            frame[1] += 1
+        # CRUD commands name their collection, getMore has it aside
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = event.command.get('collection', '')
+        self.operations.labels(stack[0][0] if stack else '', collection, event.command_name).inc()
+
+    def succeeded(self, event) -> None:
+        pass
+
+    def failed(self, event) -> None:
+        pass
+
+
+# Registered before any client is created, so every connection reports its commands
+ROUND_TRIPS = RoundTripCounter()
+monitoring.register(ROUND_TRIPS)
+
+
+class SequenceAllocator:
+
+    def __init__(self, db_counters, name: str, block_size: int = 1):
+
+        self.db_counters = db_counters
+        self.name = name
+        self.block_size = max(block_size, 1)
+
+        # Reserved range [next_value, last_value] of the current block
+        self.lock = threading.Lock()
+        self.next_value = 1
+        self.last_value = 0
+
+    def next(self) -> int:
+
+        with self.lock:
+            if self.next_value > self.last_value:
+                counter = self.db_counters.find_one_and_update({'_id': self.name},
+                                                               {'$inc': {'value': self.block_size}},
+                                                               upsert=True,
+                                                               return_document=ReturnDocument.AFTER)
+                self.last_value = counter.get('value')
+                self.next_value = self.last_value - self.block_size + 1
+            value = self.next_value
+            self.next_value += 1
+            return value
+
+    def seed(self, collection, field: str) -> None:
+
+        # Migration: the counter never goes below the current maximum of the field
+        last_document = collection.find_one({field: {'$exists': True}}, sort=[(field, -1)])
+        if last_document is not None:
+            self.db_counters.update_one({'_id': self.name},
+                                        {'$max': {'value': last_document.get(field)}},
+                                        upsert=True)
 
 
 if __name__ == '__main__':
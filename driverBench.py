@@ -0,0 +1,83 @@
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+from pymongo import MongoClient, UpdateOne
+
+from config import SETTINGS
+from database import INDEXES
+from driverLocator import DriverLocator
+
+# Chișinău and around, where the simulated drivers are spread
+CENTER_LATITUDE = 47.0245
+CENTER_LONGITUDE = 28.8322
+SPREAD_DEGREES = 0.12
+
+
+def random_point() -> tuple:
+    return (CENTER_LATITUDE + random.uniform(-SPREAD_DEGREES, SPREAD_DEGREES),
+            CENTER_LONGITUDE + random.uniform(-SPREAD_DEGREES, SPREAD_DEGREES))
+
+
+def percentile(sorted_values: list, q: float) -> float:
+    return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)]
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description='Nearest-K lookup latency over simulated driver positions.')
+    parser.add_argument('--mongodb', default='', help='MongoDB connection string, settings.json when empty')
+    parser.add_argument('--drivers', type=int, default=10000)
+    parser.add_argument('--lookups', type=int, default=2000)
+    parser.add_argument('--k', type=int, default=3)
+    parser.add_argument('--radius', type=float, default=3000, help='meters')
+    parser.add_argument('--stale-share', type=float, default=0.2, help='share of drivers with stale positions')
+    args = parser.parse_args()
+
+    mongodb_connection = args.mongodb
+    if not mongodb_connection:
+        mongodb_connection = SETTINGS.current.get('mongodb_connection')
+
+    # A scratch database, the production collections are never touched
+    client = MongoClient(mongodb_connection)
+    client.drop_database('taxi_bot_bench')
+    db_driver_locations = client.taxi_bot_bench['taxi_driver_locations']
+    for keys, options in INDEXES.get('taxi_driver_locations'):
+        db_driver_locations.create_index(keys, **options)
+
+    locator = DriverLocator(db_driver_locations, stale_after=600)
+    random.seed(42)
+    now = datetime.utcnow()
+    requests_list = []
+    for driver_id in range(args.drivers):
+        latitude, longitude = random_point()
+        # Stale for the locator, not old enough for the TTL index to remove them mid-run
+        updated_at = now - timedelta(hours=1) if random.random() < args.stale_share else now
+        requests_list.append(UpdateOne({'driver_id': driver_id},
+                                       {'$set': {'driver_name': f'driver{driver_id}',
+                                                 'location': {'type': 'Point', 'coordinates': [longitude, latitude]},
+                                                 'updated_at': updated_at,
+                                                 'live_until': None}},
+                                       upsert=True))
+    db_driver_locations.bulk_write(requests_list, ordered=False)
+
+    latencies = []
+    found = 0
+    for _ in range(args.lookups):
+        latitude, longitude = random_point()
+        started = time.perf_counter()
+        drivers = locator.nearest(latitude, longitude, args.k, args.radius)
+        latencies.append(time.perf_counter() - started)
+        found += len(drivers)
+
+    latencies = sorted(latency * 1000 for latency in latencies)
+    print(f'{args.drivers} drivers ({args.stale_share:.0%} stale), {args.lookups} lookups of {args.k} within {args.radius:.0f}m')
+    print(f'p50 {percentile(latencies, 0.5):.2f}ms  p95 {percentile(latencies, 0.95):.2f}ms  '
+          f'p99 {percentile(latencies, 0.99):.2f}ms  max {latencies[-1]:.2f}ms, '
+          f'{found / args.lookups:.2f} drivers found per lookup')
+
+    client.drop_database('taxi_bot_bench')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta
+
+
+class DriverLocator:
+
+    def __init__(self, db_driver_locations, stale_after: float = 600.0, busy_period: float = 3600.0):
+
+        # Positions shared with the drivers bot, in a 2dsphere index shared by every process
+        self.db_driver_locations = db_driver_locations
+        self.stale_after = stale_after
+        # Nothing tells when a ride is over: a driver on an order is offered orders again after busy_period
+        self.busy_period = busy_period
+
+    def update_location(self, driver_id: int, driver_name: str, latitude: float, longitude: float,
+                        live_period: int = None, upsert: bool = True) -> bool:
+
+        """Stores the position of a driver. Live locations stay fresh until their live period ends,
+        static ones for stale_after seconds. A shared (upserted) location makes a busy driver free again,
+        the updates of a live one don't (busy_period does). Returns False for a driver that isn't stored
+        (and not upserted)."""
+        now = datetime.utcnow()
+        fields = {'driver_name': driver_name,
+                  'location': {'type': 'Point', 'coordinates': [longitude, latitude]},
+                  'updated_at': now,
+                  'live_until': now + timedelta(seconds=live_period) if live_period else None}
+        if upsert:
+            fields.update(order_id=None, busy_until=None)
+        result = self.db_driver_locations.update_one({'driver_id': driver_id}, {'$set': fields}, upsert=upsert)
+        return result.matched_count > 0 or result.upserted_id is not None
+
+    def set_busy(self, driver_id: int, order_id: int) -> None:
+        # On an accepted order, not offered anything until the next location shared or for busy_period
+        busy_until = datetime.utcnow() + timedelta(seconds=self.busy_period)
+        self.db_driver_locations.update_one({'driver_id': driver_id},
+                                            {'$set': {'order_id': order_id, 'busy_until': busy_until}})
+
+    def remove_driver(self, driver_id: int) -> None:
+        self.db_driver_locations.delete_one({'driver_id': driver_id})
+
+    def nearest(self, latitude: float, longitude: float, limit: int, max_distance: float, exclude: list = None) -> list:
+
+        """Up to `limit` fresh drivers within max_distance meters that aren't on an order, closest first:
+        [{'driver_id': ..., 'distance': meters}]"""
+        available = self.available(datetime.utcnow())
+        if exclude:
+            available['driver_id'] = {'$nin': exclude}
+        pipeline = [
+            {'$geoNear': {'near': {'type': 'Point', 'coordinates': [longitude, latitude]},
+                          'distanceField': 'distance',
+                          'maxDistance': max_distance,
+                          'query': available,
+                          'spherical': True}},
+            {'$limit': limit},
+            {'$project': {'_id': False, 'driver_id': True, 'distance': True}}
+        ]
+        return list(self.db_driver_locations.aggregate(pipeline))
+
+    def available(self, now: datetime) -> dict:
+        # Drivers with a fresh position, not on an order (or on one for longer than busy_period)
+        return {'$and': [{'$or': [{'live_until': {'$gte': now}},
+                                  {'updated_at': {'$gte': now - timedelta(seconds=self.stale_after)}}]},
+                         {'$or': [{'order_id': None}, {'busy_until': {'$lt': now}}]}]}
+
+
+def parse_location(full_location: str) -> tuple | None:
+
+    # Orders keep their geolocation as "longitude,latitude" (empty for typed addresses)
+    longitude, _, latitude = (full_location or '').partition(',')
+    try:
+        return float(latitude), float(longitude)
+    except ValueError:
+        return None
+
+
+if __name__ == '__main__':
+    print('Only for import!')
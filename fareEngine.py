@@ -0,0 +1,244 @@
+import argparse
+import csv
+import json
+import sys
+import numpy as np
+
+from archive import OrderArchive
+from config import SETTINGS
+from database import Database
+from driverLocator import parse_location
+
+EARTH_RADIUS = 6371.0
+
+# Lei, the same tariffs the "Цены" menu shows
+DEFAULT_TARIFFS = {
+    'same_district': 40,
+    'adjacent_districts': 50,
+    'across_districts': 60,
+    'outside_per_km': 5,
+    # Roads are this much longer than the straight line
+    'road_factor': 1.3,
+    'round_to': 5
+}
+
+# Tariff classes
+SAME_DISTRICT = 'same_district'
+ADJACENT_DISTRICTS = 'adjacent_districts'
+ACROSS_DISTRICTS = 'across_districts'
+OUTSIDE = 'outside'
+TARIFF_CLASSES = np.array([SAME_DISTRICT, ADJACENT_DISTRICTS, ACROSS_DISTRICTS, OUTSIDE])
+
+# Points classified per chunk, bounds the points x edges matrices
+CHUNK_SIZE = 2048
+
+
+def haversine(longitudes_1, latitudes_1, longitudes_2, latitudes_2) -> np.ndarray:
+
+    # Kilometers, element-wise (broadcasting)
+    longitudes_1, latitudes_1, longitudes_2, latitudes_2 = map(np.radians, (longitudes_1, latitudes_1,
+                                                                            longitudes_2, latitudes_2))
+    a = (np.sin((latitudes_2 - latitudes_1) / 2) ** 2
+         + np.cos(latitudes_1) * np.cos(latitudes_2) * np.sin((longitudes_2 - longitudes_1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+class DistrictIndex:
+
+    def __init__(self, districts: list, adjacency_tolerance: float = 0.2):
+
+        """districts: [(name, [ring, ...])], a ring being [[longitude, latitude], ...]. Holes and
+        multi-polygons are just more rings of the district (even-odd rule)."""
+        self.names = [name for name, _ in districts]
+
+        # Every edge of every ring, with the district it belongs to
+        starts, ends, owners = [], [], []
+        for district_id, (_, rings) in enumerate(districts):
+            for ring in rings:
+                ring = np.asarray(ring, dtype=float)
+                starts.append(ring)
+                ends.append(np.roll(ring, -1, axis=0))
+                owners.append(np.full(len(ring), district_id))
+        starts, ends, owners = np.concatenate(starts), np.concatenate(ends), np.concatenate(owners)
+        self.x1, self.y1 = starts[:, 0], starts[:, 1]
+        self.y2 = ends[:, 1]
+        # Horizontal edges never cross the ray, their slope is not used
+        height = self.y2 - self.y1
+        self.inverse_slope = np.divide(ends[:, 0] - self.x1, height, out=np.zeros_like(height), where=height != 0)
+        # Edges x districts, to count the crossings of every district in one product
+        self.owners = np.zeros((len(owners), len(districts)), dtype=np.int32)
+        self.owners[np.arange(len(owners)), owners] = 1
+        self.vertices = starts
+
+        # Districts sharing a border (vertices closer than the tolerance, km)
+        self.adjacent = np.zeros((len(districts), len(districts)), dtype=bool)
+        for first in range(len(districts)):
+            for second in range(first + 1, len(districts)):
+                first_vertices = starts[owners == first]
+                second_vertices = starts[owners == second]
+                distances = haversine(first_vertices[:, None, 0], first_vertices[:, None, 1],
+                                      second_vertices[None, :, 0], second_vertices[None, :, 1])
+                self.adjacent[first, second] = self.adjacent[second, first] = distances.min() < adjacency_tolerance
+
+    @classmethod
+    def from_geojson(cls, path: str) -> 'DistrictIndex':
+
+        with open(path, 'r', encoding='utf-8') as file:
+            features = json.load(file).get('features')
+            file.close()
+
+        districts = []
+        for feature in features:
+            geometry = feature.get('geometry')
+            if geometry.get('type') == 'Polygon':
+                rings = geometry.get('coordinates')
+            elif geometry.get('type') == 'MultiPolygon':
+                rings = [ring for polygon in geometry.get('coordinates') for ring in polygon]
+            else:
+                continue
+            districts.append((feature.get('properties').get('name'), rings))
+        return cls(districts)
+
+    def classify(self, longitudes, latitudes) -> np.ndarray:
+
+        """District index of every point, -1 outside of all of them."""
+        longitudes, latitudes = np.asarray(longitudes, dtype=float), np.asarray(latitudes, dtype=float)
+        districts = np.full(len(longitudes), -1)
+        for start in range(0, len(longitudes), CHUNK_SIZE):
+            x = longitudes[start:start + CHUNK_SIZE, None]
+            y = latitudes[start:start + CHUNK_SIZE, None]
+            # Ray casting to the east: the edge spans the point's latitude and is crossed right of it
+            crossings = ((self.y1 > y) != (self.y2 > y)) & (x < self.x1 + (y - self.y1) * self.inverse_slope)
+            inside = (crossings.astype(np.int32) @ self.owners) % 2 == 1
+            districts[start:start + CHUNK_SIZE] = np.where(inside.any(axis=1), inside.argmax(axis=1), -1)
+        return districts
+
+    def distance_to_city(self, longitudes, latitudes) -> np.ndarray:
+
+        # Kilometers to the closest district vertex (0 for the points inside)
+        longitudes, latitudes = np.asarray(longitudes, dtype=float), np.asarray(latitudes, dtype=float)
+        distances = np.zeros(len(longitudes))
+        for start in range(0, len(longitudes), CHUNK_SIZE):
+            distances[start:start + CHUNK_SIZE] = haversine(longitudes[start:start + CHUNK_SIZE, None],
+                                                            latitudes[start:start + CHUNK_SIZE, None],
+                                                            self.vertices[None, :, 0],
+                                                            self.vertices[None, :, 1]).min(axis=1)
+        return distances
+
+
+class FareEngine:
+
+    def __init__(self, districts: DistrictIndex, tariffs: dict = None):
+
+        self.districts = districts
+        self.tariffs = dict(DEFAULT_TARIFFS, **(tariffs or {}))
+
+    @classmethod
+    def load(cls, districts_path: str, tariffs: dict = None) -> 'FareEngine':
+        return cls(DistrictIndex.from_geojson(districts_path), tariffs)
+
+    def estimate(self, from_location: str, to_location: str) -> dict | None:
+
+        """Fare of one order from its "longitude,latitude" locations, None without both of them."""
+        pickup, destination = parse_location(from_location), parse_location(to_location)
+        if pickup is None or destination is None:
+            return None
+        estimates = self.estimate_many([pickup[1]], [pickup[0]], [destination[1]], [destination[0]])
+        return {
+            'tariff_class': str(estimates.get('tariff_class')[0]),
+            'from_district': estimates.get('from_district')[0],
+            'to_district': estimates.get('to_district')[0],
+            'distance_km': round(float(estimates.get('distance_km')[0]), 1),
+            'price': int(estimates.get('price')[0])
+        }
+
+    def estimate_many(self, from_longitudes, from_latitudes, to_longitudes, to_latitudes) -> dict:
+
+        from_longitudes, from_latitudes = np.asarray(from_longitudes, dtype=float), np.asarray(from_latitudes, dtype=float)
+        to_longitudes, to_latitudes = np.asarray(to_longitudes, dtype=float), np.asarray(to_latitudes, dtype=float)
+        tariffs = self.tariffs
+
+        from_districts = self.districts.classify(from_longitudes, from_latitudes)
+        to_districts = self.districts.classify(to_longitudes, to_latitudes)
+        road_factor = tariffs.get('road_factor')
+        distances = haversine(from_longitudes, from_latitudes, to_longitudes, to_latitudes) * road_factor
+
+        inside = (from_districts >= 0) & (to_districts >= 0)
+        same = inside & (from_districts == to_districts)
+        adjacent = inside & ~same & self.districts.adjacent[from_districts, to_districts]
+        classes = np.select([same, adjacent, inside], [0, 1, 2], default=3)
+
+        # Outside the city: the in-city tariff to the border, per kilometer beyond it
+        outside_km = np.where(from_districts < 0, self.districts.distance_to_city(from_longitudes, from_latitudes), 0)
+        outside_km += np.where(to_districts < 0, self.districts.distance_to_city(to_longitudes, to_latitudes), 0)
+        outside_km = np.minimum(outside_km * road_factor, distances)
+        prices = np.select([same, adjacent, inside],
+                           [tariffs.get('same_district'), tariffs.get('adjacent_districts'), tariffs.get('across_districts')],
+                           default=tariffs.get('adjacent_districts') + tariffs.get('outside_per_km') * outside_km)
+        prices = np.round(prices / tariffs.get('round_to')) * tariffs.get('round_to')
+
+        names = np.array(self.districts.names + [''], dtype=object)
+        return {
+            'tariff_class': TARIFF_CLASSES[classes],
+            'from_district': names[from_districts],
+            'to_district': names[to_districts],
+            'distance_km': distances,
+            'price': prices.astype(int)
+        }
+
+
+def reprice_orders(fare_engine: FareEngine, collections: list, output) -> None:
+
+    """Re-prices every order with both geolocations (current tariffs and districts) into a CSV, from
+    taxi_orders and the monthly archive collections."""
+    orders = []
+    # An order copied into the archive by an interrupted batch is still in taxi_orders too
+    order_ids = set()
+    for collection in collections:
+        for order in collection.find({'from_location': {'$nin': ['', None]}, 'to_location': {'$nin': ['', None]}},
+                                     {'order_id': True, 'status': True, 'from_location': True, 'to_location': True,
+                                      'fare_estimate': True}):
+            if order.get('order_id') in order_ids:
+                continue
+            order_ids.add(order.get('order_id'))
+            pickup, destination = parse_location(order.get('from_location')), parse_location(order.get('to_location'))
+            if pickup is not None and destination is not None:
+                orders.append((order, pickup, destination))
+
+    writer = csv.writer(output)
+    writer.writerow(['order_id', 'status', 'from_district', 'to_district', 'tariff_class', 'distance_km',
+                     'price', 'previous_estimate'])
+    if not orders:
+        return
+    points = np.array([(pickup[1], pickup[0], destination[1], destination[0]) for _, pickup, destination in orders])
+    estimates = fare_engine.estimate_many(points[:, 0], points[:, 1], points[:, 2], points[:, 3])
+    for index, (order, _, _) in enumerate(orders):
+        writer.writerow([order.get('order_id'), order.get('status'), estimates.get('from_district')[index],
+                         estimates.get('to_district')[index], estimates.get('tariff_class')[index],
+                         f'{estimates.get("distance_km")[index]:.2f}', estimates.get('price')[index],
+                         order.get('fare_estimate', '')])
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description='Re-prices the historical orders with the current tariffs.')
+    parser.add_argument('--output', default='', help='CSV file, stdout when empty')
+    args = parser.parse_args()
+
+    settings = SETTINGS.current
+    districts_path = settings.get('districts_path')
+    fare_tariffs = settings.get('fare_tariffs')
+
+    fare_engine = FareEngine.load(districts_path, fare_tariffs)
+    database = Database()
+    archive = OrderArchive(database.db_orders_archive, database.archive_collection)
+    collections = [database.db_orders] + archive.month_collections()
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8', newline='') as output:
+            reprice_orders(fare_engine, collections, output)
+    else:
+        reprice_orders(fare_engine, collections, sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
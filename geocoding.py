@@ -0,0 +1,138 @@
+import logging
+import math
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from pymongo.errors import PyMongoError
+
+METERS_PER_DEGREE = 111320
+
+
+class GeocodingCache:
+
+    def __init__(self, db_geocoding=None, grid_size: float = 15, max_size: int = 10000, ttl: float = 30 * 24 * 3600):
+
+        # Persistent tier is optional, memory tier is always used
+        self.db_geocoding = db_geocoding
+        self.grid_size = grid_size
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.counters = {'memory_hits': 0, 'persistent_hits': 0, 'misses': 0}
+
+    def reverse(self, latitude: float, longitude: float, fetch) -> str | None:
+
+        """Returns the address of the grid cell the point belongs to, fetch() is called on a miss
+        and its result is cached unless it is None."""
+        return self.lookup(self.location_key(float(latitude), float(longitude)), fetch)
+
+    def search(self, address: str, fetch) -> dict | None:
+        return self.lookup(f'search:{self.normalize_address(address)}', fetch)
+
+    def location_key(self, latitude: float, longitude: float) -> str:
+
+        # Points are snapped to cells of about grid_size x grid_size meters
+        latitude_step = self.grid_size / METERS_PER_DEGREE
+        latitude_cell = math.floor(latitude / latitude_step)
+        cell_latitude = (latitude_cell + 0.5) * latitude_step
+        longitude_step = self.grid_size / (METERS_PER_DEGREE * max(math.cos(math.radians(cell_latitude)), 0.01))
+        longitude_cell = math.floor(longitude / longitude_step)
+        return f'near:{self.grid_size}:{latitude_cell}:{longitude_cell}'
+
+    @staticmethod
+    def normalize_address(address: str) -> str:
+        address = unicodedata.normalize('NFKC', address).casefold()
+        address = re.sub(r'[^\w]+', ' ', address)
+        return ' '.join(address.split())
+
+    def lookup(self, key: str, fetch):
+
+        value = self.get_memory(key)
+        if value is not None:
+            self.count('memory_hits')
+            return value
+
+        value = self.get_persistent(key)
+        if value is not None:
+            self.count('persistent_hits')
+            self.put_memory(key, value)
+            return value
+
+        self.count('misses')
+        value = fetch()
+        if value is not None:
+            self.put_memory(key, value)
+            self.put_persistent(key, value)
+        return value
+
+    def get_memory(self, key: str):
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put_memory(self, key: str, value) -> None:
+
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def get_persistent(self, key: str):
+
+        if self.db_geocoding is None:
+            return None
+        try:
+            entry = self.db_geocoding.find_one({'key': key})
+        except PyMongoError as error:
+            self.logger.warning('Geocoding cache is not available: %s', error)
+            return None
+        if entry is None or entry.get('created_at') < datetime.utcnow() - timedelta(seconds=self.ttl):
+            return None
+        return entry.get('value')
+
+    def put_persistent(self, key: str, value) -> None:
+
+        if self.db_geocoding is None:
+            return
+        try:
+            self.db_geocoding.update_one({'key': key},
+                                         {'$set': {'value': value, 'created_at': datetime.utcnow()}},
+                                         upsert=True)
+        except PyMongoError as error:
+            self.logger.warning('Geocoding cache is not available: %s', error)
+
+    def count(self, counter: str) -> None:
+
+        with self.lock:
+            self.counters[counter] += 1
+            lookups = sum(self.counters.values())
+        if lookups % 100 == 0:
+            self.logger.info('Geocoding cache: %s', self.stats())
+
+    def stats(self) -> dict:
+
+        with self.lock:
+            stats = dict(self.counters)
+        lookups = sum(stats.values())
+        hits = stats.get('memory_hits') + stats.get('persistent_hits')
+        stats['hit_rate'] = hits / lookups if lookups else 0.0
+        return stats
+
+
+if __name__ == '__main__':
+    print('Only for import!')
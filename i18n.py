@@ -0,0 +1,106 @@
+import html
+import re
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, ReplyKeyboardMarkup
+
+from config import ConfigFile
+
+LANGUAGES = ('ru', 'ro')
+DEFAULT_LANGUAGE = 'ru'
+
+# Main menu actions, by the suffix of their buttons in all_text.json
+MENU_ORDER = 'menu1'
+MENU_CANCEL = 'menu2'
+MENU_PRICES = 'menu3'
+MENU_QUESTION = 'menu4'
+# The same in both languages
+MENU_LANGUAGE = 'language'
+LANGUAGE_BUTTON = '🇷🇴 / 🇷🇺'
+
+# Callback data of the comment button
+NO_COMMENTS = 'no_comments'
+
+# {order.from}: the field `from` of the value `order`
+PLACEHOLDER = re.compile(r'\{([a-z_]+(?:\.[a-z_]+)*)\}')
+
+
+class Template:
+
+    __slots__ = ('literals', 'paths')
+
+    def __init__(self, text: str):
+
+        # Split once: literal, placeholder, literal, ... placeholder, literal
+        parts = PLACEHOLDER.split(text)
+        self.literals = parts[0::2]
+        self.paths = [tuple(placeholder.split('.')) for placeholder in parts[1::2]]
+
+    def render(self, values: dict) -> str:
+
+        """Fills the placeholders from values (nested dicts), HTML-escaped: the templates are sent with
+        parse_mode HTML and the values (addresses, names) are typed by the users."""
+        if not self.paths:
+            return self.literals[0]
+        pieces = [self.literals[0]]
+        for path, literal in zip(self.paths, self.literals[1:]):
+            value = values.get(path[0])
+            for key in path[1:]:
+                value = value.get(key) if value is not None else None
+            pieces.append(html.escape(str(value if value is not None else ''), quote=False))
+            pieces.append(literal)
+        return ''.join(pieces)
+
+
+class TextCatalog:
+
+    def __init__(self, data: dict):
+
+        # all_text.json: key -> {language: text, variant_language: text}, every text compiled once
+        self.templates = {key: {name: Template(text) for name, text in texts.items()} for key, texts in data.items()}
+
+        # Buttons of the main menu in every language -> action
+        main_menu = data.get('main_menu')
+        self.menu_actions = {text: name.rpartition('_')[0] for name, text in main_menu.items()}
+        self.menu_actions[LANGUAGE_BUTTON] = MENU_LANGUAGE
+        self.main_keyboards = {}
+        self.comment_keyboards = {}
+        for language in LANGUAGES:
+            self.main_keyboards[language] = ReplyKeyboardMarkup([
+                [
+                    KeyboardButton(text=main_menu.get(f'{MENU_ORDER}_{language}')),
+                    KeyboardButton(text=main_menu.get(f'{MENU_CANCEL}_{language}'))
+                ],
+                [
+                    KeyboardButton(text=main_menu.get(f'{MENU_PRICES}_{language}')),
+                    KeyboardButton(text=LANGUAGE_BUTTON),
+                    KeyboardButton(text=main_menu.get(f'{MENU_QUESTION}_{language}'))
+                ]
+            ], resize_keyboard=True, one_time_keyboard=False)
+            self.comment_keyboards[language] = InlineKeyboardMarkup([
+                [InlineKeyboardButton(data.get('taxi_comment').get(f'button_{language}'), callback_data=NO_COMMENTS)]
+            ])
+
+    def text(self, key: str, language: str, variant: str = '', **values) -> str:
+
+        # text('accepted_order', 'ro', order=order), text('taxi_contact', 'ru', 'special')
+        texts = self.templates.get(key)
+        template = texts.get(f'{variant}_{language}' if variant else language)
+        if template is None:
+            template = texts.get(f'{variant}_{DEFAULT_LANGUAGE}' if variant else DEFAULT_LANGUAGE)
+        return template.render(values)
+
+    def menu_action(self, button_text: str) -> str | None:
+        return self.menu_actions.get(button_text)
+
+    def main_keyboard(self, language: str) -> ReplyKeyboardMarkup:
+        return self.main_keyboards.get(language) or self.main_keyboards.get(DEFAULT_LANGUAGE)
+
+    def comment_keyboard(self, language: str) -> InlineKeyboardMarkup:
+        return self.comment_keyboards.get(language) or self.comment_keyboards.get(DEFAULT_LANGUAGE)
+
+
+# Texts of both bots, compiled on first use and again when all_text.json changes
+TEXTS = ConfigFile('all_text.json', TextCatalog)
+
+
+if __name__ == '__main__':
+    print('Only for import!')
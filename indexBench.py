@@ -0,0 +1,118 @@
+import argparse
+import random
+import time
+from datetime import datetime
+from bson import ObjectId
+from pymongo import MongoClient
+
+from config import SETTINGS
+from database import IndexManager, FINISHED_STATUSES
+from driverBench import percentile
+
+# Hot queries on taxi_orders, the shapes of QUERY_SHAPES with random values: name -> (filter, sort, limit)
+ORDER_QUERIES = {
+    'order by id': lambda orders, users: ({'order_id': random.randint(1, orders)}, None, 1),
+    'open order by id': lambda orders, users: ({'order_id': random.randint(1, orders), 'status': 'open'}, None, 1),
+    'last order id': lambda orders, users: ({'order_id': {'$exists': True}}, [('order_id', -1)], 1),
+    'rider open order': lambda orders, users: ({'user_id': random.randint(1, users), 'status': 'open'}, None, 1),
+    'orders to archive': lambda orders, users: ({'status': {'$in': FINISHED_STATUSES},
+                                                 '_id': {'$lt': ObjectId.from_datetime(datetime.utcnow())}},
+                                                [('_id', 1)], 500)
+}
+
+# Most orders are finished, a few are still in the wizard or waiting for a driver
+STATUSES = [('accepted', 0.6), ('declined', 0.3), ('expired', 0.05), ('new', 0.04), ('open', 0.01)]
+
+
+def synthetic_order(order_id: int, users: int) -> dict:
+
+    status = random.choices([status for status, _ in STATUSES], [share for _, share in STATUSES])[0]
+    return {'order_id': order_id,
+            'user_id': random.randint(1, users),
+            'status': status}
+
+
+def run_query(db_orders, filter_: dict, sort: list, limit: int) -> list:
+
+    cursor = db_orders.find(filter_)
+    if sort:
+        cursor = cursor.sort(sort)
+    return list(cursor.limit(limit))
+
+
+def measure(db_orders, args, index_manager: IndexManager) -> dict:
+
+    # Query name -> (winning plan stages, documents examined, sorted latencies in ms)
+    results = {}
+    for name, build_query in ORDER_QUERIES.items():
+        filter_, sort, limit = build_query(args.orders, args.users)
+        cursor = db_orders.find(filter_)
+        if sort:
+            cursor = cursor.sort(sort)
+        explanation = cursor.limit(limit).explain()
+        stages = index_manager.plan_stages(explanation.get('queryPlanner').get('winningPlan'))
+        examined = explanation.get('executionStats', {}).get('totalDocsExamined')
+
+        latencies = []
+        for _ in range(args.lookups):
+            filter_, sort, limit = build_query(args.orders, args.users)
+            started = time.perf_counter()
+            run_query(db_orders, filter_, sort, limit)
+            latencies.append(time.perf_counter() - started)
+        results[name] = (stages, examined, sorted(latency * 1000 for latency in latencies))
+    return results
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description='Latency of the hot taxi_orders queries over synthetic orders, '
+                                                 'without and with the indexes of IndexManager.')
+    parser.add_argument('--mongodb', default='', help='MongoDB connection string, settings.json when empty')
+    parser.add_argument('--orders', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--lookups', type=int, default=200, help='queries of every shape')
+    args = parser.parse_args()
+
+    mongodb_connection = args.mongodb
+    if not mongodb_connection:
+        mongodb_connection = SETTINGS.current.get('mongodb_connection')
+
+    # A scratch database, the production collections are never touched
+    client = MongoClient(mongodb_connection)
+    client.drop_database('taxi_bot_bench')
+    database = client.taxi_bot_bench
+    db_orders = database['taxi_orders']
+
+    random.seed(42)
+    started = time.monotonic()
+    batch = []
+    for order_id in range(1, args.orders + 1):
+        batch.append(synthetic_order(order_id, args.users))
+        if len(batch) == 10000:
+            db_orders.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        db_orders.insert_many(batch, ordered=False)
+    print(f'{args.orders} orders of {args.users} riders inserted in {time.monotonic() - started:.1f}s, '
+          f'{args.lookups} queries of every shape')
+
+    index_manager = IndexManager(database)
+    without_indexes = measure(db_orders, args, index_manager)
+    started = time.monotonic()
+    index_manager.ensure_indexes()
+    print(f'Indexes built in {time.monotonic() - started:.1f}s')
+    with_indexes = measure(db_orders, args, index_manager)
+
+    print(f'{"query":<20}{"indexes":>9}{"plan":>10}{"examined":>10}{"p50 ms":>10}{"p99 ms":>10}{"max ms":>10}')
+    for name in ORDER_QUERIES:
+        for label, results in (('no', without_indexes), ('yes', with_indexes)):
+            stages, examined, latencies = results.get(name)
+            plan = 'COLLSCAN' if 'COLLSCAN' in stages else 'IXSCAN' if 'IXSCAN' in stages else stages[0]
+            print(f'{name:<20}{label:>9}{plan:>10}{examined if examined is not None else "-":>10}'
+                  f'{percentile(latencies, 0.5):>10.2f}{percentile(latencies, 0.99):>10.2f}{latencies[-1]:>10.2f}')
+
+    client.drop_database('taxi_bot_bench')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,664 @@
+import argparse
+import hashlib
+import http.client
+import itertools
+import json
+import os
+import random
+import re
+import resource
+import socket
+import tempfile
+import threading
+import time
+import warnings
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qsl, urlsplit
+
+from config import SETTINGS
+from database import Database, ROUND_TRIPS
+from driverBench import CENTER_LATITUDE, CENTER_LONGITUDE, percentile
+from i18n import TEXTS
+from main import start_bots, create_notifier, start_webhook_server
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+USER_BOT_TOKEN = '100001:load-bench-user'
+DRIVERS_BOT_TOKEN = '100002:load-bench-drivers'
+DRIVERS_CHAT_ID = -1001
+ADMIN_GROUP_ID = -1002
+ADMIN_GROUP_ORDERS_ID = -1003
+FIRST_RIDER_ID = 1000000
+FIRST_DRIVER_ID = 2000000
+
+# Settings of the run, over the ones of settings.json
+BENCH_SETTINGS = {
+    'bot_token_user': USER_BOT_TOKEN,
+    'bot_token_drivers': DRIVERS_BOT_TOKEN,
+    'bot_group_id': DRIVERS_CHAT_ID,
+    'bot_admin_group_id': ADMIN_GROUP_ID,
+    'bot_admin_group_orders_id': ADMIN_GROUP_ORDERS_ID,
+    'mapmd_token': 'load-bench',
+    'update_mode': 'polling',
+    'index_audit': False,
+    # The capacity of the bot is measured, not Telegram's flood limits (--telegram-limits keeps them)
+    'send_global_rate': 1000000,
+    'send_chat_rate': 1000000,
+    'send_group_rate': 1000000,
+    # Orders go straight to the drivers chat and are accepted long before any timer
+    'dispatch_rings': [],
+    'order_repost_interval': 0,
+    'order_expire_after': 0,
+    'metrics_port': 0,
+    'profile_slow_updates': 0
+}
+
+# mongomock has neither change streams nor transactions, the notifier polls as often as a stream would wake it
+MONGOMOCK_SETTINGS = {
+    'transactions': False,
+    'user_cache_change_streams': False,
+    'blacklist_change_streams': False,
+    'notifier_change_streams': False,
+    'notifier_poll_min_interval': 0.05,
+    'notifier_poll_max_interval': 0.05
+}
+
+# Flood limits of settings.json, not overridden with --telegram-limits
+LIMIT_SETTINGS = ('send_global_rate', 'send_chat_rate', 'send_group_rate')
+
+# Paths of settings.json relative to the repository
+PATH_SETTINGS = ('address_index_path', 'districts_path')
+
+# Destinations the riders type
+STREETS = ['bd. Dacia', 'str. Ismail', 'bd. Ștefan cel Mare', 'str. Alba Iulia', 'bd. Moscova', 'str. Calea Ieșilor',
+           'str. Mihai Viteazul', 'bd. Decebal', 'str. Independenței', 'bd. Traian']
+
+# Wizard steps of a rider, every one of them answered by one message of the bot
+RIDER_STEPS = ['start', 'order', 'pickup', 'destination', 'contact', 'comment']
+# Same order of a returning rider
+RETURNING_RIDER_STEPS = RIDER_STEPS[1:]
+
+# pymongo command of every collection method, mongomock doesn't publish command events
+COMMAND_NAMES = {
+    'find': 'find',
+    'find_one': 'find',
+    'count_documents': 'aggregate',
+    'aggregate': 'aggregate',
+    'distinct': 'distinct',
+    'insert': 'insert',
+    'insert_one': 'insert',
+    'insert_many': 'insert',
+    'update': 'update',
+    'update_one': 'update',
+    'update_many': 'update',
+    'replace_one': 'update',
+    'remove': 'delete',
+    'delete_one': 'delete',
+    'delete_many': 'delete',
+    'find_one_and_update': 'findAndModify',
+    'find_one_and_delete': 'findAndModify',
+    'find_one_and_replace': 'findAndModify',
+    'create_index': 'createIndexes'
+}
+# An unordered bulk write is one command per kind of request
+BULK_COMMAND_NAMES = {
+    'InsertOne': 'insert',
+    'UpdateOne': 'update',
+    'UpdateMany': 'update',
+    'ReplaceOne': 'update',
+    'DeleteOne': 'delete',
+    'DeleteMany': 'delete'
+}
+
+
+class MonitoredCursor:
+
+    def __init__(self, cursor, lock):
+
+        # Results are computed on the first next(), under the lock of the client
+        self.cursor = cursor
+        self.lock = lock
+
+    def __getattr__(self, name: str):
+
+        attribute = getattr(self.cursor, name)
+
+        def call(*args, **kwargs):
+            with self.lock:
+                result = attribute(*args, **kwargs)
+            # sort(), limit()... return the cursor itself
+            return MonitoredCursor(result, self.lock) if result is self.cursor else result
+
+        return call
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self.lock:
+            return next(self.cursor)
+
+
+class MonitoredCollection:
+
+    def __init__(self, collection, listener, lock):
+
+        """mongomock collection reporting its commands to the listener, as pymongo's monitoring would. The
+        commands run one at a time: mongomock doesn't make them atomic the way the server does (two drivers
+        could both accept an order)."""
+        self.collection = collection
+        self.listener = listener
+        self.lock = lock
+
+    def __getattr__(self, name: str):
+
+        attribute = getattr(self.collection, name)
+        if name != 'bulk_write' and name not in COMMAND_NAMES:
+            return attribute
+
+        def command(*args, **kwargs):
+            if name == 'bulk_write':
+                command_names = {BULK_COMMAND_NAMES.get(type(request).__name__) for request in args[0]}
+            else:
+                command_names = {COMMAND_NAMES.get(name)}
+            for command_name in command_names:
+                self.listener.started(SimpleNamespace(command_name=command_name,
+                                                      command={command_name: self.collection.name}))
+            with self.lock:
+                result = attribute(*args, **kwargs)
+            # find() is read lazily, under the same lock
+            return MonitoredCursor(result, self.lock) if name == 'find' else result
+
+        return command
+
+
+class MonitoredClient:
+
+    def __init__(self, client, listener):
+
+        self.client = client
+        self.listener = listener
+        self.lock = threading.Lock()
+
+    def __getitem__(self, name: str) -> 'MonitoredDatabase':
+        return MonitoredDatabase(self.client[name], self.listener, self.lock)
+
+    def __getattr__(self, name: str):
+        return getattr(self.client, name)
+
+
+class MonitoredDatabase:
+
+    def __init__(self, database, listener, lock):
+
+        self.database = database
+        self.listener = listener
+        self.lock = lock
+
+    def __getitem__(self, name: str) -> MonitoredCollection:
+        return MonitoredCollection(self.database[name], self.listener, self.lock)
+
+    def __getattr__(self, name: str):
+        return getattr(self.database, name)
+
+
+class FakeServer:
+
+    def __init__(self):
+
+        # HTTP server answering every request with handle(path, params) -> (status, result) of the subclass
+        self.server = None
+
+    def start(self) -> 'FakeServer':
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.request_handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name=type(self).__name__, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def request_handler(self):
+
+        fake_server = self
+
+        class FakeRequestHandler(BaseHTTPRequestHandler):
+
+            # Keep-alive, like the real APIs (headers and body are separate writes, Nagle would delay the body)
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self) -> None:
+                url = urlsplit(self.path)
+                self.respond(*fake_server.handle(url.path, dict(parse_qsl(url.query))))
+
+            def do_POST(self) -> None:
+                url = urlsplit(self.path)
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    params = json.loads(body or b'{}')
+                else:
+                    params = dict(parse_qsl(body.decode()))
+                self.respond(*fake_server.handle(url.path, params))
+
+            def respond(self, status: int, result) -> None:
+                body = json.dumps(result).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client has given up waiting (timeouts of the map.md client)
+                    self.close_connection = True
+
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+        return FakeRequestHandler
+
+
+class FakeBotApi(FakeServer):
+
+    def __init__(self):
+
+        """Bot API of both bots: /bot<token>/<method>. Updates pushed with push_update are served by
+        getUpdates (long polling), the calls of the bots are passed to the listeners."""
+        super().__init__()
+        self.condition = threading.Condition()
+        self.updates = {}
+        self.closed = False
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        # listener(token, method, params, result), called after the result is made
+        self.listeners = []
+
+    def push_update(self, token: str, update: dict) -> None:
+
+        with self.condition:
+            update['update_id'] = next(self.update_ids)
+            self.updates.setdefault(token, []).append(update)
+            self.condition.notify_all()
+
+    def close(self) -> None:
+
+        # Pending long polls return at once, the updaters stop without waiting for their timeout
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def handle(self, path: str, params: dict) -> tuple:
+
+        token, _, method = path[len('/bot'):].partition('/')
+        if method == 'getUpdates':
+            result = self.get_updates(token, int(params.get('offset') or 0), float(params.get('timeout') or 0))
+        elif method in ('sendMessage', 'forwardMessage'):
+            result = {'message_id': next(self.message_ids), 'date': int(time.time()),
+                      'chat': {'id': int(params.get('chat_id')), 'type': 'private' if int(params.get('chat_id')) > 0 else 'supergroup'},
+                      'from': self.bot_user(token), 'text': params.get('text', '')}
+        elif method == 'getMe':
+            result = self.bot_user(token)
+        elif method == 'getChatMember':
+            result = {'status': 'member', 'user': {'id': int(params.get('user_id')), 'is_bot': False, 'first_name': 'driver'}}
+        else:
+            # deleteMessage, answerCallbackQuery, setWebhook...
+            result = True
+        for listener in self.listeners:
+            listener(token, method, params, result)
+        return 200, {'ok': True, 'result': result}
+
+    def get_updates(self, token: str, offset: int, timeout: float) -> list:
+
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            updates = self.updates.setdefault(token, [])
+            # Updates below the offset are confirmed
+            updates[:] = [update for update in updates if update.get('update_id') >= offset]
+            while not updates and not self.closed and time.monotonic() < deadline:
+                self.condition.wait(deadline - time.monotonic())
+            return updates[:100]
+
+    @staticmethod
+    def bot_user(token: str) -> dict:
+        return {'id': int(token.partition(':')[0]), 'is_bot': True, 'first_name': 'bench', 'username': f'bench{token[:6]}bot'}
+
+
+class WebhookClient:
+
+    def __init__(self, url: str, secret_token: str):
+
+        # Updates POSTed to the webhook server of the bots, the way Telegram delivers them in webhook mode
+        self.url = urlsplit(url)
+        self.secret_token = secret_token
+        self.update_ids = itertools.count(1)
+
+    def push_update(self, token: str, update: dict) -> None:
+
+        update['update_id'] = next(self.update_ids)
+        connection = http.client.HTTPConnection(self.url.hostname, self.url.port, timeout=10)
+        try:
+            connection.request('POST', f'/{token}', json.dumps(update),
+                               {'Content-Type': 'application/json', 'X-Telegram-Bot-Api-Secret-Token': self.secret_token})
+            response = connection.getresponse()
+            response.read()
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise RuntimeError(f'Webhook answered {response.status}')
+
+
+class FakeMapMd(FakeServer):
+
+    def __init__(self, latency: float = 0.0):
+
+        # map.md's /near and /search with fixed answers, after `latency` seconds
+        super().__init__()
+        self.latency = latency
+
+    def handle(self, path: str, params: dict) -> tuple:
+
+        time.sleep(self.latency)
+        if path.endswith('/near'):
+            return 200, {'building': {'location': 'Chişinău', 'street_name': 'bd. Dacia',
+                                      'number': str(int(float(params.get('lat')) * 1000) % 100 + 1)}}
+        # The same address always has the same centroid
+        digest = hashlib.md5(params.get('q', '').encode()).digest()
+        return 200, {'selected': {'centroid': {'lat': CENTER_LATITUDE + (digest[0] - 128) / 2000,
+                                               'lon': CENTER_LONGITUDE + (digest[1] - 128) / 2000}}}
+
+
+class LoadSimulation:
+
+    def __init__(self, bot_api: FakeBotApi, riders: int, orders_per_rider: int, drivers: int, drivers_per_order: int,
+                 seed: int = 42, updates=None):
+
+        """Riders go through the order wizard (the next step as soon as the bot answers the previous one),
+        drivers_per_order drivers tap "Принять" on every order posted to the drivers chat. The updates go
+        through getUpdates of the Bot API, or to `updates` (a WebhookClient)."""
+        self.bot_api = bot_api
+        self.updates = updates or bot_api
+        self.riders = riders
+        self.orders_per_rider = orders_per_rider
+        self.drivers = drivers
+        self.drivers_per_order = drivers_per_order
+        self.random = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.message_ids = itertools.count(1)
+        # Rider ID -> {steps, step, sent_at, opened_at, orders}
+        self.rider_states = {}
+        # Callback query ID -> (driver ID, order ID, sent_at)
+        self.accepts = {}
+        # Driver ID -> sent_at of the taps that won, until their riders are told
+        self.wins = {}
+        self.latencies = {step: [] for step in RIDER_STEPS + ['accept', 'told', 'accepted']}
+        self.winners = {}
+        self.late_drivers = 0
+        self.orders_accepted = 0
+        self.updates_sent = 0
+        self.done = threading.Event()
+
+        bot_api.listeners.append(self.on_bot_call)
+
+    def start(self) -> None:
+
+        for rider_id in range(FIRST_RIDER_ID, FIRST_RIDER_ID + self.riders):
+            self.rider_states[rider_id] = {'steps': RIDER_STEPS, 'step': 0, 'sent_at': 0.0, 'opened_at': 0.0, 'orders': 0}
+        for rider_id in list(self.rider_states):
+            with self.lock:
+                self.send_step(rider_id)
+
+    def send_step(self, rider_id: int) -> None:
+
+        state = self.rider_states.get(rider_id)
+        step = state.get('steps')[state.get('step')]
+        user = {'id': rider_id, 'is_bot': False, 'first_name': f'rider{rider_id}', 'username': f'rider{rider_id}'}
+        message = {'message_id': next(self.message_ids), 'date': int(time.time()), 'from': user,
+                   'chat': {'id': rider_id, 'type': 'private', 'first_name': f'rider{rider_id}',
+                            'username': f'rider{rider_id}'}}
+        if step == 'start':
+            update = {'message': dict(message, text='/start', entities=[{'type': 'bot_command', 'offset': 0, 'length': 6}])}
+        elif step == 'order':
+            update = {'message': dict(message, text='Заказать')}
+        elif step == 'pickup':
+            update = {'message': dict(message, location={'latitude': CENTER_LATITUDE + self.random.uniform(-0.05, 0.05),
+                                                         'longitude': CENTER_LONGITUDE + self.random.uniform(-0.05, 0.05)})}
+        elif step == 'destination':
+            update = {'message': dict(message, text=f'{self.random.choice(STREETS)} {self.random.randint(1, 60)}')}
+        elif step == 'contact':
+            update = {'message': dict(message, text=f'+3736{rider_id % 10000000:07d}')}
+        else:
+            update = {'callback_query': {'id': f'comment:{rider_id}:{state.get("orders")}', 'from': user,
+                                         'chat_instance': str(rider_id), 'data': 'no_comments',
+                                         'message': dict(message, **{'from': FakeBotApi.bot_user(USER_BOT_TOKEN)},
+                                                         text='comment')}}
+        state['sent_at'] = time.monotonic()
+        self.updates_sent += 1
+        self.updates.push_update(USER_BOT_TOKEN, update)
+
+    def on_bot_call(self, token: str, method: str, params: dict, result) -> None:
+
+        now = time.monotonic()
+        with self.lock:
+            if method == 'sendMessage' and int(params.get('chat_id')) == DRIVERS_CHAT_ID:
+                self.race(params, result)
+            elif method == 'sendMessage' and token == USER_BOT_TOKEN and int(params.get('chat_id')) in self.rider_states:
+                self.rider_answered(int(params.get('chat_id')), now, params.get('text', ''))
+            elif method == 'answerCallbackQuery' and params.get('callback_query_id') in self.accepts:
+                driver_id, order_id, sent_at = self.accepts.pop(params.get('callback_query_id'))
+                self.latencies.get('accept').append(now - sent_at)
+                # Only the losers are told the order is gone
+                if params.get('text'):
+                    self.late_drivers += 1
+                else:
+                    self.winners[order_id] = self.winners.get(order_id, 0) + 1
+                    self.wins.setdefault(driver_id, []).append(sent_at)
+
+    def race(self, params: dict, result: dict) -> None:
+
+        reply_markup = params.get('reply_markup')
+        if isinstance(reply_markup, str):
+            reply_markup = json.loads(reply_markup)
+        callback_data = reply_markup.get('inline_keyboard')[0][0].get('callback_data')
+        order_id = int(callback_data.partition(':')[2])
+
+        # Every driver taps at the same time
+        for driver_id in self.random.sample(range(FIRST_DRIVER_ID, FIRST_DRIVER_ID + self.drivers), self.drivers_per_order):
+            query_id = f'accept:{order_id}:{driver_id}'
+            self.accepts[query_id] = (driver_id, order_id, time.monotonic())
+            self.updates_sent += 1
+            self.updates.push_update(DRIVERS_BOT_TOKEN, {'callback_query': {
+                'id': query_id,
+                'from': {'id': driver_id, 'is_bot': False, 'first_name': f'driver{driver_id}', 'username': f'driver{driver_id}'},
+                'chat_instance': str(DRIVERS_CHAT_ID),
+                'data': callback_data,
+                'message': {'message_id': result.get('message_id'), 'date': result.get('date'), 'chat': result.get('chat'),
+                            'from': result.get('from'), 'text': params.get('text')}
+            }})
+
+    def rider_answered(self, rider_id: int, now: float, text: str) -> None:
+
+        state = self.rider_states.get(rider_id)
+        steps = state.get('steps')
+        if state.get('step') < len(steps):
+            self.latencies.get(steps[state.get('step')]).append(now - state.get('sent_at'))
+            state['step'] += 1
+            if state.get('step') < len(steps):
+                self.send_step(rider_id)
+            else:
+                state['opened_at'] = now
+            return
+
+        # Waiting for a driver: the bot tells the rider the order is accepted (and by whom)
+        self.latencies.get('accepted').append(now - state.get('opened_at'))
+        driver = re.search(r'@driver(\d+)', text)
+        if driver and self.wins.get(int(driver.group(1))):
+            self.latencies.get('told').append(now - self.wins.get(int(driver.group(1))).pop(0))
+        self.orders_accepted += 1
+        state['orders'] += 1
+        if state.get('orders') < self.orders_per_rider:
+            state.update({'steps': RETURNING_RIDER_STEPS, 'step': 0})
+            self.send_step(rider_id)
+        elif self.orders_accepted == self.riders * self.orders_per_rider:
+            self.done.set()
+
+
+def operation_counts(round_trips) -> tuple:
+
+    # MongoDB commands made in the update handlers and outside of them (notifier, background threads)
+    in_handlers, background = 0, 0
+    for (handler, _, _), counter in list(round_trips.operations.children.items()):
+        if handler:
+            in_handlers += counter.snapshot()
+        else:
+            background += counter.snapshot()
+    return in_handlers, background
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def write_settings(path: str, overrides: dict) -> None:
+
+    file_data = dict(SETTINGS.load(os.path.join(REPO_DIR, 'settings.json')))
+    for key in PATH_SETTINGS:
+        if file_data.get(key):
+            file_data[key] = os.path.join(REPO_DIR, file_data.get(key))
+    file_data.update(overrides)
+    with open(path, 'w') as file:
+        json.dump(file_data, file, indent=2, default=dict)
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description='Load test of both bots against a fake Bot API, a stub map.md and '
+                                                 'mongomock (or a scratch database): riders through the order wizard, '
+                                                 'drivers racing to accept.')
+    parser.add_argument('--riders', type=int, default=100, help='riders ordering at the same time')
+    parser.add_argument('--orders', type=int, default=3, help='orders of every rider, one after another')
+    parser.add_argument('--drivers', type=int, default=50)
+    parser.add_argument('--drivers-per-order', type=int, default=5, help='drivers tapping "Принять" on every order')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='handler threads of each bot (of the asyncio server), settings.json when 0')
+    parser.add_argument('--update-mode', choices=('polling', 'webhook', 'asyncio'), default='polling',
+                        help='updates through getUpdates or POSTed to the webhook server (asyncio: its ingress '
+                             'only, the handlers stay synchronous on a thread pool)')
+    parser.add_argument('--telegram-limits', action='store_true',
+                        help='send at the flood limits of settings.json (20 messages a minute to a group)')
+    parser.add_argument('--map-latency', type=float, default=0.0, help='seconds the stub map.md takes to answer')
+    # mongomock scans its collections (no indexes): right for the command counts, slower as the run grows
+    parser.add_argument('--mongodb', default='', help='MongoDB connection string (scratch database), mongomock when empty')
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    # mongomock warns about the legacy update()/insert() some managers still call
+    warnings.simplefilter('ignore', DeprecationWarning)
+
+    bot_api = FakeBotApi().start()
+    map_md = FakeMapMd(args.map_latency).start()
+
+    # The run has its own settings, over the ones of the repository
+    settings = dict(BENCH_SETTINGS, bot_api_url=f'{bot_api.url}/bot', mapmd_url=map_md.url)
+    if not args.mongodb:
+        settings.update(MONGOMOCK_SETTINGS)
+    if args.workers:
+        settings.update(workers=args.workers, handler_workers=args.workers)
+    if args.telegram_limits:
+        for key in LIMIT_SETTINGS:
+            del settings[key]
+    if args.update_mode != 'polling':
+        webhook_port = free_port()
+        settings.update(update_mode=args.update_mode, webhook_listen='127.0.0.1', webhook_port=webhook_port,
+                        webhook_url=f'http://127.0.0.1:{webhook_port}', webhook_secret='load-bench')
+    settings_file, settings_path = tempfile.mkstemp(prefix='load-bench-', suffix='.json')
+    os.close(settings_file)
+    write_settings(settings_path, settings)
+    SETTINGS.load(settings_path)
+    TEXTS.load(os.path.join(REPO_DIR, 'all_text.json'))
+
+    if args.mongodb:
+        from pymongo import MongoClient
+        client = MongoClient(args.mongodb)
+        client.drop_database('taxi_bot_bench')
+    else:
+        import mongomock
+        client = MonitoredClient(mongomock.MongoClient(), ROUND_TRIPS)
+
+    database, telegram_bot, telegram_chat_bot = start_bots(database=Database(client, 'taxi_bot_bench'))
+    webhook_server, updates = None, None
+    if args.update_mode != 'polling':
+        webhook_server = start_webhook_server(telegram_bot, telegram_chat_bot)
+        updates = WebhookClient(SETTINGS.current.get('webhook_url'), SETTINGS.current.get('webhook_secret'))
+    notifier, outbox_dispatcher = create_notifier(database, telegram_bot, telegram_chat_bot)
+    threading.Thread(target=notifier.run, args=(outbox_dispatcher.dispatch,), name='notifier', daemon=True).start()
+
+    simulation = LoadSimulation(bot_api, args.riders, args.orders, args.drivers, args.drivers_per_order, args.seed,
+                                updates)
+    operations_before = operation_counts(ROUND_TRIPS)
+    started = time.monotonic()
+    simulation.start()
+    # Threads of the process, sampled while the run lasts
+    peak_threads = threading.active_count()
+    while not simulation.done.wait(0.05) and time.monotonic() - started < args.timeout:
+        peak_threads = max(peak_threads, threading.active_count())
+    elapsed = time.monotonic() - started
+    in_handlers, background = (after - before for after, before in zip(operation_counts(ROUND_TRIPS), operations_before))
+
+    orders = args.riders * args.orders
+    accepted = simulation.orders_accepted
+    print(f'{args.riders} riders x {args.orders} orders, {args.drivers_per_order} of {args.drivers} drivers racing, '
+          f'{"mongomock" if not args.mongodb else "MongoDB"}, {"Telegram" if args.telegram_limits else "no"} flood limits, '
+          f'{"asyncio ingress" if args.update_mode == "asyncio" else args.update_mode}, '
+          f'{SETTINGS.current.get("handler_workers" if args.update_mode == "asyncio" else "workers", 4)} handler threads')
+    print(f'{accepted}/{orders} orders accepted in {elapsed:.2f}s: {accepted / elapsed:.1f} orders/s, '
+          f'{simulation.updates_sent / elapsed:.1f} updates/s')
+    print(f'{"step":<12}{"count":>8}{"p50 ms":>10}{"p99 ms":>10}{"max ms":>10}')
+    for step, latencies in simulation.latencies.items():
+        if latencies:
+            latencies = sorted(latency * 1000 for latency in latencies)
+            print(f'{step:<12}{len(latencies):>8}{percentile(latencies, 0.5):>10.1f}{percentile(latencies, 0.99):>10.1f}'
+                  f'{latencies[-1]:>10.1f}')
+    print('(accept: driver tap -> answer, told: winning tap -> rider told, accepted: order opened -> rider told, '
+          'through the notifier)')
+    if accepted:
+        print(f'MongoDB commands per order: {in_handlers / accepted:.1f} in the handlers, '
+              f'{background / accepted:.1f} outside of them (notifier, background threads)')
+    # The whole process: fake servers and mongomock included, the same in every mode
+    print(f'peak threads: {peak_threads}, max RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB')
+    print('round trips per update: ' + ', '.join(f'{name} {average:.1f}'
+                                                 for name, average in sorted(ROUND_TRIPS.report().items())))
+
+    # Exactly one driver wins every order
+    double_accepts = [order_id for order_id, winners in simulation.winners.items() if winners > 1]
+    print(f'driver race: {len(simulation.winners)} orders won, {len(double_accepts)} won twice, '
+          f'{simulation.late_drivers} late drivers told the order is gone')
+
+    bot_api.close()
+    notifier.stop()
+    if webhook_server is not None:
+        webhook_server.stop()
+    for updater in (telegram_bot.updater, telegram_chat_bot.updater):
+        updater.stop()
+    telegram_bot.scheduler.stop()
+    telegram_bot.conversations.stop()
+    bot_api.stop()
+    map_md.stop()
+    if args.mongodb:
+        client.drop_database('taxi_bot_bench')
+    os.remove(settings_path)
+
+    print('OK' if accepted == orders and not double_accepts else 'FAILED')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,82 +1,483 @@
+import html
 import urllib.parse
 import json
+import logging
+import threading
+from datetime import datetime, timedelta
 
-import requests
-from requests.auth import HTTPBasicAuth
-
-from telegram import ParseMode, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import ParseMode, Update
+from telegram.ext import Updater
 
+from archive import OrderArchiver
+from asyncCore import AsyncWebhookServer
+from cluster import Cluster, LeaderElection, LeaderLease, ShardedWebhookServer
+from config import SETTINGS, ConfigWatcher
 from database import Database
+from i18n import TEXTS
+from metrics import HANDLERS, MetricsServer, SlowUpdateProfiler
+from orderNotifier import OrderNotifier
+from outbox import Outbox, OutboxDispatcher, OUTBOX_CHANGES_PIPELINE, NEW_ORDER, ORDER_ACCEPTED, ORDER_DECLINED, ORDER_DISPATCH, ORDER_REMINDER, ORDER_EXPIRED
+from sendQueue import MessageScheduler, PRIORITY_RIDER, PRIORITY_DRIVERS, send_error
 from telegramBot import TelegramBot
 from telegramChatBot import TelegramChatBot
-
-# TEXT DICTIONARY
-with open('all_text.json', 'r', encoding='utf-8') as file:
-    ALL_TEXT = json.load(file)
-    file.close()
+from timers import TimerService, ORDER_REPOST, ORDER_EXPIRE, GARBAGE_COLLECTION, ORDER_ARCHIVAL
+from webhook import WebhookServer
 
 
 def main():
 
-    # Map.md Token
-    with open('settings.json', 'r') as file:
-        file_data = json.load(file)
-        mapmd_token = file_data.get('mapmd_token')
-        file.close()
+    settings = SETTINGS.current
+    bot_token_user = settings.get('bot_token_user')
+    bot_token_drivers = settings.get('bot_token_drivers')
+    update_mode = settings.get('update_mode', 'polling')
+    webhook_listen = settings.get('webhook_listen', '0.0.0.0')
+    webhook_port = settings.get('webhook_port', 8443)
+    webhook_url = settings.get('webhook_url', '')
+    webhook_secret = settings.get('webhook_secret', '')
+    cluster_workers = settings.get('cluster_workers', 4)
+
+    start_metrics()
+
+    # Cluster mode: this process is only the ingress, the bots run in the worker processes
+    if update_mode == 'cluster':
+        cluster = Cluster(cluster_workers, run_worker)
+        cluster.start()
+        webhook_server = ShardedWebhookServer(webhook_listen, webhook_port, webhook_url, webhook_secret,
+                                              cluster.queues)
+        webhook_server.add_bot(Updater(token=bot_token_user, use_context=True, workers=0))
+        webhook_server.add_bot(Updater(token=bot_token_drivers, use_context=True, workers=0), Update.ALL_TYPES)
+        webhook_server.start()
+        cluster.supervise()
+        return
+
+    database, telegram_bot, telegram_chat_bot = start_bots()
+    start_config_watcher()
+
+    # Webhook modes: one HTTP ingress for both bots instead of two long-polling loops
+    if update_mode in ('webhook', 'asyncio'):
+        start_webhook_server(telegram_bot, telegram_chat_bot)
+
+    # Reposts, expiry and garbage collection
+    timer_service = create_timer_service(telegram_bot)
+    threading.Thread(target=timer_service.run, name='timers', daemon=True).start()
+
+    # Main loop: outbox entries are claimed in batches, sent and acked
+    notifier, outbox_dispatcher = create_notifier(database, telegram_bot, telegram_chat_bot)
+    try:
+        notifier.run(outbox_dispatcher.dispatch)
+    finally:
+        # Wizard steps not flushed yet
+        telegram_bot.conversations.stop()
+
+
+def start_metrics(port_offset: int = 0) -> None:
+
+    settings = SETTINGS.current
+    metrics_listen = settings.get('metrics_listen', '127.0.0.1')
+    metrics_port = settings.get('metrics_port', 0)
+    profile_slow_updates = settings.get('profile_slow_updates', 0)
+    profile_sample_rate = settings.get('profile_sample_rate', 0.01)
+
+    # Prometheus endpoint (GET /metrics), off without a port
+    if metrics_port:
+        MetricsServer(metrics_listen, metrics_port + port_offset).start()
+    # Profiles of the sampled updates slower than profile_slow_updates seconds are logged
+    if profile_slow_updates:
+        HANDLERS.profiler = SlowUpdateProfiler(profile_slow_updates, profile_sample_rate)
+
+
+def start_webhook_server(telegram_bot: TelegramBot, telegram_chat_bot: TelegramChatBot) -> WebhookServer:
+
+    settings = SETTINGS.current
+    update_mode = settings.get('update_mode', 'polling')
+    webhook_listen = settings.get('webhook_listen', '0.0.0.0')
+    webhook_port = settings.get('webhook_port', 8443)
+    webhook_url = settings.get('webhook_url', '')
+    webhook_secret = settings.get('webhook_secret', '')
+    handler_workers = settings.get('handler_workers', 32)
+
+    if update_mode == 'asyncio':
+        webhook_server = AsyncWebhookServer(webhook_listen, webhook_port, webhook_url, webhook_secret, handler_workers)
+    else:
+        webhook_server = WebhookServer(webhook_listen, webhook_port, webhook_url, webhook_secret)
+    webhook_server.add_bot(telegram_bot.updater)
+    webhook_server.add_bot(telegram_chat_bot.updater, Update.ALL_TYPES)
+    webhook_server.start()
+    return webhook_server
+
+
+def start_config_watcher() -> None:
+
+    # settings.json and all_text.json are reloaded when they change, off with an interval of 0
+    config_reload_interval = SETTINGS.current.get('config_reload_interval', 5)
+    if config_reload_interval:
+        ConfigWatcher([SETTINGS, TEXTS], config_reload_interval).start()
+
+
+def start_bots(shards: int = 1, database: Database = None) -> tuple:
+
+    settings = SETTINGS.current
+    send_global_rate = settings.get('send_global_rate', 30)
+    send_chat_rate = settings.get('send_chat_rate', 1)
+    send_group_rate = settings.get('send_group_rate', 20 / 60)
+    send_workers = settings.get('send_workers', 4)
+    send_timeout = settings.get('send_timeout', 30)
+
+    if database is None:
+        database = Database()
+
+    # Outbound messages of both bots share Telegram's flood limits (split between the workers of a cluster,
+    # a private chat only ever belongs to one of them)
+    scheduler = MessageScheduler(send_global_rate / shards, send_chat_rate, send_group_rate / shards, send_workers,
+                                 send_timeout=send_timeout).start()
+
+    telegram_bot = TelegramBot(database, scheduler)
+    telegram_chat_bot = TelegramChatBot(database, scheduler, telegram_bot.orders_manager)
+
+    # Cancelled orders are taken off the drivers chat by the process that cancels them, not on the next notifier pass
+    telegram_bot.orders_manager.dispatch_now = OutboxDispatcher(telegram_bot.outbox, {
+        ORDER_DECLINED: lambda entries: deliver_declined_orders(telegram_bot, telegram_chat_bot, entries)
+    }).dispatch_now
+
+    return database, telegram_bot, telegram_chat_bot
+
+
+def create_notifier(database: Database, telegram_bot: TelegramBot, telegram_chat_bot: TelegramChatBot) -> tuple:
+
+    settings = SETTINGS.current
+    mapmd_token = settings.get('mapmd_token')
+    poll_min_interval = settings.get('notifier_poll_min_interval', 0.5)
+    poll_max_interval = settings.get('notifier_poll_max_interval', 5.0)
+    use_change_streams = settings.get('notifier_change_streams', True)
+    outbox_batch_size = settings.get('outbox_batch_size', 50)
+    order_repost_interval = settings.get('order_repost_interval', 0)
+    order_escalate_after = settings.get('order_escalate_after', 2)
+
+    # Notifications that were pending under the old per-order flags
+    migrate_notification_flags(database, telegram_bot.outbox)
+
+    outbox_dispatcher = OutboxDispatcher(telegram_bot.outbox, {
+        NEW_ORDER: lambda entries: deliver_new_orders(telegram_bot, telegram_chat_bot, mapmd_token, entries),
+        ORDER_DISPATCH: lambda entries: deliver_new_orders(telegram_bot, telegram_chat_bot, mapmd_token, entries),
+        ORDER_ACCEPTED: lambda entries: deliver_accepted_orders(telegram_bot, telegram_chat_bot, entries),
+        ORDER_DECLINED: lambda entries: deliver_declined_orders(telegram_bot, telegram_chat_bot, entries),
+        ORDER_REMINDER: lambda entries: deliver_order_reminders(telegram_bot, telegram_chat_bot, mapmd_token,
+                                                                order_repost_interval, order_escalate_after, entries),
+        ORDER_EXPIRED: lambda entries: deliver_expired_orders(telegram_bot, telegram_chat_bot, entries)
+    }, outbox_batch_size)
+    notifier = OrderNotifier(database.db_outbox, OUTBOX_CHANGES_PIPELINE, poll_min_interval, poll_max_interval,
+                             use_change_streams)
+
+    return notifier, outbox_dispatcher
+
+
+def create_timer_service(telegram_bot: TelegramBot) -> TimerService:
+
+    settings = SETTINGS.current
+    order_repost_interval = settings.get('order_repost_interval', 0)
+    order_repost_limit = settings.get('order_repost_limit', 3)
+    abandoned_after = settings.get('abandoned_after', 3600)
+    garbage_collection_interval = settings.get('garbage_collection_interval', 600)
+    order_expire_after = settings.get('order_expire_after', 0)
+    timers_refresh_interval = settings.get('timers_refresh_interval', 5)
+    archive_after = settings.get('archive_after', 30)
+    archive_batch_size = settings.get('archive_batch_size', 1000)
+    archive_interval = settings.get('archive_interval', 3600)
+    archive_max_batches = settings.get('archive_max_batches', 10)
+
+    # Users written before their documents were timestamped count as updated now
+    telegram_bot.database.db_user_info.update_many({'updated_at': {'$exists': False}},
+                                                   {'$set': {'updated_at': datetime.utcnow()}})
+    telegram_bot.timers.schedule(GARBAGE_COLLECTION, 'orders', 0, keep_existing=True)
+    telegram_bot.timers.schedule(ORDER_ARCHIVAL, 'orders', 0, keep_existing=True)
+    # Orders opened before they had timers expire like the new ones
+    if order_expire_after:
+        for order in telegram_bot.database.db_orders.find({'status': 'open'}, {'order_id': True}):
+            telegram_bot.timers.schedule(ORDER_EXPIRE, order.get('order_id'), order_expire_after, keep_existing=True)
+
+    # A few batches per run keep the timers of the leader responsive
+    archiver = OrderArchiver(telegram_bot.database.db_orders, telegram_bot.archive,
+                             telegram_bot.database.db_archive_checkpoints, archive_after, archive_batch_size)
+
+    return TimerService(telegram_bot.timers, {
+        ORDER_REPOST: lambda timer: fire_order_repost(telegram_bot, order_repost_interval, order_repost_limit, timer),
+        ORDER_EXPIRE: lambda timer: telegram_bot.orders_manager.expire_order(timer.get('key')),
+        GARBAGE_COLLECTION: lambda timer: collect_garbage(telegram_bot, abandoned_after, garbage_collection_interval),
+        ORDER_ARCHIVAL: lambda timer: archive_orders(archiver, archive_max_batches, archive_interval)
+    }, timers_refresh_interval)
+
+
+def run_worker(shard: int, queue) -> None:
+
+    settings = SETTINGS.current
+    cluster_workers = settings.get('cluster_workers', 4)
+    leader_lease_time = settings.get('leader_lease_time', 10)
+
+    # Every worker has its own metrics port, after the one of the ingress
+    start_metrics(shard + 1)
+    database, telegram_bot, telegram_chat_bot = start_bots(cluster_workers)
+    start_config_watcher()
+    updaters = {f'/{updater.bot.token}': updater for updater in (telegram_bot.updater, telegram_chat_bot.updater)}
+    for updater in updaters.values():
+        thread = threading.Thread(target=updater.dispatcher.start, name=f'dispatcher-{updater.bot.id}', daemon=True)
+        thread.start()
+
+    # Singleton duties (notifications, deleting declined orders and the timers) run on the elected worker only
+    duties = []
+
+    def start_notifier() -> None:
+        notifier, outbox_dispatcher = create_notifier(database, telegram_bot, telegram_chat_bot)
+        timer_service = create_timer_service(telegram_bot)
+        duties.extend([notifier, timer_service])
+        threading.Thread(target=notifier.run, args=(outbox_dispatcher.dispatch,), name='notifier', daemon=True).start()
+        threading.Thread(target=timer_service.run, name='timers', daemon=True).start()
+
+    def stop_notifier() -> None:
+        while duties:
+            duties.pop().stop()
+
+    election = LeaderElection(LeaderLease(database.db_leases, 'notifier', leader_lease_time), start_notifier, stop_notifier)
+    election.start()
 
-    database = Database()
+    while True:
+        path, body = queue.get()
+        updater = updaters.get(path)
+        updater.dispatcher.update_queue.put(Update.de_json(json.loads(body), updater.bot))
 
-    telegram_bot = TelegramBot(database)
-    telegram_chat_bot = TelegramChatBot(database)
 
-    # Menu
-    order_keyboard = [
-        [InlineKeyboardButton(text='Принять', callback_data='accept_order')]
-    ]
-    reply_markup = InlineKeyboardMarkup(order_keyboard, resize_keyboard=True, one_time_keyboard=False)
+def migrate_notification_flags(database: Database, outbox: Outbox) -> None:
 
-    # Main loop
-    while True:
-
-        # USER bot
-        accepted_orders = database.db_orders.find({'status': 'accepted', 'user_notification_sent': False})
-        for order in accepted_orders:
+    legacy_flags = [
+        (NEW_ORDER, 'open', 'drivers_notification_sent'),
+        (ORDER_ACCEPTED, 'accepted', 'user_notification_sent'),
+        (ORDER_DECLINED, 'declined', 'drivers_notification_declined_sent')
+    ]
+    # One pass without an index: the flags are only left on orders older than the outbox, and the archiver
+    # keeps taxi_orders down to the orders that aren't finished yet
+    legacy_orders = list(database.db_orders.find({'$or': [{'status': status, flag: False}
+                                                          for _, status, flag in legacy_flags]},
+                                                 {'order_id': True, 'status': True}))
+    for kind, status, flag in legacy_flags:
+        order_ids = [order.get('order_id') for order in legacy_orders if order.get('status') == status]
+        if order_ids:
+            outbox.enqueue_many(kind, order_ids)
+            database.db_orders.update_many({'order_id': {'$in': order_ids}}, {'$set': {flag: True}})
+
+
+def deliver_new_orders(telegram_bot: TelegramBot, telegram_chat_bot: TelegramChatBot, mapmd_token: str, entries: list) -> list:
+
+    # DRIVERS CHAT bot: the nearest drivers first, ring by ring, then the whole group
+    delivered_ids = []
+    offers_sent = []
+    orders = telegram_bot.orders_manager.get_orders_info([entry.get('order_id') for entry in entries])
+    for entry in entries:
+        order = orders.get(entry.get('order_id'))
+        # Cancelled or accepted before the drivers have seen it
+        if order is None or order.get('status') != 'open':
+            delivered_ids.append(entry.get('_id'))
+            continue
+        message_for_drivers = generate_message_for_drivers(order, mapmd_token)
+        ring, order_offers = telegram_chat_bot.offer_order(order, message_for_drivers, entry.get('stage', 0))
+        if order_offers:
+            offers_sent.append((entry, order, ring, order_offers))
+            continue
+        # Message to drivers chat
+        message_sent = telegram_chat_bot.scheduler.send_message(telegram_chat_bot.updater.bot,
+                                                                chat_id=telegram_chat_bot.bot_chat_id,
+                                                                priority=PRIORITY_DRIVERS,
+                                                                text=message_for_drivers,
+                                                                parse_mode=ParseMode.HTML,
+                                                                reply_markup=telegram_chat_bot.generate_order_keyboard(order.get('order_id')),
+                                                                disable_web_page_preview=True)
+        store_group_post(telegram_bot, telegram_chat_bot, order.get('order_id'), message_sent)
+        delivered_ids.append(entry.get('_id'))
+
+    # Update info of the orders, the private offers are waited for (their message IDs withdraw them)
+    telegram_chat_bot.scheduler.wait_sent([offer_sent for *_, order_offers in offers_sent
+                                           for _, offer_sent in order_offers])
+    orders_fields = {}
+    for entry, order, ring, order_offers in offers_sent:
+        # Drivers that couldn't be reached are kept too, so the next ring skips them
+        new_offers = [{'driver_id': driver_id,
+                       'message_id': offer_sent.result().message_id if send_error(offer_sent) is None else 0}
+                      for driver_id, offer_sent in order_offers]
+        orders_fields[entry.get('order_id')] = {'offers': order.get('offers', []) + new_offers, 'dispatch_ring': ring}
+        # The next ring (or the group) gets it if nobody accepts in time
+        delay = telegram_chat_bot.dispatch_offer_timeout if any(offer.get('message_id') for offer in new_offers) else 0
+        telegram_bot.outbox.enqueue(ORDER_DISPATCH, entry.get('order_id'), delay=delay, stage=ring + 1)
+        delivered_ids.append(entry.get('_id'))
+    telegram_bot.orders_manager.set_orders_fields(orders_fields)
+
+    return delivered_ids
+
+
+def store_group_post(telegram_bot: TelegramBot, telegram_chat_bot: TelegramChatBot, order_id: int, message_sent) -> None:
+
+    """Group posts are left to the scheduler (a group takes 20 messages a minute), the message ID is stored
+    once the post is out. A post that went out after the order was taken is deleted again."""
+    def store(future) -> None:
+        # The scheduler has logged a failed send
+        if send_error(future) is not None:
+            return
+        message_id = future.result().message_id
+        try:
+            telegram_bot.orders_manager.set_orders_fields({order_id: {'message_id': message_id}})
+            order = telegram_bot.orders_manager.get_order_info(order_id)
+        except Exception as error:
+            logging.getLogger(__name__).exception('Group post of order %s was not stored: %s', order_id, error)
+            return
+        if order is None or order.get('status') != 'open':
+            telegram_chat_bot.scheduler.delete_message(telegram_chat_bot.updater.bot,
+                                                       chat_id=telegram_chat_bot.bot_chat_id,
+                                                       message_id=message_id)
+    message_sent.add_done_callback(store)
+
+
+def deliver_accepted_orders(telegram_bot: TelegramBot, telegram_chat_bot: TelegramChatBot, entries: list) -> list:
+
+    # USER bot
+    delivered_ids = []
+    messages_sent = []
+    orders = telegram_bot.orders_manager.get_orders_info([entry.get('order_id') for entry in entries])
+    for entry in entries:
+        order = orders.get(entry.get('order_id'))
+        # Archived or collected since, nobody to tell
+        if order is None:
+            delivered_ids.append(entry.get('_id'))
+            continue
+        # One broken order is retried on its own, not with the whole batch
+        try:
             user_id = order.get('user_id')
             user_language = telegram_bot.user_manager.get_user_field(user_id, 'language')
-            order_info = ALL_TEXT.get('accepted_order').get(user_language).replace('{order.from}', order.get('from')).replace('{order.to}', order.get('to')).replace('{order.driver_name}', order.get('driver_name'))
-            telegram_bot.updater.bot.send_message(chat_id=user_id,
-                                                  text=order_info,
-                                                  parse_mode=ParseMode.HTML)
-            telegram_bot.orders_manager.set_order_field(order.get('order_id'), 'user_notification_sent', True)
+            order_info = TEXTS.current.text('accepted_order', user_language, order=order)
+            message_sent = telegram_bot.scheduler.send_message(telegram_bot.updater.bot,
+                                                               chat_id=user_id,
+                                                               priority=PRIORITY_RIDER,
+                                                               text=order_info,
+                                                               parse_mode=ParseMode.HTML)
+            # Offers still open for the other drivers, not waited for
+            telegram_chat_bot.withdraw_order(order)
+        except Exception as error:
+            logging.getLogger(__name__).exception('Accepted order %s was not delivered: %s', entry.get('order_id'), error)
+            continue
+        messages_sent.append((entry, order, message_sent))
+
+    # Only the riders' messages are waited for
+    telegram_bot.scheduler.wait_sent([message_sent for _, _, message_sent in messages_sent])
+    for entry, order, message_sent in messages_sent:
+        if send_error(message_sent) is not None:
+            continue
+        try:
             # Updating orders count
-            current_orders_count = telegram_bot.user_manager.get_user_field(user_id, 'orders_count')
-            telegram_bot.user_manager.set_user_field(user_id, 'orders_count', current_orders_count + 1)
-
-        # DRIVERS CHAT bot
-        # New orders
-        opened_orders = telegram_chat_bot.get_orders('open')
-        for order in opened_orders:
-            order_id = order.get('order_id')
-            message_for_drivers = generate_message_for_drivers(order, mapmd_token)
-            # Message to drivers chat
-            message_sent = telegram_chat_bot.updater.bot.send_message(chat_id=telegram_chat_bot.bot_chat_id,
-                                                                      text=message_for_drivers,
-                                                                      parse_mode=ParseMode.HTML,
-                                                                      reply_markup=reply_markup,
-                                                                      disable_web_page_preview=True)
-            # Update info of the order
-            telegram_bot.orders_manager.set_order_field(order_id, 'message_id', message_sent.message_id)
-            telegram_bot.orders_manager.set_order_field(order_id, 'drivers_notification_sent', True)
-        # Declined orders
-        declined_orders = telegram_chat_bot.get_orders('declined')
-        for order in declined_orders:
-            telegram_chat_bot.updater.bot.delete_message(chat_id=telegram_chat_bot.bot_chat_id,
-                                                         message_id=order.get('message_id'))
-            telegram_bot.orders_manager.set_order_field(order.get('order_id'), 'drivers_notification_declined_sent', True)
+            telegram_bot.user_manager.increment_user_field(order.get('user_id'), 'orders_count')
+        except Exception as error:
+            # The rider has the message, the count is not worth a second one
+            logging.getLogger(__name__).exception('Orders count of %s was not updated: %s', order.get('user_id'), error)
+        delivered_ids.append(entry.get('_id'))
+
+    return delivered_ids
+
+
+def deliver_declined_orders(telegram_bot: TelegramBot, telegram_chat_bot: TelegramChatBot, entries: list) -> list:
+
+    # Left to the scheduler, a message that can't be deleted (already gone) is not retried
+    orders = telegram_bot.orders_manager.get_orders_info([entry.get('order_id') for entry in entries])
+    for entry in entries:
+        telegram_chat_bot.withdraw_order(orders.get(entry.get('order_id'), {}))
+
+    return [entry.get('_id') for entry in entries]
+
+
+def deliver_order_reminders(telegram_bot: TelegramBot, telegram_chat_bot: TelegramChatBot, mapmd_token: str,
+                            repost_interval: float, escalate_after: int, entries: list) -> list:
+
+    # DRIVERS CHAT bot: the group post goes to the bottom again, the admins step in after a few reposts.
+    # Nothing here is waited for, the groups are throttled to 20 messages a minute
+    delivered_ids = []
+    orders = telegram_bot.orders_manager.get_orders_info([entry.get('order_id') for entry in entries])
+    for entry in entries:
+        order = orders.get(entry.get('order_id'))
+        if order is None or order.get('status') != 'open':
+            delivered_ids.append(entry.get('_id'))
+            continue
+        message_for_drivers = generate_message_for_drivers(order, mapmd_token)
+        messages = telegram_chat_bot.repost_order(order, message_for_drivers)
+        # Still offered to the nearest drivers when there are no messages, not in the group yet
+        if messages is not None:
+            store_group_post(telegram_bot, telegram_chat_bot, order.get('order_id'), messages[1])
+        if entry.get('stage') >= escalate_after:
+            telegram_chat_bot.escalate_order(order, message_for_drivers, entry.get('stage') * repost_interval)
+        delivered_ids.append(entry.get('_id'))
+
+    return delivered_ids
+
+
+def deliver_expired_orders(telegram_bot: TelegramBot, telegram_chat_bot: TelegramChatBot, entries: list) -> list:
+
+    # USER bot: the rider is told, the drivers chat and the offers forget the order
+    delivered_ids = []
+    messages_sent = []
+    orders = telegram_bot.orders_manager.get_orders_info([entry.get('order_id') for entry in entries])
+    for entry in entries:
+        order = orders.get(entry.get('order_id'))
+        # Archived or collected since, nobody to tell
+        if order is None:
+            delivered_ids.append(entry.get('_id'))
+            continue
+        # One broken order is retried on its own, not with the whole batch
+        try:
+            user_language = telegram_bot.user_manager.get_user_field(order.get('user_id'), 'language')
+            order_info = TEXTS.current.text('expired_order', user_language, order=order)
+            message_sent = telegram_bot.scheduler.send_message(telegram_bot.updater.bot,
+                                                               chat_id=order.get('user_id'),
+                                                               priority=PRIORITY_RIDER,
+                                                               text=order_info,
+                                                               parse_mode=ParseMode.HTML)
+            # Not waited for
+            telegram_chat_bot.withdraw_order(order)
+        except Exception as error:
+            logging.getLogger(__name__).exception('Expired order %s was not delivered: %s', entry.get('order_id'), error)
+            continue
+        messages_sent.append((entry, message_sent))
+
+    # Only the riders' messages are waited for
+    telegram_bot.scheduler.wait_sent([message_sent for _, message_sent in messages_sent])
+    for entry, message_sent in messages_sent:
+        if send_error(message_sent) is None:
+            delivered_ids.append(entry.get('_id'))
+
+    return delivered_ids
+
+
+def fire_order_repost(telegram_bot: TelegramBot, repost_interval: float, repost_limit: int, timer: dict) -> float | None:
+
+    # Accepted and declined orders have their timers cancelled, the reminder checks the status again anyway
+    reposts = timer.get('fired') + 1
+    telegram_bot.outbox.enqueue(ORDER_REMINDER, timer.get('key'), stage=reposts)
+    return repost_interval if reposts < repost_limit else None
+
+
+def collect_garbage(telegram_bot: TelegramBot, abandoned_after: float, interval: float) -> float:
+
+    updated_before = datetime.utcnow() - timedelta(seconds=abandoned_after)
+    order_ids = telegram_bot.orders_manager.remove_abandoned_orders(updated_before)
+    reset_count = telegram_bot.user_manager.reset_stale_steps(updated_before, order_ids)
+    if order_ids or reset_count:
+        logging.getLogger(__name__).info('Removed %d abandoned orders, reset %d stale steps', len(order_ids), reset_count)
+    return interval
+
+
+def archive_orders(archiver: OrderArchiver, max_batches: int, interval: float) -> float:
+
+    # A backlog larger than max_batches is worked off by the next runs, sooner
+    if archiver.run(max_batches) >= max_batches * archiver.batch_size:
+        return 0
+    return interval
 
 
 def generate_message_for_drivers(order: dict, mapmd_token: str) -> str:
 
+    # Everything the rider typed is escaped, the message is sent with parse_mode HTML
     from_message = order.get('from')
     to_message = order.get('to')
 
@@ -88,27 +489,30 @@ def generate_message_for_drivers(order: dict, mapmd_token: str) -> str:
 
     # Checking if we got addresses from geolocation
     if from_geo:
-        from_message_modified = from_message.replace('Chișinău,', '').replace('Chisinau,', '').strip()
-        order_from = f'<a href="https://yandex.ru/maps/?pt={from_location}&z=18&l=map">{from_message_modified}</a>'
+        from_message_modified = html.escape(from_message.replace('Chișinău,', '').replace('Chisinau,', '').strip())
+        order_from = f'<a href="https://yandex.ru/maps/?pt={html.escape(from_location)}&z=18&l=map">{from_message_modified}</a>'
     else:
-        order_from = f'<a href="https://yandex.ru/maps/?l=map&text={convert_address_url(from_message)}">{from_message}</a>'
+        order_from = f'<a href="https://yandex.ru/maps/?l=map&text={convert_address_url(from_message)}">{html.escape(from_message)}</a>'
 
     if to_geo:
-        to_message_modified = to_message.replace('Chișinău,', '').replace('Chisinau,', '').strip()
-        order_to = f'<a href="https://yandex.ru/maps/?pt={to_location}&z=18&l=map">{to_message_modified}</a>'
+        to_message_modified = html.escape(to_message.replace('Chișinău,', '').replace('Chisinau,', '').strip())
+        order_to = f'<a href="https://yandex.ru/maps/?pt={html.escape(to_location)}&z=18&l=map">{to_message_modified}</a>'
     else:
-        order_to = f'<a href="https://yandex.ru/maps/?l=map&text={convert_address_url(to_message)}">{to_message}</a>'
+        order_to = f'<a href="https://yandex.ru/maps/?l=map&text={convert_address_url(to_message)}">{html.escape(to_message)}</a>'
 
     # Route
     message = f'‼️ <b>Новый заказ</b> ‼️ №{order.get("order_id")}\n\n' \
               f'{order_from} ➡️ {order_to}\n' \
-              f'📞 Связь: {order.get("contacts")}\n'
+              f'📞 Связь: {html.escape(str(order.get("contacts")))}\n'
 
     if order.get("user_name"):
-        message += f'💬 @{order.get("user_name")}\n'
+        message += f'💬 @{html.escape(order.get("user_name"))}\n'
+
+    if order.get("fare_estimate"):
+        message += f'💰 ~{order.get("fare_estimate")} лей ({order.get("distance_km")} км)\n'
 
     if order.get("comment"):
-        message += f'🕓 Комментарий: <i>{order.get("comment")}</i>'
+        message += f'🕓 Комментарий: <i>{html.escape(order.get("comment"))}</i>'
 
     return message
 
@@ -121,56 +525,5 @@ def convert_address_url(address: str) -> str:
     return urllib.parse.quote(address)
 
 
-def generate_route_url(from_message: str, to_message: str, from_location: str, to_location: str, token: str) -> str:
-
-    if len(from_location) == 0:
-        from_structure = get_address_structure(from_message, token)
-        from_lat = from_structure.get('latitude')
-        from_lon = from_structure.get('longitude')
-    else:
-        from_structure = from_location.split(',')
-        from_lat = from_structure[1]
-        from_lon = from_structure[0]
-
-    if len(to_location) == 0:
-        to_structure = get_address_structure(to_message, token)
-        to_lat = to_structure.get('latitude')
-        to_lon = to_structure.get('longitude')
-    else:
-        to_structure = to_location.split(',')
-        to_lat = to_structure[1]
-        to_lon = to_structure[0]
-
-    return f'https://yandex.ru/maps/?rtext={from_lat},{from_lon}~{to_lat},{to_lon}&rtt=auto'
-
-
-def get_address_structure(address: str, token: str) -> dict:
-
-    url = f'https://map.md/api/companies/webmap/search?q={address}'
-    headers = {'Content-Type': 'application/json'}
-    request = requests.get(url=url,
-                           auth=HTTPBasicAuth(token, ''),
-                           headers=headers)
-
-    if request.status_code == 200:
-        request_json = request.json()
-        try:
-            centroid = request_json.get('selected').get('centroid')
-            return {
-                'latitude': centroid.get('lat'),
-                'longitude': centroid.get('lon')
-            }
-        except:
-            return {
-                'latitude': 0,
-                'longitude': 0
-            }
-    else:
-        return {
-            'latitude': 0,
-            'longitude': 0
-        }
-
-
 if __name__ == '__main__':
     main()
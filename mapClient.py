@@ -0,0 +1,161 @@
+import logging
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+
+from metrics import REGISTRY
+
+MAPMD_URL = 'https://map.md/api/companies/webmap'
+
+MAPMD_LATENCY = REGISTRY.histogram('mapmd_request_seconds', 'map.md request latency', ('path',))
+MAPMD_RESPONSES = REGISTRY.counter('mapmd_responses_total', 'map.md responses by status (or error)', ('path', 'status'))
+
+
+class CircuitBreaker:
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+
+    def allow(self) -> bool:
+
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            # Half-open: one trial request after the timeout
+            if time.monotonic() - self.opened_at >= self.reset_timeout and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self) -> None:
+
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class InFlightRequest:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+
+class MapClient:
+
+    def __init__(self, token: str, base_url: str = MAPMD_URL, timeout: float = 3.0, retries: int = 2,
+                 backoff: float = 0.2, failure_threshold: int = 5, reset_timeout: float = 30.0, pool_size: int = 10):
+
+        self.base_url = base_url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+        self.logger = logging.getLogger(__name__)
+
+        # Keep-alive connections shared by all the dispatcher threads
+        self.session = requests.Session()
+        self.session.auth = HTTPBasicAuth(token, '')
+        self.session.headers.update({'Content-Type': 'application/json'})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
+        # Identical lookups running at the same time share one request
+        self.in_flight_lock = threading.Lock()
+        self.in_flight = {}
+
+    def near(self, latitude: str, longitude: str) -> dict | None:
+        return self.get_json('near', {'lat': latitude, 'lon': longitude})
+
+    def search(self, address: str) -> dict | None:
+        return self.get_json('search', {'q': address})
+
+    def get_json(self, path: str, params: dict) -> dict | None:
+
+        """Returns the decoded response or None, if the upstream failed or the circuit is open."""
+        key = (path, tuple(sorted(params.items())))
+        with self.in_flight_lock:
+            request = self.in_flight.get(key)
+            leader = request is None
+            if leader:
+                request = InFlightRequest()
+                self.in_flight[key] = request
+
+        if not leader:
+            request.done.wait(self.timeout)
+            return request.result
+
+        try:
+            request.result = self.request_json(path, params)
+        finally:
+            with self.in_flight_lock:
+                self.in_flight.pop(key, None)
+            request.done.set()
+        return request.result
+
+    def request_json(self, path: str, params: dict) -> dict | None:
+
+        if not self.breaker.allow():
+            MAPMD_RESPONSES.labels(path, 'circuit_open').inc()
+            return None
+
+        deadline = time.monotonic() + self.timeout
+        for attempt in range(self.retries + 1):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            started = time.monotonic()
+            try:
+                response = self.session.get(url=f'{self.base_url}/{path}', params=params, timeout=remaining)
+            except requests.RequestException as error:
+                MAPMD_LATENCY.labels(path).observe(time.monotonic() - started)
+                MAPMD_RESPONSES.labels(path, type(error).__name__).inc()
+                self.logger.warning('map.md %s failed: %s', path, error)
+            else:
+                MAPMD_LATENCY.labels(path).observe(time.monotonic() - started)
+                MAPMD_RESPONSES.labels(path, str(response.status_code)).inc()
+                if response.status_code == 200:
+                    self.breaker.record_success()
+                    try:
+                        return response.json()
+                    except ValueError:
+                        return None
+                if response.status_code < 500:
+                    # The request itself is wrong, retrying won't help
+                    self.breaker.record_success()
+                    return None
+
+            # Exponential backoff with full jitter, never past the deadline
+            delay = random.uniform(0, self.backoff * 2 ** attempt)
+            if attempt < self.retries and time.monotonic() + delay < deadline:
+                time.sleep(delay)
+
+        self.breaker.record_failure()
+        return None
+
+
+if __name__ == '__main__':
+    print('Only for import!')
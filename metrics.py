@@ -0,0 +1,304 @@
+import bisect
+import cProfile
+import io
+import logging
+import pstats
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Database commands made by one update
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34)
+
+
+class Histogram:
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        # The last bucket is +Inf
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.total += value
+            self.count += 1
+
+    def quantile(self, q: float) -> float:
+
+        # Upper bound of the bucket the quantile falls into
+        with self.lock:
+            if self.count == 0:
+                return 0.0
+            rank = q * self.count
+            seen = 0
+            for index, bucket_count in enumerate(self.counts):
+                seen += bucket_count
+                if seen >= rank:
+                    return self.buckets[index] if index < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def snapshot(self) -> dict:
+
+        with self.lock:
+            return {
+                'buckets': dict(zip(self.buckets + (float('inf'),), self.counts)),
+                'sum': self.total,
+                'count': self.count
+            }
+
+
+class Counter:
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        with self.lock:
+            self.value += amount
+
+    def snapshot(self) -> float:
+        with self.lock:
+            return self.value
+
+
+class MetricFamily:
+
+    def __init__(self, name: str, help_text: str, kind: str, label_names: tuple, buckets: tuple = None):
+
+        # One metric per combination of label values, created on first use
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self.label_names = label_names
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.children = {}
+
+    def labels(self, *label_values) -> Histogram | Counter:
+
+        child = self.children.get(label_values)
+        if child is None:
+            with self.lock:
+                child = self.children.get(label_values)
+                if child is None:
+                    child = Histogram(self.buckets) if self.kind == 'histogram' else Counter()
+                    self.children[label_values] = child
+        return child
+
+    def render(self) -> list:
+
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.kind}']
+        for label_values, child in list(self.children.items()):
+            labels = [f'{name}="{escape_label(str(value))}"' for name, value in zip(self.label_names, label_values)]
+            if self.kind == 'counter':
+                lines.append(f'{self.name}{format_labels(labels)} {child.snapshot()}')
+                continue
+            snapshot = child.snapshot()
+            # Prometheus buckets are cumulative
+            cumulative = 0
+            for bucket, bucket_count in snapshot.get('buckets').items():
+                cumulative += bucket_count
+                bound = '+Inf' if bucket == float('inf') else repr(bucket)
+                bucket_labels = labels + [f'le="{bound}"']
+                lines.append(f'{self.name}_bucket{format_labels(bucket_labels)} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(labels)} {snapshot.get("sum")}')
+            lines.append(f'{self.name}_count{format_labels(labels)} {snapshot.get("count")}')
+        return lines
+
+
+def escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels: list) -> str:
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.families = {}
+
+    def counter(self, name: str, help_text: str, label_names: tuple = ()) -> MetricFamily:
+        return self.family(name, help_text, 'counter', label_names)
+
+    def histogram(self, name: str, help_text: str, label_names: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> MetricFamily:
+        return self.family(name, help_text, 'histogram', label_names, buckets)
+
+    def family(self, name: str, help_text: str, kind: str, label_names: tuple, buckets: tuple = None) -> MetricFamily:
+
+        # Modules declare their metrics at import, the same name always returns the same family
+        with self.lock:
+            family = self.families.get(name)
+            if family is None:
+                family = MetricFamily(name, help_text, kind, label_names, buckets)
+                self.families[name] = family
+            return family
+
+    def render(self) -> str:
+
+        # Prometheus text exposition format
+        lines = []
+        for family in list(self.families.values()):
+            lines += family.render()
+        return '\n'.join(lines) + '\n'
+
+
+# Every metric of the process, served by MetricsServer
+REGISTRY = MetricsRegistry()
+
+
+class SlowUpdateProfiler:
+
+    def __init__(self, threshold: float, sample_rate: float = 0.01, top: int = 25):
+
+        # A sample of the updates is profiled, the profile is logged only when the update turns out slow
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.top = top
+
+        self.logger = logging.getLogger(__name__)
+        # Only one profiler can be active in the process
+        self.lock = threading.Lock()
+
+    def start(self) -> cProfile.Profile | None:
+
+        if random.random() >= self.sample_rate or not self.lock.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiling tool is active
+            self.lock.release()
+            return None
+        return profile
+
+    def finish(self, profile: cProfile.Profile, handler_name: str, elapsed: float) -> None:
+
+        profile.disable()
+        self.lock.release()
+        if elapsed < self.threshold:
+            return
+        output = io.StringIO()
+        pstats.Stats(profile, stream=output).sort_stats('cumulative').print_stats(self.top)
+        self.logger.warning('Slow update in %s (%.3fs):\n%s', handler_name, elapsed, output.getvalue())
+
+
+class HandlerMetrics:
+
+    def __init__(self, registry: MetricsRegistry):
+
+        self.latency = registry.histogram('handler_seconds', 'Update handler latency', ('handler',))
+        self.round_trips = registry.histogram('handler_mongo_round_trips', 'MongoDB commands per update',
+                                              ('handler',), COUNT_BUCKETS)
+        # Opt-in, see SlowUpdateProfiler
+        self.profiler = None
+        # Handlers running in the current thread: [handler name, round trips], the database listener counts into them
+        self.local = threading.local()
+
+    def track(self, handler_name: str) -> 'HandlerTimer':
+        return HandlerTimer(self, handler_name)
+
+    def get_stack(self) -> list:
+        try:
+            return self.local.stack
+        except AttributeError:
+            self.local.stack = []
+            return self.local.stack
+
+
+class HandlerTimer:
+
+    # A plain context manager, it runs for every update (cheaper than a generator based one)
+    __slots__ = ('handler_metrics', 'handler_name', 'frame', 'profile', 'started')
+
+    def __init__(self, handler_metrics: HandlerMetrics, handler_name: str):
+        self.handler_metrics = handler_metrics
+        self.handler_name = handler_name
+
+    def __enter__(self) -> None:
+        self.frame = [self.handler_name, 0]
+        self.handler_metrics.get_stack().append(self.frame)
+        profiler = self.handler_metrics.profiler
+        self.profile = profiler.start() if profiler is not None else None
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info) -> None:
+        elapsed = time.perf_counter() - self.started
+        handler_metrics = self.handler_metrics
+        handler_metrics.get_stack().pop()
+        handler_metrics.latency.labels(self.handler_name).observe(elapsed)
+        handler_metrics.round_trips.labels(self.handler_name).observe(self.frame[1])
+        if self.profile is not None:
+            handler_metrics.profiler.finish(self.profile, self.handler_name, elapsed)
+
+
+HANDLERS = HandlerMetrics(REGISTRY)
+
+
+class MetricsServer:
+
+    def __init__(self, listen: str, port: int, registry: MetricsRegistry = REGISTRY):
+
+        self.listen = listen
+        self.port = port
+        self.registry = registry
+
+        self.logger = logging.getLogger(__name__)
+        self.server = None
+
+    def start(self) -> None:
+
+        self.server = ThreadingHTTPServer((self.listen, self.port), self.request_handler())
+        self.server.daemon_threads = True
+        thread = threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True)
+        thread.start()
+
+        print(f'METRICS listening on {self.listen}:{self.server.server_address[1]}')
+
+    def stop(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
+
+    def request_handler(self):
+
+        metrics_server = self
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self) -> None:
+                if self.path != '/metrics':
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                body = metrics_server.registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args) -> None:
+                metrics_server.logger.debug(format, *args)
+
+        return MetricsRequestHandler
+
+
+if __name__ == '__main__':
+    print('Only for import!')
@@ -0,0 +1,165 @@
+import argparse
+import threading
+import time
+import warnings
+
+from config import SETTINGS
+from driverBench import percentile
+from loadBench import COMMAND_NAMES
+from orderNotifier import OrderNotifier
+from outbox import Outbox, OutboxDispatcher, OUTBOX_CHANGES_PIPELINE, ORDER_ACCEPTED
+
+
+class CountingCollection:
+
+    def __init__(self, collection, counter: list):
+
+        # Commands sent to the collection, added up in counter[0] (a list, shared by every collection)
+        self.collection = collection
+        self.counter = counter
+
+    def __getattr__(self, name: str):
+
+        attribute = getattr(self.collection, name)
+        if name != 'bulk_write' and name not in COMMAND_NAMES:
+            return attribute
+
+        def command(*args, **kwargs):
+            self.counter[0] += 1
+            return attribute(*args, **kwargs)
+
+        return command
+
+
+class Workload:
+
+    def __init__(self, db_orders, db_outbox):
+
+        # Orders the rider bot accepts, the way OrdersManager writes them
+        self.db_orders = db_orders
+        self.outbox = Outbox(db_outbox)
+        self.lock = threading.Lock()
+        # Order ID -> perf_counter() of the write, until it is delivered
+        self.written_at = {}
+        self.latencies = []
+
+    def accept(self, order_id: int) -> None:
+
+        with self.lock:
+            self.written_at[order_id] = time.perf_counter()
+        self.db_orders.insert_one({'order_id': order_id, 'user_id': order_id, 'status': 'accepted',
+                                   'user_notification_sent': False})
+        self.outbox.enqueue(ORDER_ACCEPTED, order_id)
+
+    def delivered(self, order_id: int) -> None:
+        with self.lock:
+            self.latencies.append(time.perf_counter() - self.written_at.pop(order_id))
+
+
+def run_busy_loop(workload: Workload, stop_event: threading.Event) -> None:
+
+    # The main loop before the notifier: three queries back to back, no sleep
+    db_orders = workload.db_orders
+    while not stop_event.is_set():
+        for order in db_orders.find({'status': 'accepted', 'user_notification_sent': False}):
+            workload.delivered(order.get('order_id'))
+            db_orders.update_one({'order_id': order.get('order_id')}, {'$set': {'user_notification_sent': True}})
+        list(db_orders.find({'status': 'open', 'drivers_notification_sent': False}))
+        list(db_orders.find({'status': 'declined', 'drivers_notification_declined_sent': False}))
+
+
+def deliver(workload: Workload, entries: list) -> list:
+    for entry in entries:
+        workload.delivered(entry.get('order_id'))
+    return [entry.get('_id') for entry in entries]
+
+
+def measure(mode: str, args, database, counter: list) -> dict:
+
+    """Idle CPU and query rate, then the latency of orders accepted one by one (args.gap seconds apart, so
+    a polling notifier has backed off in between)."""
+    workload = Workload(CountingCollection(database['taxi_orders'], counter),
+                        CountingCollection(database['taxi_outbox'], counter))
+    stop_event = threading.Event()
+    if mode == 'busy-loop':
+        thread = threading.Thread(target=run_busy_loop, args=(workload, stop_event), daemon=True)
+    else:
+        settings = SETTINGS.current
+        notifier = OrderNotifier(workload.outbox.db_outbox, OUTBOX_CHANGES_PIPELINE,
+                                 settings.get('notifier_poll_min_interval', 0.5),
+                                 settings.get('notifier_poll_max_interval', 5.0),
+                                 bool(args.mongodb) and settings.get('notifier_change_streams', True))
+        dispatcher = OutboxDispatcher(workload.outbox, {ORDER_ACCEPTED: lambda entries: deliver(workload, entries)})
+        thread = threading.Thread(target=notifier.run, args=(dispatcher.dispatch,), daemon=True)
+        stop_event = notifier.stop_event
+    thread.start()
+    time.sleep(1)
+
+    # Nothing happens
+    commands, cpu, started = counter[0], time.process_time(), time.monotonic()
+    time.sleep(args.idle)
+    idle_elapsed = time.monotonic() - started
+    result = {'idle_cpu': (time.process_time() - cpu) / idle_elapsed,
+              'idle_commands': (counter[0] - commands) / idle_elapsed}
+
+    # Orders accepted one by one
+    commands, cpu, started = counter[0], time.process_time(), time.monotonic()
+    for order_id in range(args.orders):
+        workload.accept(order_id)
+        time.sleep(args.gap)
+    deadline = time.monotonic() + 30
+    while workload.written_at and time.monotonic() < deadline:
+        time.sleep(0.01)
+    busy_elapsed = time.monotonic() - started
+    result.update(busy_cpu=(time.process_time() - cpu) / busy_elapsed,
+                  busy_commands=(counter[0] - commands) / busy_elapsed,
+                  latencies=sorted(latency * 1000 for latency in workload.latencies),
+                  lost=len(workload.written_at))
+
+    stop_event.set()
+    thread.join(10)
+    return result
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description='Notification loop before and after OrderNotifier: idle CPU and '
+                                                 'MongoDB commands, accepted order -> notification latency.')
+    parser.add_argument('--mongodb', default='', help='MongoDB connection string (scratch database), mongomock when '
+                                                      'empty (no change streams, the notifier polls)')
+    parser.add_argument('--idle', type=float, default=10, help='seconds without any order')
+    parser.add_argument('--orders', type=int, default=20)
+    parser.add_argument('--gap', type=float, default=1.0, help='seconds between two accepted orders')
+    parser.add_argument('--modes', default='busy-loop,notifier')
+    args = parser.parse_args()
+    # mongomock warns about the legacy calls of its own
+    warnings.simplefilter('ignore', DeprecationWarning)
+
+    settings = SETTINGS.current
+    print(f'{args.idle:.0f}s idle, then {args.orders} orders accepted {args.gap}s apart, '
+          f'{"MongoDB" if args.mongodb else "mongomock"}, notifier polling '
+          f'{settings.get("notifier_poll_min_interval", 0.5)}..{settings.get("notifier_poll_max_interval", 5.0)}s'
+          f'{" (change streams when available)" if args.mongodb else ""}')
+    print(f'{"mode":<12}{"idle CPU":>10}{"idle cmd/s":>12}{"busy CPU":>10}{"busy cmd/s":>12}'
+          f'{"p50 ms":>10}{"p99 ms":>10}{"max ms":>10}')
+    for mode in args.modes.split(','):
+        if args.mongodb:
+            from pymongo import MongoClient
+            client = MongoClient(args.mongodb)
+            client.drop_database('taxi_bot_bench')
+        else:
+            import mongomock
+            client = mongomock.MongoClient()
+        counter = [0]
+        result = measure(mode, args, client['taxi_bot_bench'], counter)
+        latencies = result.get('latencies') or [0.0]
+        lost = f'  {result.get("lost")} not delivered' if result.get('lost') else ''
+        print(f'{mode:<12}{result.get("idle_cpu"):>10.0%}{result.get("idle_commands"):>12.1f}'
+              f'{result.get("busy_cpu"):>10.0%}{result.get("busy_commands"):>12.1f}'
+              f'{percentile(latencies, 0.5):>10.1f}{percentile(latencies, 0.99):>10.1f}{latencies[-1]:>10.1f}{lost}')
+        if args.mongodb:
+            client.drop_database('taxi_bot_bench')
+
+
+if __name__ == '__main__':
+    main()
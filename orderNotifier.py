@@ -0,0 +1,80 @@
+import logging
+import threading
+import time
+from pymongo.errors import OperationFailure, PyMongoError
+
+
+class OrderNotifier:
+
+    def __init__(self, collection, pipeline: list, poll_min_interval: float = 0.5, poll_max_interval: float = 5.0,
+                 use_change_streams: bool = True):
+
+        # Changes of the collection matching the pipeline wake the notifier up
+        self.collection = collection
+        self.pipeline = pipeline
+        self.use_change_streams = use_change_streams
+        self.poll_min_interval = poll_min_interval
+        self.poll_max_interval = poll_max_interval
+
+        self.logger = logging.getLogger(__name__)
+        self.stop_event = threading.Event()
+        self.stream = None
+
+    def run(self, process_orders) -> None:
+
+        """Calls process_orders() every time the watched collection changes and at least every
+        poll_max_interval (for delayed work). process_orders() must return the number of items it
+        has handled. Uses MongoDB change streams and falls back to polling with adaptive backoff
+        when they are not available (standalone mongod, mocks).
+        """
+        if not self.use_change_streams:
+            self.poll_orders(process_orders)
+            return
+
+        while not self.stop_event.is_set():
+            try:
+                self.watch_orders(process_orders)
+            except OperationFailure as error:
+                self.logger.warning('Change streams are not available (%s), falling back to polling', error)
+                self.poll_orders(process_orders)
+            except PyMongoError as error:
+                if self.stop_event.is_set():
+                    break
+                self.logger.warning('Change stream failed (%s), polling until it is reopened', error)
+                self.poll_orders(process_orders, self.poll_max_interval * 10)
+
+    def watch_orders(self, process_orders) -> None:
+
+        with self.collection.watch(self.pipeline) as stream:
+            self.stream = stream
+            # Catching up with the changes made before the stream was opened
+            process_orders()
+            last_pass = time.monotonic()
+            while not self.stop_event.is_set() and stream.alive:
+                if stream.try_next() is not None or time.monotonic() - last_pass >= self.poll_max_interval:
+                    process_orders()
+                    last_pass = time.monotonic()
+
+    def poll_orders(self, process_orders, duration: float = None) -> None:
+
+        interval = self.poll_min_interval
+        elapsed = 0.0
+        while not self.stop_event.is_set():
+            if process_orders() > 0:
+                interval = self.poll_min_interval
+            else:
+                interval = min(interval * 2, self.poll_max_interval)
+            self.stop_event.wait(interval)
+            elapsed += interval
+            if duration is not None and elapsed >= duration:
+                return
+
+    def stop(self) -> None:
+
+        self.stop_event.set()
+        if self.stream is not None:
+            self.stream.close()
+
+
+if __name__ == '__main__':
+    print('Only for import!')
@@ -0,0 +1,182 @@
+import logging
+import time
+import uuid
+from datetime import datetime, timedelta
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from metrics import REGISTRY
+
+# Entry kinds written by the order state transitions
+NEW_ORDER = 'new_order'
+ORDER_ACCEPTED = 'order_accepted'
+ORDER_DECLINED = 'order_declined'
+# Next ring of drivers for an order nobody has accepted yet
+ORDER_DISPATCH = 'order_dispatch'
+# Written by the timers of the open orders: repost (and escalation) and expiry
+ORDER_REMINDER = 'order_reminder'
+ORDER_EXPIRED = 'order_expired'
+
+# Only inserts into the outbox wake the dispatcher up
+OUTBOX_CHANGES_PIPELINE = [
+    {'$match': {'operationType': 'insert'}}
+]
+
+# From the order's status change (or the time a delayed entry was due) to its messages being sent
+NOTIFICATION_LAG = REGISTRY.histogram('notification_lag_seconds', 'Order status change to Telegram message',
+                                      ('kind',), (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0))
+DISPATCH_LATENCY = REGISTRY.histogram('outbox_dispatch_seconds', 'Notifier pass over the due outbox entries')
+
+
+class Outbox:
+
+    def __init__(self, db_outbox, lease_time: float = 30.0, retry_delay: float = 5.0, max_attempts: int = 10):
+
+        self.db_outbox = db_outbox
+        self.lease_time = lease_time
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+
+    def enqueue(self, kind: str, order_id: int, session=None, delay: float = 0, stage: int = None) -> None:
+
+        # The idempotency key makes repeated transitions produce a single notification
+        now = datetime.utcnow()
+        entry = {
+            '_id': f'{kind}:{order_id}' if stage is None else f'{kind}:{order_id}:{stage}',
+            'kind': kind,
+            'order_id': order_id,
+            'state': 'pending',
+            'attempts': 0,
+            'available_at': now + timedelta(seconds=delay),
+            'due_at': now + timedelta(seconds=delay),
+            'created_at': now
+        }
+        if stage is not None:
+            entry['stage'] = stage
+        try:
+            self.db_outbox.insert_one(entry, session=session)
+        except DuplicateKeyError:
+            pass
+
+    def enqueue_many(self, kind: str, order_ids: list, session=None) -> list:
+
+        # Returns the IDs of the entries
+        if not order_ids:
+            return []
+        now = datetime.utcnow()
+        entries = [{'_id': f'{kind}:{order_id}', 'kind': kind, 'order_id': order_id, 'state': 'pending',
+                    'attempts': 0, 'available_at': now, 'due_at': now, 'created_at': now} for order_id in order_ids]
+        try:
+            self.db_outbox.insert_many(entries, ordered=False, session=session)
+        except BulkWriteError as error:
+            # Entries that already exist are skipped, anything else is a real failure
+            if any(write_error.get('code') != 11000 for write_error in error.details.get('writeErrors')):
+                raise
+        return [entry.get('_id') for entry in entries]
+
+    def claim(self, limit: int) -> list:
+
+        """Leases up to `limit` due entries: they stay invisible to other dispatchers until
+        the lease expires or they are acked."""
+        now = datetime.utcnow()
+        due = {'state': 'pending', 'available_at': {'$lte': now}}
+        candidates = self.db_outbox.find(due, {'_id': True}).sort('available_at', 1).limit(limit)
+        return self.lease(due, [candidate.get('_id') for candidate in candidates])
+
+    def claim_entries(self, entry_ids: list) -> list:
+        # The given entries, if they are due and nobody has claimed them yet
+        return self.lease({'state': 'pending', 'available_at': {'$lte': datetime.utcnow()}}, entry_ids)
+
+    def lease(self, due: dict, entry_ids: list) -> list:
+
+        if not entry_ids:
+            return []
+        now = datetime.utcnow()
+        lease_token = uuid.uuid4().hex
+        self.db_outbox.update_many(dict(due, _id={'$in': entry_ids}),
+                                   {'$set': {'available_at': now + timedelta(seconds=self.lease_time),
+                                             'lease_token': lease_token},
+                                    '$inc': {'attempts': 1}})
+        # Entries taken by another dispatcher in between are not ours
+        return list(self.db_outbox.find({'lease_token': lease_token}))
+
+    def ack(self, entry_ids: list) -> None:
+
+        if entry_ids:
+            self.db_outbox.update_many({'_id': {'$in': entry_ids}},
+                                       {'$set': {'state': 'sent', 'sent_at': datetime.utcnow()},
+                                        '$unset': {'lease_token': ''}})
+
+    def retry(self, entries: list) -> None:
+
+        # Backoff grows with the attempts, entries that keep failing are parked
+        for entry in entries:
+            if entry.get('attempts') >= self.max_attempts:
+                value_to_update = {'$set': {'state': 'failed'}, '$unset': {'lease_token': ''}}
+            else:
+                delay = self.retry_delay * 2 ** (entry.get('attempts') - 1)
+                value_to_update = {'$set': {'available_at': datetime.utcnow() + timedelta(seconds=delay)},
+                                   '$unset': {'lease_token': ''}}
+            self.db_outbox.update_one({'_id': entry.get('_id'), 'lease_token': entry.get('lease_token')},
+                                      value_to_update)
+
+
+class OutboxDispatcher:
+
+    def __init__(self, outbox: Outbox, handlers: dict, batch_size: int = 50):
+
+        # Kind -> handler(entries) returning the IDs of the entries that were delivered
+        self.outbox = outbox
+        self.handlers = handlers
+        self.batch_size = batch_size
+
+        self.logger = logging.getLogger(__name__)
+
+    def dispatch(self) -> int:
+
+        processed = 0
+        started = time.monotonic()
+        while True:
+            entries = self.outbox.claim(self.batch_size)
+            processed += self.dispatch_entries(entries)
+            if len(entries) < self.batch_size:
+                DISPATCH_LATENCY.labels().observe(time.monotonic() - started)
+                return processed
+
+    def dispatch_now(self, entry_ids: list) -> int:
+        # Entries just written, delivered by the caller instead of the next notifier pass
+        return self.dispatch_entries(self.outbox.claim_entries(entry_ids))
+
+    def dispatch_entries(self, entries: list) -> int:
+
+        entries_by_kind = {}
+        for entry in entries:
+            entries_by_kind.setdefault(entry.get('kind'), []).append(entry)
+
+        delivered_ids = []
+        failed_entries = []
+        for kind, kind_entries in entries_by_kind.items():
+            try:
+                kind_delivered_ids = set(self.handlers[kind](kind_entries))
+            except Exception as error:
+                self.logger.exception('Outbox handler %s failed: %s', kind, error)
+                kind_delivered_ids = set()
+            for entry in kind_entries:
+                if entry.get('_id') in kind_delivered_ids:
+                    delivered_ids.append(entry.get('_id'))
+                else:
+                    failed_entries.append(entry)
+
+        self.outbox.ack(delivered_ids)
+        self.outbox.retry(failed_entries)
+
+        now = datetime.utcnow()
+        delivered = set(delivered_ids)
+        for entry in entries:
+            if entry.get('_id') in delivered:
+                due_at = entry.get('due_at') or entry.get('created_at')
+                NOTIFICATION_LAG.labels(entry.get('kind')).observe((now - due_at).total_seconds())
+        return len(entries)
+
+
+if __name__ == '__main__':
+    print('Only for import!')
@@ -0,0 +1,261 @@
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor, wait
+from telegram.error import RetryAfter
+
+from metrics import REGISTRY
+
+# Lower value is sent first
+PRIORITY_RIDER = 0
+PRIORITY_DRIVERS = 1
+PRIORITY_ADMIN = 2
+
+SEND_WAIT = REGISTRY.histogram('telegram_send_wait_seconds', 'Time queued before the Bot API call (flood limits)',
+                               ('priority',))
+SEND_LATENCY = REGISTRY.histogram('telegram_send_seconds', 'Bot API call latency', ('method', 'result'))
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, capacity: float):
+
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def ready_in(self, now: float) -> float:
+        self.refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        self.refill(now)
+        self.tokens -= 1
+
+
+class OutboundJob:
+
+    def __init__(self, priority: int, sequence: int, bot, method: str, chat_id, kwargs: dict):
+
+        self.priority = priority
+        self.sequence = sequence
+        self.bot = bot
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.future = Future()
+        self.attempts = 0
+        self.submitted_at = time.monotonic()
+
+
+class MessageScheduler:
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, group_rate: float = 20 / 60,
+                 workers: int = 4, max_retries: int = 5, send_timeout: float = 30):
+
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        # Longest wait for a batch of sends, see wait_sent()
+        self.send_timeout = send_timeout
+
+        self.logger = logging.getLogger(__name__)
+        self.condition = threading.Condition()
+        self.sequence = itertools.count()
+        self.running = False
+
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}
+        # Every chat has its own FIFO queue and at most one request in flight
+        self.chat_queues = {}
+        self.busy_chats = set()
+        self.blocked_until = {}
+
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='send')
+
+    def start(self) -> 'MessageScheduler':
+
+        self.running = True
+        thread = threading.Thread(target=self.schedule_loop, name='send-scheduler', daemon=True)
+        thread.start()
+        return self
+
+    def stop(self) -> None:
+
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.executor.shutdown(wait=True)
+
+    def send_message(self, bot, chat_id, priority: int = PRIORITY_RIDER, **kwargs) -> Future:
+        return self.submit(bot, 'send_message', chat_id, priority, kwargs)
+
+    def delete_message(self, bot, chat_id, message_id: int, priority: int = PRIORITY_DRIVERS) -> Future:
+        return self.submit(bot, 'delete_message', chat_id, priority, {'message_id': message_id})
+
+    def forward_message(self, bot, chat_id, priority: int = PRIORITY_ADMIN, **kwargs) -> Future:
+        return self.submit(bot, 'forward_message', chat_id, priority, kwargs)
+
+    def wait_sent(self, futures: list) -> None:
+
+        """Waits for a batch of sends, send_timeout seconds at most for all of them. The ones still queued
+        are cancelled, so an outbox entry retried for them doesn't send them twice."""
+        wait(futures, self.send_timeout)
+        for future in futures:
+            future.cancel()
+
+    def submit(self, bot, method: str, chat_id, priority: int, kwargs: dict) -> Future:
+
+        job = OutboundJob(priority, next(self.sequence), bot, method, chat_id, kwargs)
+        with self.condition:
+            self.chat_queues.setdefault(chat_id, deque()).append(job)
+            self.condition.notify()
+        return job.future
+
+    def chat_bucket(self, chat_id) -> TokenBucket:
+
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # Negative IDs are groups and channels, so are @usernames: they have a stricter limit
+            rate = self.group_rate if str(chat_id).startswith(('-', '@')) else self.chat_rate
+            bucket = TokenBucket(rate, 1)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def schedule_loop(self) -> None:
+
+        with self.condition:
+            while self.running:
+                try:
+                    wait_time = self.schedule(time.monotonic())
+                except Exception as error:
+                    # The loop never stops: every queued send would wait forever
+                    self.logger.exception('Send scheduler failed: %s', error)
+                    wait_time = 1.0
+                if wait_time != 0:
+                    self.condition.wait(wait_time)
+
+    def schedule(self, now: float) -> float | None:
+
+        """Hands the next job to the workers. Returns 0 when one was handed over, else how long
+        to wait for the next one (None: until a job is submitted or a chat is released)."""
+        best_job = None
+        wait_time = None
+
+        # The head of every idle chat queue competes, highest priority first
+        for chat_id, queue in list(self.chat_queues.items()):
+            if chat_id in self.busy_chats:
+                continue
+            try:
+                delay = max(self.chat_bucket(chat_id).ready_in(now), self.blocked_until.get(chat_id, 0) - now)
+            except Exception as error:
+                # A chat that can't be scheduled fails its own sends only
+                self.fail_chat(chat_id, error)
+                continue
+            if delay > 0:
+                wait_time = delay if wait_time is None else min(wait_time, delay)
+                continue
+            job = queue[0]
+            if best_job is None or (job.priority, job.sequence) < (best_job.priority, best_job.sequence):
+                best_job = job
+
+        if best_job is None:
+            return wait_time
+        global_delay = self.global_bucket.ready_in(now)
+        if global_delay > 0:
+            return global_delay
+        self.global_bucket.take(now)
+        self.chat_bucket(best_job.chat_id).take(now)
+        self.dequeue(best_job)
+        try:
+            self.executor.submit(self.execute, best_job)
+        except Exception as error:
+            # E.g. the executor is shut down
+            self.busy_chats.discard(best_job.chat_id)
+            self.fail_job(best_job, error)
+        return 0
+
+    def fail_chat(self, chat_id, error: Exception) -> None:
+
+        self.logger.warning('Sends to chat %s failed: %s', chat_id, error)
+        for job in self.chat_queues.pop(chat_id):
+            self.fail_job(job, error)
+        self.blocked_until.pop(chat_id, None)
+
+    def fail_job(self, job: OutboundJob, error: Exception) -> None:
+        # Cancelled jobs are done already
+        if not job.future.done():
+            job.future.set_exception(error)
+
+    def dequeue(self, job: OutboundJob) -> None:
+
+        queue = self.chat_queues.get(job.chat_id)
+        queue.popleft()
+        if not queue:
+            del self.chat_queues[job.chat_id]
+        self.busy_chats.add(job.chat_id)
+
+    def execute(self, job: OutboundJob) -> None:
+
+        job.attempts += 1
+        # Cancelled while it was queued (wait_sent() timed out), a retried send is running already
+        if job.attempts == 1 and not job.future.set_running_or_notify_cancel():
+            self.release(job.chat_id)
+            return
+        started = time.monotonic()
+        if job.attempts == 1:
+            SEND_WAIT.labels(job.priority).observe(started - job.submitted_at)
+        try:
+            result = getattr(job.bot, job.method)(chat_id=job.chat_id, **job.kwargs)
+        except RetryAfter as error:
+            SEND_LATENCY.labels(job.method, 'retry_after').observe(time.monotonic() - started)
+            self.logger.warning('Flood limit for chat %s, retrying in %ss', job.chat_id, error.retry_after)
+            if job.attempts > self.max_retries:
+                job.future.set_exception(error)
+                self.release(job.chat_id)
+                return
+            # Back to the head of its queue, the chat is paused for the time Telegram asked for
+            with self.condition:
+                self.blocked_until[job.chat_id] = time.monotonic() + error.retry_after
+                self.chat_queues.setdefault(job.chat_id, deque()).appendleft(job)
+            self.release(job.chat_id)
+        except Exception as error:
+            SEND_LATENCY.labels(job.method, 'error').observe(time.monotonic() - started)
+            self.logger.warning('%s to chat %s failed: %s', job.method, job.chat_id, error)
+            job.future.set_exception(error)
+            self.release(job.chat_id)
+        else:
+            SEND_LATENCY.labels(job.method, 'ok').observe(time.monotonic() - started)
+            job.future.set_result(result)
+            self.release(job.chat_id)
+
+    def release(self, chat_id) -> None:
+
+        with self.condition:
+            self.busy_chats.discard(chat_id)
+            if chat_id not in self.chat_queues:
+                self.blocked_until.pop(chat_id, None)
+                # Idle buckets are full again, no need to keep them around
+                if len(self.chat_buckets) > 10000:
+                    self.chat_buckets.pop(chat_id, None)
+            self.condition.notify()
+
+
+def send_error(future: Future) -> BaseException | None:
+    # Exception of a send, a send cancelled or still running after wait_sent() failed too
+    if future.cancelled():
+        return CancelledError()
+    if not future.done():
+        return TimeoutError('Still being sent')
+    return future.exception()
+
+
+if __name__ == '__main__':
+    print('Only for import!')
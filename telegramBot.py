@@ -1,8 +1,32 @@
-import json
-import requests
-from requests.auth import HTTPBasicAuth
+import functools
+import html
+import logging
+import os
+import threading
+import uuid
+from datetime import datetime
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackQueryHandler
-from telegram import KeyboardButton, ReplyKeyboardMarkup, ParseMode, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import ParseMode
+
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import PyMongoError
+
+from addressIndex import AddressIndex
+from archive import OrderArchive
+from blacklist import Blacklist
+from config import SETTINGS
+from conversation import Conversation, ConversationState, ConversationStore, IDLE, ANY_STEP, TEXT, LOCATION
+from database import SequenceAllocator
+from fareEngine import DEFAULT_TARIFFS, FareEngine
+from geocoding import GeocodingCache
+from i18n import TEXTS, DEFAULT_LANGUAGE, MENU_ORDER, MENU_CANCEL, MENU_PRICES, MENU_QUESTION, MENU_LANGUAGE, NO_COMMENTS
+from mapClient import MapClient, MAPMD_URL
+from metrics import HANDLERS
+from outbox import Outbox, NEW_ORDER, ORDER_ACCEPTED, ORDER_DECLINED, ORDER_EXPIRED
+from sendQueue import MessageScheduler, PRIORITY_ADMIN
+from timers import TimerStore, ORDER_REPOST, ORDER_EXPIRE
+from userSession import PROCESS_ID, UserSession, SessionCache, UserLocks
 
 
 # STEP NAMES
@@ -14,62 +38,162 @@ TAXI_TO_LOCATION = 'to_location'
 TAXI_CONTACT = 'contacts'
 TAXI_COMMENT = 'comment'
 
-# TEXT DICTIONARY
-with open('all_text.json', 'r', encoding='utf-8') as file:
-    ALL_TEXT = json.load(file)
-    file.close()
+# Most recent contacts kept for a user
+CONTACTS_LIMIT = 10
 
-# ADMIN GROUP ID
-with open('settings.json', 'r') as file:
-    file_data = json.load(file)
-    ADMIN_GROUP_ID = file_data.get('bot_admin_group_id')
-    file.close()
 
+def user_session(handler):
 
-class TelegramBot:
+    # The user's document is loaded once per update and the changes are flushed at the end
+    @functools.wraps(handler)
+    def wrapper(self, update, context) -> None:
+        user_id = update.effective_chat.id
+        with HANDLERS.track(handler.__name__):
+            self.user_manager.open_session(user_id)
+            try:
+                return handler(self, update, context)
+            finally:
+                self.user_manager.close_session(user_id)
 
-    def __init__(self, database):
+    return wrapper
 
-        # Reading file and getting settings
-        with open('settings.json', 'r') as file:
-            file_data = json.load(file)
-            bot_token = file_data.get('bot_token_user')
-            file.close()
 
-        self.database = database
-        self.user_manager = UserManager(self.database.db_user_info, self.database.db_blacklist)
-        self.orders_manager = OrdersManager(database.db_orders)
+def count_round_trips(handler):
+
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        with HANDLERS.track(handler.__name__):
+            return handler(*args, **kwargs)
+
+    return wrapper
+
+
+class TelegramBot:
 
-        # Main telegram UPDATER
-        self.updater = Updater(token=bot_token, use_context=True)
+    def __init__(self, database, scheduler: MessageScheduler):
+
+        # Getting settings
+        settings = SETTINGS.current
+        bot_token = settings.get('bot_token_user')
+        bot_api_url = settings.get('bot_api_url', '')
+        update_mode = settings.get('update_mode', 'polling')
+        workers = settings.get('workers', 4)
+        mapmd_token = settings.get('mapmd_token')
+        mapmd_url = settings.get('mapmd_url', MAPMD_URL)
+        mapmd_timeout = settings.get('mapmd_timeout', 3.0)
+        mapmd_retries = settings.get('mapmd_retries', 2)
+        order_id_block_size = settings.get('order_id_block_size', 1)
+        user_cache_size = settings.get('user_cache_size', 10000)
+        user_cache_ttl = settings.get('user_cache_ttl', 60)
+        user_cache_change_streams = settings.get('user_cache_change_streams', True)
+        conversation_flush_interval = settings.get('conversation_flush_interval', 1.0)
+        conversation_batch_size = settings.get('conversation_batch_size', 500)
+        conversation_ttl = settings.get('conversation_ttl', 600)
+        geocoding_grid_size = settings.get('geocoding_grid_size', 15)
+        geocoding_cache_size = settings.get('geocoding_cache_size', 10000)
+        geocoding_cache_ttl = settings.get('geocoding_cache_ttl', 30 * 24 * 3600)
+        geocoding_persistent = settings.get('geocoding_persistent', True)
+        address_index_path = settings.get('address_index_path', '')
+        address_index_min_score = settings.get('address_index_min_score', 0.5)
+        districts_path = settings.get('districts_path', '')
+        fare_tariffs = settings.get('fare_tariffs', {})
+        blacklist_refresh_interval = settings.get('blacklist_refresh_interval', 30)
+        blacklist_bloom_threshold = settings.get('blacklist_bloom_threshold', 100000)
+        blacklist_change_streams = settings.get('blacklist_change_streams', True)
+        outbox_lease_time = settings.get('outbox_lease_time', 30)
+        outbox_retry_delay = settings.get('outbox_retry_delay', 5)
+        outbox_max_attempts = settings.get('outbox_max_attempts', 10)
+        order_repost_interval = settings.get('order_repost_interval', 0)
+        order_expire_after = settings.get('order_expire_after', 0)
+
+        self.database = database
+        self.scheduler = scheduler
+
+        # Users' sessions are cached between updates and invalidated by other processes' writes
+        session_cache = SessionCache(user_cache_size, user_cache_ttl)
+        if user_cache_change_streams:
+            session_cache.watch_invalidations(self.database.db_user_info)
+
+        # Banned users are kept in memory and refreshed in the background
+        self.blacklist = Blacklist(self.database.db_blacklist, blacklist_refresh_interval, blacklist_bloom_threshold)
+        self.blacklist.start(blacklist_change_streams)
+
+        # Wizard steps are kept in memory and written behind, in batches
+        self.conversations = ConversationStore(self.database.db_user_info, PROCESS_ID, conversation_flush_interval,
+                                               conversation_batch_size, conversation_ttl).start()
+
+        self.user_manager = UserManager(self.database.db_user_info, self.blacklist, session_cache, self.conversations)
+
+        # Order IDs are taken from the counters collection (seeded from the existing orders)
+        order_id_allocator = SequenceAllocator(self.database.db_counters, 'order_id', order_id_block_size)
+        order_id_allocator.seed(self.database.db_orders, 'order_id')
+        self.outbox = Outbox(self.database.db_outbox, outbox_lease_time, outbox_retry_delay, outbox_max_attempts)
+        # Open orders are reposted and expired by timers fired on the leader
+        self.timers = TimerStore(self.database.db_timers)
+        # Archived orders are still found, through the archive
+        self.archive = OrderArchive(self.database.db_orders_archive, self.database.archive_collection)
+        self.orders_manager = OrdersManager(self.database.db_orders, order_id_allocator, self.outbox,
+                                            self.database.run_transaction, self.timers, order_repost_interval,
+                                            order_expire_after, self.archive)
+
+        # Map.md lookups are cached by grid cell / normalized address
+        self.map_client = MapClient(mapmd_token, mapmd_url, mapmd_timeout, mapmd_retries)
+        db_geocoding = self.database.db_geocoding if geocoding_persistent else None
+        self.geocoding_cache = GeocodingCache(db_geocoding, geocoding_grid_size, geocoding_cache_size, geocoding_cache_ttl)
+
+        # Typed addresses are resolved offline first (built with `python addressIndex.py build`)
+        self.address_index = None
+        if address_index_path and os.path.exists(address_index_path):
+            self.address_index = AddressIndex.load(address_index_path, address_index_min_score)
+
+        # Fares are estimated from the districts of both ends (GeoJSON polygons of the districts)
+        self.fare_engine = None
+        if districts_path and os.path.exists(districts_path):
+            self.fare_engine = FareEngine.load(districts_path, fare_tariffs)
+
+        # Main telegram UPDATER (another Bot API server than Telegram's with bot_api_url)
+        self.updater = Updater(token=bot_token, base_url=bot_api_url or None, use_context=True, workers=workers)
         self.dispatcher = self.updater.dispatcher
 
         # Initializing Menu object
-        menu = TelegramMenu(self.user_manager, self.orders_manager)
+        menu = TelegramMenu(self.user_manager, self.orders_manager, self.scheduler, self.map_client, self.geocoding_cache,
+                            self.address_index, self.fare_engine)
 
         # Initializing Handler object
-        handlers = TelegramHandlers(self.user_manager, menu)
-
-        # Handlers
-        self.dispatcher.add_handler(CommandHandler('start', handlers.start))
-        self.dispatcher.add_handler(CommandHandler('stop', handlers.stop))
-        self.dispatcher.add_handler(MessageHandler(Filters.text, menu.menu_message))
-        self.dispatcher.add_handler(MessageHandler(Filters.location, menu.location_message))
-        self.dispatcher.add_handler(MessageHandler(Filters.command, handlers.unknown))
+        handlers = TelegramHandlers(self.user_manager, self.scheduler, menu)
+
+        # Handlers run on the `workers` threads of the dispatcher (the asyncio server has its own pool and
+        # keeps the updates of a user in order), one update of a user at a time
+        run_async = update_mode != 'asyncio'
+        in_order = UserLocks().in_order
+        self.dispatcher.add_handler(CommandHandler('start', in_order(handlers.start), run_async=run_async))
+        self.dispatcher.add_handler(CommandHandler('stop', in_order(handlers.stop), run_async=run_async))
+        self.dispatcher.add_handler(CommandHandler('ban', in_order(handlers.ban), run_async=run_async))
+        self.dispatcher.add_handler(CommandHandler('unban', in_order(handlers.unban), run_async=run_async))
+        self.dispatcher.add_handler(MessageHandler(Filters.text, in_order(menu.menu_message), run_async=run_async))
+        self.dispatcher.add_handler(MessageHandler(Filters.location, in_order(menu.location_message), run_async=run_async))
+        self.dispatcher.add_handler(MessageHandler(Filters.command, in_order(handlers.unknown), run_async=run_async))
         # Comment menu handlers
-        self.dispatcher.add_handler(CallbackQueryHandler(menu.no_comments, pattern='no_comments'))
+        self.dispatcher.add_handler(CallbackQueryHandler(in_order(menu.no_comments), pattern=NO_COMMENTS,
+                                                         run_async=run_async))
 
-        # Starting the bot
-        self.updater.start_polling()
+        # Starting the bot (in webhook mode updates are delivered by the shared webhook server)
+        if update_mode == 'polling':
+            self.updater.start_polling()
 
         print('USER BOT initialized!')
 
 
 class UserManager:
 
-    def __init__(self, db_user_info, db_blacklist):
+    def __init__(self, db_user_info, blacklist: Blacklist, session_cache: SessionCache,
+                 conversations: ConversationStore):
         self.db_user_info = db_user_info
-        self.db_blacklist = db_blacklist
+        self.blacklist = blacklist
+        self.session_cache = session_cache
+        self.conversations = conversations
+        # Sessions opened by the update handled in the current thread
+        self.open_sessions = threading.local()
 
     def create_user(self, current_user: dict) -> None:
         user_link = current_user.link
@@ -82,29 +206,157 @@ class UserManager:
                      'current_order_id': '',
                      'contacts': [],
                      'orders_count': 0,
-                     'language': 'ru'}
+                     'language': DEFAULT_LANGUAGE,
+                     'updated_by': PROCESS_ID,
+                     'updated_at': datetime.utcnow()}
         self.db_user_info.update({'user_id': current_user.id}, user_info, upsert=True)
+        self.session_cache.evict(current_user.id)
+        # Also over a flush of the old step still on its way
+        self.conversations.set(current_user.id, IDLE)
 
     def remove_user(self, user_id: str) -> None:
         self.db_user_info.remove({'user_id': user_id})
+        self.session_cache.evict(user_id)
+        self.conversations.forget(user_id)
+
+    def get_session(self, user_id: str) -> UserSession | None:
+        sessions = self.get_open_sessions()
+        session = sessions.get(user_id) or self.session_cache.get(user_id)
+        if session is None:
+            document = self.db_user_info.find_one({'user_id': user_id})
+            if document is None:
+                return None
+            session = UserSession(user_id, document)
+            self.session_cache.put(session)
+            self.conversations.refresh(user_id, document)
+        if user_id in sessions:
+            sessions[user_id] = session
+        return session
+
+    def open_session(self, user_id: str) -> None:
+        self.get_open_sessions()[user_id] = None
+
+    def close_session(self, user_id: str) -> None:
+        session = self.get_open_sessions().pop(user_id, None)
+        if session is None or not session.pending:
+            return
+        # All changes made while handling the update go in one write
+        value_to_update = {'$set': dict(session.pending, updated_by=PROCESS_ID, updated_at=datetime.utcnow())}
+        session.pending = {}
+        try:
+            self.db_user_info.update_one({'user_id': user_id}, value_to_update)
+        except Exception:
+            self.session_cache.evict(user_id)
+            raise
+
+    def get_open_sessions(self) -> dict:
+        if not hasattr(self.open_sessions, 'sessions'):
+            self.open_sessions.sessions = {}
+        return self.open_sessions.sessions
 
     def get_user_field(self, user_id: str, field: str) -> str | list:
-        return self.db_user_info.find({'user_id': user_id}).next().get(field)
+        session = self.get_session(user_id)
+        return session.get(field) if session is not None else None
 
     def set_user_field(self, user_id: str, field: str, new_value: str | list) -> None:
-        value_to_update = {'$set': {field: new_value}}
-        self.db_user_info.update({'user_id': user_id}, value_to_update)
+        self.set_user_fields(user_id, {field: new_value})
+
+    def set_user_fields(self, user_id: str, fields: dict) -> None:
+        if user_id in self.get_open_sessions():
+            session = self.get_session(user_id)
+            if session is not None:
+                for field, new_value in fields.items():
+                    session.set(field, new_value)
+                return
+        value_to_update = {'$set': dict(fields, updated_by=PROCESS_ID, updated_at=datetime.utcnow())}
+        self.db_user_info.update_one({'user_id': user_id}, value_to_update)
+        self.session_cache.evict(user_id)
+
+    def get_conversation(self, user_id: str) -> ConversationState:
+        # Loading the session picks up the steps reset by other processes
+        session = self.get_session(user_id)
+        if session is None:
+            return IDLE
+        return self.conversations.get(user_id, session.document)
+
+    def set_conversation(self, user_id: str, state: ConversationState) -> None:
+        # Written behind by the store, the cached document only follows it
+        self.conversations.set(user_id, state)
+        session = self.get_open_sessions().get(user_id) or self.session_cache.get(user_id)
+        if session is not None:
+            session.document.update(current_step=state.step, current_order_id=state.order_id)
+
+    def increment_user_field(self, user_id: str, field: str, amount: int = 1) -> None:
+        self.update_user_atomically({'user_id': user_id}, {'$inc': {field: amount}}, field)
+
+    def add_to_user_set(self, user_id: str, field: str, value: str, max_size: int = None) -> None:
+        if max_size is None:
+            self.update_user_atomically({'user_id': user_id}, {'$addToSet': {field: value}}, field)
+        else:
+            # $push keeps only the last max_size values, the filter skips values that are already there
+            self.update_user_atomically({'user_id': user_id, field: {'$ne': value}},
+                                        {'$push': {field: {'$each': [value], '$slice': -max_size}}}, field)
+
+    def remove_from_user_set(self, user_id: str, field: str, value: str) -> None:
+        self.update_user_atomically({'user_id': user_id}, {'$pull': {field: value}}, field)
+
+    def update_user_atomically(self, user_filter: dict, value_to_update: dict, field: str) -> None:
+        # Server-side mutation, the cached session takes the value the server ended up with. Stamped like
+        # every user write (the garbage collection goes by updated_at), over the caller's own $set
+        value_to_update['$set'] = dict(value_to_update.get('$set', {}), updated_by=PROCESS_ID,
+                                       updated_at=datetime.utcnow())
+        user_info = self.db_user_info.find_one_and_update(user_filter, value_to_update,
+                                                          projection={field: True},
+                                                          return_document=ReturnDocument.AFTER)
+        user_id = user_filter.get('user_id')
+        session = self.get_open_sessions().get(user_id) or self.session_cache.get(user_id)
+        if user_info is not None and session is not None:
+            session.document[field] = user_info.get(field)
+            session.pending.pop(field, None)
+
+    def reset_stale_steps(self, updated_before: datetime, order_ids: list) -> int:
+
+        # Users stuck in a step since updated_before, or in the wizard of an order that is gone. Written without
+        # updated_by, so every process (this one too) drops the cached sessions
+        reset = {'$set': {'current_step': '', 'current_order_id': '', 'updated_at': datetime.utcnow()}}
+        result = self.db_user_info.update_many({'current_step': {'$gt': ''}, 'updated_at': {'$lt': updated_before}},
+                                               reset)
+        reset_count = result.modified_count
+        if order_ids:
+            result = self.db_user_info.update_many({'current_step': {'$gt': ''}, 'current_order_id': {'$in': order_ids}},
+                                                   reset)
+            reset_count += result.modified_count
+        return reset_count
 
     def user_banned(self, user_id: str) -> bool:
-        return self.db_blacklist.find({'user_id': user_id}).count() > 0
+        return self.blacklist.is_banned(user_id)
+
+    def ban_user(self, user_id: str) -> None:
+        self.blacklist.ban(user_id)
+
+    def unban_user(self, user_id: str) -> None:
+        self.blacklist.unban(user_id)
 
 
 class OrdersManager:
 
-    def __init__(self, db_orders):
+    def __init__(self, db_orders, order_id_allocator: SequenceAllocator, outbox: Outbox, run_transaction,
+                 timers: TimerStore = None, repost_interval: float = 0, expire_after: float = 0,
+                 archive: OrderArchive = None):
         self.db_orders = db_orders
-
-    def create_order(self, user_id: str, user_name: str) -> str:
+        self.order_id_allocator = order_id_allocator
+        # Status transitions write their notifications into the outbox in the same transaction
+        self.outbox = outbox
+        self.run_transaction = run_transaction
+        # ... and (un)schedule the timers of the order (0 disables repost / expiry)
+        self.timers = timers
+        self.repost_interval = repost_interval
+        self.expire_after = expire_after
+        self.archive = archive
+        # Outbox entries delivered right away by the caller (set once both bots exist), the notifier does it otherwise
+        self.dispatch_now = None
+
+    def create_order(self, user_id: str, user_name: str, fields: dict = None) -> str:
         new_order = {
             'order_id': self.generate_new_order_id(),
             'message_id': 0,
@@ -112,9 +364,6 @@ class OrdersManager:
             'user_name': user_name,
             'status': 'new',
             'driver_name': '',
-            'drivers_notification_sent': False,
-            'drivers_notification_declined_sent': False,
-            'user_notification_sent': False,
             TAXI_FROM: '',
             TAXI_FROM_LOCATION: '',
             TAXI_TO: '',
@@ -122,25 +371,125 @@ class OrdersManager:
             TAXI_CONTACT: '',
             TAXI_COMMENT: ''
         }
+        if fields:
+            new_order.update(fields)
         self.db_orders.insert(new_order)
         return new_order.get('order_id')
 
     def generate_new_order_id(self) -> str:
-        if self.db_orders.count() == 0:
-            return 1
-        else:
-            all_orders = self.db_orders.find()
-            return all_orders[all_orders.count() - 1].get('order_id') + 1
+        return self.order_id_allocator.next()
 
     def set_order_field(self, order_id: str, order_field: str, new_value: str) -> None:
-        value_to_update = {"$set": {order_field: new_value}}
-        self.db_orders.update({'order_id': order_id}, value_to_update)
+        self.set_order_fields(order_id, {order_field: new_value})
 
-    def get_order_info(self, order_id: str) -> dict:
-        return self.db_orders.find({'order_id': order_id}).next()
+    def set_order_fields(self, order_id: str, fields: dict) -> None:
+        value_to_update = {"$set": fields}
+        self.db_orders.update_one({'order_id': order_id}, value_to_update)
 
-    def get_open_orders(self, user_id: str) -> list:
-        return self.db_orders.find({'user_id': user_id, 'status': 'open'})
+    def set_orders_fields(self, orders_fields: dict) -> None:
+        # {order_id: {field: value}} in one bulk write
+        if not orders_fields:
+            return
+        requests_list = [UpdateOne({'order_id': order_id}, {'$set': fields}) for order_id, fields in orders_fields.items()]
+        self.db_orders.bulk_write(requests_list, ordered=False)
+
+    def open_order(self, order_id: str, fields: dict) -> None:
+        def transition(session) -> None:
+            result = self.db_orders.update_one({'order_id': order_id, 'status': 'new'},
+                                               {'$set': dict(fields, status='open')},
+                                               session=session)
+            if result.modified_count:
+                self.outbox.enqueue(NEW_ORDER, order_id, session)
+                if self.timers is not None and self.repost_interval:
+                    self.timers.schedule(ORDER_REPOST, order_id, self.repost_interval, session)
+                if self.timers is not None and self.expire_after:
+                    self.timers.schedule(ORDER_EXPIRE, order_id, self.expire_after, session)
+        self.run_transaction(transition)
+
+    def accept_order(self, order_id: str, driver_name: str, driver_id: str, chat_id: str = None) -> dict | None:
+        # Only one driver can move the order from open to accepted
+        accepted = {}
+
+        def transition(session) -> None:
+            accepted['order'] = self.db_orders.find_one_and_update({'order_id': order_id, 'status': 'open'},
+                                                                   {'$set': {'status': 'accepted',
+                                                                             'driver_name': driver_name,
+                                                                             'driver_id': driver_id,
+                                                                             'accepted_chat_id': chat_id}},
+                                                                   session=session)
+            if accepted.get('order') is not None:
+                self.outbox.enqueue(ORDER_ACCEPTED, order_id, session)
+                self.cancel_timers(order_id, session)
+        self.run_transaction(transition)
+        return accepted.get('order')
+
+    def decline_open_orders(self, user_id: str) -> list:
+
+        """Declines all the open orders of the user in one update_many, the token stamped on them
+        finds the ones it has declined. Returns them (order_id, message_id, offers); their messages
+        are deleted from the drivers chat at once."""
+        cancel_token = uuid.uuid4().hex
+        declined = []
+        entry_ids = []
+
+        def transition(session) -> None:
+            self.db_orders.update_many({'user_id': user_id, 'status': 'open'},
+                                       {'$set': {'status': 'declined', 'cancel_token': cancel_token}},
+                                       session=session)
+            declined[:] = self.db_orders.find({'cancel_token': cancel_token},
+                                              {'order_id': True, 'message_id': True, 'offers': True},
+                                              session=session)
+            order_ids = [order.get('order_id') for order in declined]
+            entry_ids[:] = self.outbox.enqueue_many(ORDER_DECLINED, order_ids, session)
+            if order_ids and self.timers is not None:
+                self.timers.cancel_many(order_ids, session)
+        self.run_transaction(transition)
+
+        # The deletions are queued, not waited for
+        if entry_ids and self.dispatch_now is not None:
+            self.dispatch_declined(entry_ids)
+        return declined
+
+    def dispatch_declined(self, entry_ids: list) -> None:
+        try:
+            self.dispatch_now(entry_ids)
+        except PyMongoError as error:
+            # Still pending, the notifier delivers them
+            logging.getLogger(__name__).warning('Declined orders were left to the notifier: %s', error)
+
+    def expire_order(self, order_id: str) -> None:
+        # Nobody has accepted it in time
+        def transition(session) -> None:
+            result = self.db_orders.update_one({'order_id': order_id, 'status': 'open'},
+                                               {'$set': {'status': 'expired'}},
+                                               session=session)
+            if result.modified_count:
+                self.outbox.enqueue(ORDER_EXPIRED, order_id, session)
+                self.cancel_timers(order_id, session)
+        self.run_transaction(transition)
+
+    def cancel_timers(self, order_id: str, session=None) -> None:
+        if self.timers is not None:
+            self.timers.cancel(order_id, session)
+
+    def remove_abandoned_orders(self, created_before: datetime) -> list:
+        # Orders left in the wizard (never opened), their creation time is the one of the ObjectId
+        abandoned = {'status': 'new', '_id': {'$lt': ObjectId.from_datetime(created_before)}}
+        order_ids = [order.get('order_id') for order in self.db_orders.find(abandoned, {'order_id': True})]
+        if order_ids:
+            self.db_orders.delete_many(dict(abandoned, order_id={'$in': order_ids}))
+        return order_ids
+
+    def get_order_info(self, order_id: str) -> dict | None:
+        return self.get_orders_info([order_id]).get(order_id)
+
+    def get_orders_info(self, order_ids: list) -> dict:
+        orders = {order.get('order_id'): order for order in self.db_orders.find({'order_id': {'$in': order_ids}})}
+        # Orders that are not in taxi_orders anymore (archived)
+        missing_ids = [order_id for order_id in order_ids if order_id not in orders]
+        if missing_ids and self.archive is not None:
+            orders.update(self.archive.find_orders(missing_ids))
+        return orders
 
     def generate_order_message(self, order: dict) -> str:
         order_message = f'[№{order.get("order_id")}] {order.get(TAXI_FROM)} -> {order.get(TAXI_TO)}'
@@ -151,136 +500,147 @@ class OrdersManager:
 
 class TelegramMenu:
 
-    def __init__(self, user_manager: UserManager, orders_manager: OrdersManager):
-
-        # Map.md Token
-        with open('settings.json', 'r') as file:
-            file_data = json.load(file)
-            self.mapmd_token = file_data.get('mapmd_token')
-            file.close()
+    def __init__(self, user_manager: UserManager, orders_manager: OrdersManager, scheduler: MessageScheduler,
+                 map_client: MapClient, geocoding_cache: GeocodingCache, address_index: AddressIndex = None,
+                 fare_engine: FareEngine = None):
 
         self.user_manager = user_manager
         self.orders_manager = orders_manager
-
-        # Main menu buttons
-        main_keyboard = [
-            [
-                KeyboardButton(text='Заказать'),
-                KeyboardButton(text='Отменить')
-             ],
-            [
-                KeyboardButton(text='Цены'),
-                KeyboardButton(text='🇷🇴 / 🇷🇺'),
-                KeyboardButton(text='Контакты')
-            ]
-        ]
-        self.reply_markup = ReplyKeyboardMarkup(main_keyboard, resize_keyboard=True, one_time_keyboard=False)
-
+        self.scheduler = scheduler
+        self.map_client = map_client
+        self.geocoding_cache = geocoding_cache
+        self.address_index = address_index
+        self.fare_engine = fare_engine
+
+        # Order wizard: (step, event) -> handler(user_id, state, user_language, update, context) -> next state.
+        # Menu buttons work from every step, text nobody expects gets the unknown command answer
+        self.conversation = Conversation({
+            (ANY_STEP, MENU_ORDER): self.order_menu,
+            (ANY_STEP, MENU_CANCEL): self.cancel_menu,
+            (ANY_STEP, MENU_PRICES): self.prices_menu,
+            (ANY_STEP, MENU_LANGUAGE): self.language_menu,
+            (ANY_STEP, MENU_QUESTION): self.question_menu,
+            (ANY_STEP, TEXT): self.unknown_message,
+            (QUESTION, TEXT): self.question_handler,
+            (TAXI_FROM, TEXT): self.taxi_from_handler,
+            (TAXI_FROM, LOCATION): self.taxi_from_handler,
+            (TAXI_TO, TEXT): self.taxi_to_handler,
+            (TAXI_TO, LOCATION): self.taxi_to_handler,
+            (TAXI_CONTACT, TEXT): self.taxi_contact_handler,
+            (TAXI_COMMENT, TEXT): self.taxi_comment_handler,
+            (TAXI_COMMENT, NO_COMMENTS): self.taxi_comment_handler
+        }, self.user_manager.set_conversation)
+
+    @user_session
     def menu_message(self, update, context) -> None:
 
-        user_message = update.message.text
         user_id = update.effective_chat.id
 
-        user_language = self.user_manager.get_user_field(user_id, 'language')
-        current_step = self.user_manager.get_user_field(user_id, 'current_step')
+        # Blacklist check (in memory, before touching the database)
+        if self.user_manager.user_banned(user_id):
+            return
 
-        main_menu_text = ALL_TEXT.get('main_menu')
+        # Menu buttons are events of their own, any other text goes to the current step
+        event = TEXTS.current.menu_action(update.message.text) or TEXT
+        self.dispatch(user_id, event, update, context)
+
+    @user_session
+    def location_message(self, update, context) -> None:
+
+        user_id = update.effective_chat.id
 
         # Blacklist check
         if self.user_manager.user_banned(user_id):
             return
 
-        if user_message == main_menu_text.get('menu1_ru') or user_message == main_menu_text.get('menu1_ro'):
-            context.bot.send_message(chat_id=update.effective_chat.id,
-                                     text=ALL_TEXT.get('taxi_from').get(user_language),
-                                     parse_mode=ParseMode.HTML)
-            self.user_manager.set_user_field(user_id, 'current_step', TAXI_FROM)
-        elif user_message == main_menu_text.get('menu2_ru') or user_message == main_menu_text.get('menu2_ro'):
-            open_orders = self.orders_manager.get_open_orders(user_id)
-            if open_orders.count() == 0:
-                context.bot.send_message(chat_id=update.effective_chat.id,
-                                         text=ALL_TEXT.get('no_open_orders').get(user_language))
-            else:
-                for open_order in open_orders:
-                    self.orders_manager.set_order_field(open_order.get('order_id'), 'status', 'declined')
-                context.bot.send_message(chat_id=update.effective_chat.id,
-                                         text=ALL_TEXT.get('orders_have_been_declined').get(user_language))
-        elif user_message == main_menu_text.get('menu3_ru') or user_message == main_menu_text.get('menu3_ro'):
-            context.bot.send_message(chat_id=update.effective_chat.id,
-                                     text='❇️ По району - <b>40 ЛЕЙ</b>\n'
-                                          '❇️ Между районами - <b>50 ЛЕЙ</b>\n'
-                                          '❇️ Через район - <b>60 ЛЕЙ</b>\n\n'
-                                          '🌐 Тариф вне Кишинева - <b>5 ЛЕЙ/КМ</b>\n\n'
-                                          '🕓 <i>Ожидание: 5 мин. бесплатно, далее - <b>1 ЛЕЙ/МИН.</b></i>\n\n'
-                                          '‼️ Цены указаны приблизительно и могут варьироваться в зависимости от разных факторов!\n'
-                                          '‼️ Советуем уточнять цену перед поездкой!',
-                                     parse_mode=ParseMode.HTML)
-        elif user_message == '🇷🇴 / 🇷🇺':
-            current_language = self.user_manager.get_user_field(user_id, 'language')
-            new_language = 'ro' if current_language == 'ru' else 'ru'
-            self.user_manager.set_user_field(user_id, 'language', new_language)
-            # Main menu buttons
-            new_keyboard = [
-                [
-                    KeyboardButton(text=main_menu_text.get(f'menu1_{new_language}')),
-                    KeyboardButton(text=main_menu_text.get(f'menu2_{new_language}'))
-                ],
-                [
-                    KeyboardButton(text=main_menu_text.get(f'menu3_{new_language}')),
-                    KeyboardButton(text='🇷🇴 / 🇷🇺'),
-                    KeyboardButton(text=main_menu_text.get(f'menu4_{new_language}'))
-                ]
-            ]
-            reply_markup = ReplyKeyboardMarkup(new_keyboard, resize_keyboard=True, one_time_keyboard=False)
-            context.bot.send_message(chat_id=update.effective_chat.id,
-                                     text=ALL_TEXT.get('language_change').get(new_language),
-                                     reply_markup=reply_markup)
-        elif user_message == main_menu_text.get('menu4_ru') or user_message == main_menu_text.get('menu4_ro'):
-            message_for_user = ALL_TEXT.get('contacts').get(user_language)
-            context.bot.send_message(chat_id=update.effective_chat.id,
-                                     text=message_for_user,
-                                     parse_mode=ParseMode.HTML)
-            self.user_manager.set_user_field(user_id, 'current_step', QUESTION)
-        elif len(current_step) != 0:
-            self.message_handler(user_id, user_message, current_step, update, context)
-        else:
-            context.bot.send_message(chat_id=update.effective_chat.id,
-                                     text=ALL_TEXT.get('unknown_command').get(user_language))
+        self.dispatch(user_id, LOCATION, update, context)
 
-    def location_message(self, update, context) -> None:
+    @user_session
+    def no_comments(self, update, context) -> None:
 
-        user_id = update.effective_chat.id
+        query = update.callback_query
+        query.answer()
 
-        location = update.message.location
-        latitude = location.latitude
-        longitude = location.longitude
-        full_location = f'{longitude},{latitude}'
-        address = self.get_address_from_location(latitude, longitude)
-
-        current_step = self.user_manager.get_user_field(user_id, 'current_step')
-
-        if current_step == TAXI_FROM:
-            self.taxi_from_handler(user_id, address, full_location, context)
-        elif current_step == TAXI_TO:
-            self.taxi_to_handler(user_id, address, full_location, context)
-
-    def message_handler(self, user_id: str, user_message: str, current_step: str, update, context) -> None:
-
-        if current_step == QUESTION:
-            # Forward message to admins group
-            context.bot.forward_message(chat_id=ADMIN_GROUP_ID,
-                                        from_chat_id=update.message.chat_id,
-                                        message_id=update.message.message_id)
-        elif current_step == TAXI_FROM:
-            self.taxi_from_handler(user_id, user_message, '', context)
-        elif current_step == TAXI_TO:
-            self.taxi_to_handler(user_id, user_message, '', context)
-        elif current_step == TAXI_CONTACT:
-            self.taxi_contact_handler(user_id, user_message, update)
-        elif current_step == TAXI_COMMENT:
-            self.taxi_comment_handler(user_id, user_message, context)
-
-    def taxi_from_handler(self, user_id: str, address: str, full_location: str, context) -> None:
+        self.dispatch(update.effective_chat.id, NO_COMMENTS, update, context)
+
+    def dispatch(self, user_id: str, event: str, update, context) -> None:
+        user_language = self.user_manager.get_user_field(user_id, 'language')
+        state = self.user_manager.get_conversation(user_id)
+        self.conversation.dispatch(user_id, state, event, user_language, update, context)
+
+    def order_menu(self, user_id: str, state: ConversationState, user_language: str, update, context) -> ConversationState:
+
+        self.scheduler.send_message(context.bot,
+                                    chat_id=user_id,
+                                    text=TEXTS.current.text('taxi_from', user_language),
+                                    parse_mode=ParseMode.HTML)
+        return ConversationState(TAXI_FROM, '')
+
+    def cancel_menu(self, user_id: str, state: ConversationState, user_language: str, update, context) -> None:
+
+        texts = TEXTS.current
+        if self.orders_manager.decline_open_orders(user_id):
+            self.scheduler.send_message(context.bot,
+                                        chat_id=user_id,
+                                        text=texts.text('orders_have_been_declined', user_language))
+        else:
+            self.scheduler.send_message(context.bot,
+                                        chat_id=user_id,
+                                        text=texts.text('no_open_orders', user_language))
+
+    def prices_menu(self, user_id: str, state: ConversationState, user_language: str, update, context) -> None:
+
+        tariffs = self.fare_engine.tariffs if self.fare_engine is not None else DEFAULT_TARIFFS
+        self.scheduler.send_message(context.bot,
+                                    chat_id=user_id,
+                                    text=f'❇️ По району - <b>{tariffs.get("same_district")} ЛЕЙ</b>\n'
+                                         f'❇️ Между районами - <b>{tariffs.get("adjacent_districts")} ЛЕЙ</b>\n'
+                                         f'❇️ Через район - <b>{tariffs.get("across_districts")} ЛЕЙ</b>\n\n'
+                                         f'🌐 Тариф вне Кишинева - <b>{tariffs.get("outside_per_km")} ЛЕЙ/КМ</b>\n\n'
+                                         '🕓 <i>Ожидание: 5 мин. бесплатно, далее - <b>1 ЛЕЙ/МИН.</b></i>\n\n'
+                                         '‼️ Цены указаны приблизительно и могут варьироваться в зависимости от разных факторов!\n'
+                                         '‼️ Советуем уточнять цену перед поездкой!',
+                                    parse_mode=ParseMode.HTML)
+
+    def language_menu(self, user_id: str, state: ConversationState, user_language: str, update, context) -> None:
+
+        new_language = 'ro' if user_language == 'ru' else 'ru'
+        self.user_manager.set_user_field(user_id, 'language', new_language)
+        texts = TEXTS.current
+        self.scheduler.send_message(context.bot,
+                                    chat_id=user_id,
+                                    text=texts.text('language_change', new_language),
+                                    reply_markup=texts.main_keyboard(new_language))
+
+    def question_menu(self, user_id: str, state: ConversationState, user_language: str, update, context) -> ConversationState:
+
+        self.scheduler.send_message(context.bot,
+                                    chat_id=user_id,
+                                    text=TEXTS.current.text('contacts', user_language),
+                                    parse_mode=ParseMode.HTML)
+        return ConversationState(QUESTION, '')
+
+    def unknown_message(self, user_id: str, state: ConversationState, user_language: str, update, context) -> None:
+
+        # Only outside of the wizard, a step without a text handler ignores it
+        if not state.step:
+            self.scheduler.send_message(context.bot,
+                                        chat_id=user_id,
+                                        text=TEXTS.current.text('unknown_command', user_language))
+
+    def question_handler(self, user_id: str, state: ConversationState, user_language: str, update, context) -> None:
+
+        # Forward message to admins group
+        self.scheduler.forward_message(context.bot,
+                                       chat_id=SETTINGS.current.get('bot_admin_group_id'),
+                                       priority=PRIORITY_ADMIN,
+                                       from_chat_id=update.message.chat_id,
+                                       message_id=update.message.message_id)
+
+    @count_round_trips
+    def taxi_from_handler(self, user_id: str, state: ConversationState, user_language: str, update, context) -> ConversationState:
+
+        address, full_location = self.get_message_address(update.message)
 
         user_link = self.user_manager.get_user_field(user_id, 'link')
         if user_link:
@@ -288,141 +648,217 @@ class TelegramMenu:
         else:
             user_name = ''
 
-        order_id = self.orders_manager.create_order(user_id, user_name)
-
-        self.orders_manager.set_order_field(order_id, TAXI_FROM, address)
-        self.orders_manager.set_order_field(order_id, TAXI_FROM_LOCATION, full_location)
-
-        self.user_manager.set_user_field(user_id, 'current_order_id', order_id)
-        self.user_manager.set_user_field(user_id, 'current_step', TAXI_TO)
+        order_id = self.orders_manager.create_order(user_id, user_name, {TAXI_FROM: address,
+                                                                         TAXI_FROM_LOCATION: full_location})
 
-        user_language = self.user_manager.get_user_field(user_id, 'language')
-        context.bot.send_message(chat_id=user_id,
-                                 text=ALL_TEXT.get('taxi_to').get(user_language),
-                                 parse_mode=ParseMode.HTML)
-
-    def taxi_to_handler(self, user_id: str, address: str, full_location: str, context) -> None:
+        self.scheduler.send_message(context.bot,
+                                    chat_id=user_id,
+                                    text=TEXTS.current.text('taxi_to', user_language),
+                                    parse_mode=ParseMode.HTML)
+        return ConversationState(TAXI_TO, order_id)
 
-        order_id = self.user_manager.get_user_field(user_id, 'current_order_id')
+    @count_round_trips
+    def taxi_to_handler(self, user_id: str, state: ConversationState, user_language: str, update, context) -> ConversationState:
 
-        self.orders_manager.set_order_field(order_id, TAXI_TO, address)
-        self.orders_manager.set_order_field(order_id, TAXI_TO_LOCATION, full_location)
+        address, full_location = self.get_message_address(update.message)
 
-        self.user_manager.set_user_field(user_id, 'current_step', TAXI_CONTACT)
+        self.orders_manager.set_order_fields(state.order_id, {TAXI_TO: address,
+                                                              TAXI_TO_LOCATION: full_location})
 
         # Checking if username is hide
-        user_language = self.user_manager.get_user_field(user_id, 'language')
-        message_text = ALL_TEXT.get('taxi_contact').get(user_language)
+        texts = TEXTS.current
+        message_text = texts.text('taxi_contact', user_language)
         if not self.user_manager.get_user_field(user_id, 'link'):
-            message_text += ALL_TEXT.get('taxi_contact').get(f'special_{user_language}')
+            message_text += texts.text('taxi_contact', user_language, 'special')
 
-        context.bot.send_message(chat_id=user_id,
-                                 text=message_text,
-                                 parse_mode=ParseMode.HTML)
+        self.scheduler.send_message(context.bot,
+                                    chat_id=user_id,
+                                    text=message_text,
+                                    parse_mode=ParseMode.HTML)
+        return ConversationState(TAXI_CONTACT, state.order_id)
 
-    def taxi_contact_handler(self, user_id: str, user_message: str, update) -> None:
+    @count_round_trips
+    def taxi_contact_handler(self, user_id: str, state: ConversationState, user_language: str, update, context) -> ConversationState:
 
-        order_id = self.user_manager.get_user_field(user_id, 'current_order_id')
-
-        self.orders_manager.set_order_field(order_id, TAXI_CONTACT, user_message)
-        self.user_manager.set_user_field(user_id, 'current_step', TAXI_COMMENT)
+        user_message = update.message.text
+        self.orders_manager.set_order_field(state.order_id, TAXI_CONTACT, user_message)
 
         # Updating contacts
-        current_contacts = self.user_manager.get_user_field(user_id, 'contacts')
-        if user_message not in current_contacts:
-            current_contacts.append(user_message)
-        self.user_manager.set_user_field(user_id, 'contacts', current_contacts)
+        self.user_manager.add_to_user_set(user_id, 'contacts', user_message, CONTACTS_LIMIT)
+
+        texts = TEXTS.current
+        self.scheduler.send_message(context.bot,
+                                    chat_id=user_id,
+                                    text=texts.text('taxi_comment', user_language),
+                                    reply_markup=texts.comment_keyboard(user_language),
+                                    parse_mode=ParseMode.HTML)
+        return ConversationState(TAXI_COMMENT, state.order_id)
+
+    @count_round_trips
+    def taxi_comment_handler(self, user_id: str, state: ConversationState, user_language: str, update, context) -> ConversationState:
+
+        # Typed, or the "no comments" button
+        comment = update.message.text if update.callback_query is None else ''
+
+        order_fields = {TAXI_COMMENT: comment}
+        fare = self.estimate_fare(state.order_id)
+        if fare is not None:
+            order_fields.update({'fare_estimate': fare.get('price'),
+                                 'fare_class': fare.get('tariff_class'),
+                                 'distance_km': fare.get('distance_km')})
+        self.orders_manager.open_order(state.order_id, order_fields)
+
+        texts = TEXTS.current
+        message_text = texts.text('open_order', user_language)
+        if fare is not None:
+            message_text += texts.text('fare_estimate', user_language, fare=fare)
+        self.scheduler.send_message(context.bot,
+                                    chat_id=user_id,
+                                    text=message_text,
+                                    parse_mode=ParseMode.HTML)
+        return IDLE
+
+    def estimate_fare(self, order_id: str) -> dict | None:
+
+        # Only orders with both ends geolocated (shared or resolved from the typed address)
+        if self.fare_engine is None:
+            return None
+        order = self.orders_manager.get_order_info(order_id)
+        if order is None:
+            return None
+        return self.fare_engine.estimate(order.get(TAXI_FROM_LOCATION), order.get(TAXI_TO_LOCATION))
+
+    def get_message_address(self, message) -> tuple:
+
+        # (address, "longitude,latitude") of a shared location or a typed address
+        if message.location is not None:
+            latitude = message.location.latitude
+            longitude = message.location.longitude
+            return self.get_address_from_location(latitude, longitude), f'{longitude},{latitude}'
+        return message.text, self.get_location_from_address(message.text)
 
-        user_language = self.user_manager.get_user_field(user_id, 'language')
-        text_comment = ALL_TEXT.get('taxi_comment')
-        keyboard = [
-            [
-                InlineKeyboardButton(text_comment.get(f'button_{user_language}'), callback_data='no_comments')
-            ]
-        ]
-        update.message.reply_text(text=text_comment.get(user_language),
-                                  reply_markup=InlineKeyboardMarkup(keyboard),
-                                  parse_mode=ParseMode.HTML)
+    def get_address_from_location(self, latitude: str, longitude: str) -> str:
 
-    def taxi_comment_handler(self, user_id: str, user_message: str, context) -> None:
+        address = self.geocoding_cache.reverse(latitude, longitude,
+                                               lambda: self.fetch_address_from_location(latitude, longitude))
+        return address if address is not None else 'Не определен'
 
-        order_id = self.user_manager.get_user_field(user_id, 'current_order_id')
+    def fetch_address_from_location(self, latitude: str, longitude: str) -> str | None:
 
-        self.orders_manager.set_order_field(order_id, TAXI_COMMENT, user_message)
+        request_json = self.map_client.near(latitude, longitude)
+        if request_json is None:
+            return None
 
-        self.user_manager.set_user_field(user_id, 'current_step', '')
-        self.user_manager.set_user_field(user_id, 'current_order_id', '')
+        try:
+            building = request_json.get('building')
+            city = building.get('location').replace('Chişinău', 'Chisinau')
+            street = building.get('street_name')
+            number = building.get('number')
+            return f'{city}, {street} {number}'
+        except:
+            return None
 
-        self.orders_manager.set_order_field(order_id, 'status', 'open')
+    def get_location_from_address(self, address: str) -> str:
 
-        user_language = self.user_manager.get_user_field(user_id, 'language')
-        context.bot.send_message(chat_id=user_id,
-                                 text=ALL_TEXT.get('open_order').get(user_language))
+        # Offline index first, map.md only for the addresses it doesn't know
+        structure = self.address_index.lookup(address) if self.address_index is not None else None
+        if structure is None:
+            structure = self.geocoding_cache.search(address, lambda: self.fetch_location_from_address(address))
+        if structure is None:
+            return ''
+        return f'{structure.get("longitude")},{structure.get("latitude")}'
 
-    def get_address_from_location(self, latitude: str, longitude: str) -> str:
+    def fetch_location_from_address(self, address: str) -> dict | None:
 
-        url = f'https://map.md/api/companies/webmap/near?lat={latitude}&lon={longitude}'
-        headers = {'Content-Type': 'application/json'}
-        request = requests.get(url=url,
-                               auth=HTTPBasicAuth(self.mapmd_token, ''),
-                               headers=headers)
+        request_json = self.map_client.search(address)
+        if request_json is None:
+            return None
 
-        if request.status_code == 200:
-            request_json = request.json()
-            try:
-                building = request_json.get('building')
-                city = building.get('location').replace('Chişinău', 'Chisinau')
-                street = building.get('street_name')
-                number = building.get('number')
-                return f'{city}, {street} {number}'
-            except:
-                return 'Не определен'
-        else:
-            return 'Не определен'
-
-    def no_comments(self, update, context) -> None:
-        
-        query = update.callback_query
-        query.answer()
-
-        user_id = update.effective_chat.id
-        self.taxi_comment_handler(user_id, '', context)
+        try:
+            centroid = request_json.get('selected').get('centroid')
+            return {
+                'latitude': centroid.get('lat'),
+                'longitude': centroid.get('lon')
+            }
+        except:
+            return None
 
 
 class TelegramHandlers:
 
-    def __init__(self, user_manager: UserManager, menu: TelegramMenu):
+    def __init__(self, user_manager: UserManager, scheduler: MessageScheduler, menu: TelegramMenu):
 
         # Initializing menu
         self.menu = menu
         self.user_manager = user_manager
+        self.scheduler = scheduler
 
+    @count_round_trips
     def start(self, update, context) -> None:
 
         # Creating user
         current_user = update.effective_chat
         self.user_manager.create_user(current_user)
 
-        context.bot.send_message(chat_id=update.effective_chat.id,
-                                 text=f'👋 <b>Привет, {current_user.full_name}!</b> 👋\n\n'
-                                      f'🚕 С моей помощью можно удобно заказать такси\n'
-                                      f'❓ <i>Есть вопрос или предложение? Связаться с администрацией можно по соответствующей кнопке</i>\n\n'
-                                      f'📣 Хочешь быть в команде водителей? Свяжись с нами\n\n'
-                                      f'Проблемы с ботом? Пропишите /start для перезапуска или свяжитесь с администрацией',
-                                 reply_markup=self.menu.reply_markup,
-                                 parse_mode=ParseMode.HTML)
-
+        self.scheduler.send_message(context.bot,
+                                    chat_id=update.effective_chat.id,
+                                    text=f'👋 <b>Привет, {html.escape(current_user.full_name)}!</b> 👋\n\n'
+                                         f'🚕 С моей помощью можно удобно заказать такси\n'
+                                         f'❓ <i>Есть вопрос или предложение? Связаться с администрацией можно по соответствующей кнопке</i>\n\n'
+                                         f'📣 Хочешь быть в команде водителей? Свяжись с нами\n\n'
+                                         f'Проблемы с ботом? Пропишите /start для перезапуска или свяжитесь с администрацией',
+                                    reply_markup=TEXTS.current.main_keyboard(DEFAULT_LANGUAGE),
+                                    parse_mode=ParseMode.HTML)
+
+    @count_round_trips
     def stop(self, update, context) -> None:
 
         self.user_manager.remove_user(update.effective_chat.id)
 
-        context.bot.send_message(chat_id=update.effective_chat.id,
-                                 text='Чтобы вновь удобно заказывать такси - введи /start')
+        self.scheduler.send_message(context.bot,
+                                    chat_id=update.effective_chat.id,
+                                    text='Чтобы вновь удобно заказывать такси - введи /start')
 
+    @count_round_trips
+    def ban(self, update, context) -> None:
+        self.change_ban(update, context, True)
+
+    @count_round_trips
+    def unban(self, update, context) -> None:
+        self.change_ban(update, context, False)
+
+    def change_ban(self, update, context, banned: bool) -> None:
+
+        # Only available in the admins group: /ban <user_id>, /unban <user_id>
+        if str(update.effective_chat.id) != str(SETTINGS.current.get('bot_admin_group_id')):
+            self.unknown(update, context)
+            return
+
+        if len(context.args) != 1 or not context.args[0].lstrip('-').isdigit():
+            self.scheduler.send_message(context.bot,
+                                        chat_id=update.effective_chat.id,
+                                        priority=PRIORITY_ADMIN,
+                                        text='Использование: /ban <user_id> или /unban <user_id>')
+            return
+
+        user_id = int(context.args[0])
+        if banned:
+            self.user_manager.ban_user(user_id)
+            message_text = f'Пользователь {user_id} заблокирован'
+        else:
+            self.user_manager.unban_user(user_id)
+            message_text = f'Пользователь {user_id} разблокирован'
+        self.scheduler.send_message(context.bot,
+                                    chat_id=update.effective_chat.id,
+                                    priority=PRIORITY_ADMIN,
+                                    text=message_text)
+
+    @count_round_trips
     def unknown(self, update, context) -> None:
 
-        context.bot.send_message(chat_id=update.effective_chat.id,
-                                 text="Я не знаю такой команды")
+        self.scheduler.send_message(context.bot,
+                                    chat_id=update.effective_chat.id,
+                                    text="Я не знаю такой команды")
 
 
 if __name__ == '__main__':
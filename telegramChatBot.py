@@ -1,24 +1,28 @@
-import json
+import html
 import logging
-from telegram import Update, Chat, ChatMember, ParseMode, ChatMemberUpdated
+from telegram import Update, Chat, ChatMember, ParseMode, ChatMemberUpdated, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Updater,
     CallbackContext,
     ChatMemberHandler,
-    CallbackQueryHandler
+    CallbackQueryHandler,
+    MessageHandler,
+    Filters
 )
 
-# Reading file and getting settings
-with open('settings.json', 'r') as file:
-    file_data = json.load(file)
-    ADMIN_GROUP_ID = file_data.get('bot_admin_group_id')
-    ADMIN_GROUP_ORDERS_ID = file_data.get('bot_admin_group_orders_id')
-    file.close()
+from config import SETTINGS, Config
+from driverLocator import DriverLocator, parse_location
+from telegramBot import count_round_trips
+from userSession import UserLocks
+from sendQueue import MessageScheduler, PRIORITY_ADMIN, PRIORITY_DRIVERS
+
+# Callback data of the order button: accept_order:<order_id>
+ACCEPT_ORDER = 'accept_order'
 
 
 class TelegramChatBot:
 
-    def __init__(self, database):
+    def __init__(self, database, scheduler: MessageScheduler, orders_manager):
 
         # Logging
         logging.basicConfig(
@@ -27,29 +31,55 @@ class TelegramChatBot:
 
         self.logger = logging.getLogger(__name__)
 
-        # Reading file and getting settings
-        with open('settings.json', 'r') as file:
-            file_data = json.load(file)
-            bot_token = file_data.get('bot_token_drivers')
-            self.bot_chat_id = file_data.get('bot_group_id')
-            file.close()
+        # Getting settings
+        settings = SETTINGS.current
+        bot_token = settings.get('bot_token_drivers')
+        bot_api_url = settings.get('bot_api_url', '')
+        self.bot_chat_id = settings.get('bot_group_id')
+        update_mode = settings.get('update_mode', 'polling')
+        workers = settings.get('workers', 4)
+        driver_location_stale_after = settings.get('driver_location_stale_after', 600)
+        driver_busy_period = settings.get('driver_busy_period', 3600)
+        # The dispatch settings follow settings.json without a restart
+        self.apply_settings(settings)
+        SETTINGS.subscribe(self.apply_settings)
 
         self.database = database
+        self.scheduler = scheduler
+        self.orders_manager = orders_manager
+        self.driver_locator = DriverLocator(database.db_driver_locations, driver_location_stale_after,
+                                            driver_busy_period)
 
-        # Main telegram UPDATER
-        self.updater = Updater(token=bot_token, use_context=True)
+        # Main telegram UPDATER (another Bot API server than Telegram's with bot_api_url)
+        self.updater = Updater(token=bot_token, base_url=bot_api_url or None, use_context=True, workers=workers)
         self.dispatcher = self.updater.dispatcher
 
-        # Handlers
-        self.dispatcher.add_handler(ChatMemberHandler(self.track_chats, ChatMemberHandler.MY_CHAT_MEMBER))
+        # Handlers run on the `workers` threads of the dispatcher (the asyncio server has its own pool). Accepting
+        # is atomic, the drivers race for an order in the same group chat
+        run_async = update_mode != 'asyncio'
+        self.dispatcher.add_handler(ChatMemberHandler(self.track_chats, ChatMemberHandler.MY_CHAT_MEMBER,
+                                                      run_async=run_async))
         # Menu handlers
-        self.dispatcher.add_handler(CallbackQueryHandler(self.accept_order, pattern='accept_order'))
+        self.dispatcher.add_handler(CallbackQueryHandler(self.accept_order, pattern=f'^{ACCEPT_ORDER}',
+                                                         run_async=run_async))
+        # Drivers share their (live) location in the private chat with the bot, in order
+        self.dispatcher.add_handler(MessageHandler(Filters.location & Filters.chat_type.private,
+                                                   UserLocks().in_order(self.driver_location), run_async=run_async))
 
-        # Starting the bot
-        self.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+        # Starting the bot (in webhook mode updates are delivered by the shared webhook server)
+        if update_mode == 'polling':
+            self.updater.start_polling(allowed_updates=Update.ALL_TYPES)
 
         print('CHAT BOT initialized!')
 
+    def apply_settings(self, settings: Config) -> None:
+
+        # Radii (meters) of the rings of nearest drivers an order is offered to before the group
+        self.dispatch_rings = settings.get('dispatch_rings', [])
+        self.dispatch_drivers_per_ring = settings.get('dispatch_drivers_per_ring', 3)
+        self.dispatch_offer_timeout = settings.get('dispatch_offer_timeout', 20)
+
+    @count_round_trips
     def track_chats(self, update: Update, context: CallbackContext) -> None:
 
         """Tracks the chats the bot is in."""
@@ -120,43 +150,165 @@ class TelegramChatBot:
 
         return was_member, is_member
 
-    def get_orders(self, status_name: str) -> list:
-
-        if status_name == 'declined':
-            flag_type = 'drivers_notification_declined_sent'
-        else:
-            flag_type = 'drivers_notification_sent'
+    @staticmethod
+    def get_callback_order_id(callback_data: str) -> int | None:
+        order_id = callback_data.partition(':')[2]
+        return int(order_id) if order_id.isdigit() else None
 
-        return self.database.db_orders.find({'status': status_name, flag_type: False})
+    @staticmethod
+    def generate_order_keyboard(order_id: int) -> InlineKeyboardMarkup:
+        order_keyboard = [
+            [InlineKeyboardButton(text='Принять', callback_data=f'{ACCEPT_ORDER}:{order_id}')]
+        ]
+        return InlineKeyboardMarkup(order_keyboard, resize_keyboard=True, one_time_keyboard=False)
 
+    @count_round_trips
     def accept_order(self, update, context) -> None:
 
+        query = update.callback_query
         message = update.effective_message.text_html
-        order_id = message.partition('</b>')[2].partition('\n')[0].replace(' ‼️ №', '')
         driver_name = update.effective_user.name
 
-        # Updating order driver's name
-        value_to_update = {"$set": {'driver_name': driver_name}}
-        self.database.db_orders.update({'order_id': int(order_id)}, value_to_update)        
-        # Updating order status
-        value_to_update = {"$set": {'status': "accepted"}}
-        self.database.db_orders.update({'order_id': int(order_id)}, value_to_update)
+        order_id = self.get_callback_order_id(query.data)
+        if order_id is None:
+            # Messages posted before the order ID was put into the callback data
+            order_id = int(message.partition('</b>')[2].partition('\n')[0].replace(' ‼️ №', ''))
+
+        accepted_order = self.orders_manager.accept_order(order_id, driver_name, update.effective_user.id,
+                                                          query.message.chat_id)
+        if accepted_order is None:
+            query.answer(text='⛔️ Заказ уже принят другим водителем или отменен', show_alert=True)
+            return
+
+        # No more offers for the driver until the next location shared
+        self.driver_locator.set_busy(update.effective_user.id, order_id)
 
         # Order info message (delete from main chat and transfer to the admins chat)
-        query = update.callback_query
         query.answer()
-        query.message.delete()
-        message_for_admins = message.replace('Новый заказ', 'Заказ') + f'\n🚕 <b>Водитель: {driver_name}</b>'
-        self.updater.bot.send_message(chat_id=ADMIN_GROUP_ORDERS_ID,
-                                      text=message_for_admins,
-                                      parse_mode=ParseMode.HTML,
-                                      disable_web_page_preview=True)
+        self.scheduler.delete_message(self.updater.bot,
+                                      chat_id=query.message.chat_id,
+                                      message_id=query.message.message_id)
+        message_for_admins = message.replace('Новый заказ', 'Заказ') + f'\n🚕 <b>Водитель: {html.escape(driver_name)}</b>'
+        self.scheduler.send_message(self.updater.bot,
+                                    chat_id=SETTINGS.current.get('bot_admin_group_orders_id'),
+                                    priority=PRIORITY_ADMIN,
+                                    text=message_for_admins,
+                                    parse_mode=ParseMode.HTML,
+                                    disable_web_page_preview=True)
 
         # Sending copy of order info to the driver
-        self.updater.bot.send_message(chat_id=update.effective_user.id,
-                                      text=message.replace('Новый заказ', 'Заказ'),
-                                      parse_mode=ParseMode.HTML,
-                                      disable_web_page_preview=True)
+        self.scheduler.send_message(self.updater.bot,
+                                    chat_id=update.effective_user.id,
+                                    priority=PRIORITY_DRIVERS,
+                                    text=message.replace('Новый заказ', 'Заказ'),
+                                    parse_mode=ParseMode.HTML,
+                                    disable_web_page_preview=True)
+
+    @count_round_trips
+    def driver_location(self, update, context) -> None:
+
+        driver = update.effective_user
+        location = update.effective_message.location
+
+        # Live location updates arrive as edits of the first message, the last one (sharing stopped) without
+        # a live period: the driver is no longer offered orders
+        if update.edited_message is not None and not location.live_period:
+            self.driver_locator.remove_driver(driver.id)
+            return
+        if update.edited_message is not None:
+            self.driver_locator.update_location(driver.id, driver.name, location.latitude, location.longitude,
+                                                location.live_period, upsert=False)
+            return
+
+        # Only the members of the drivers chat get orders offered
+        member = context.bot.get_chat_member(self.bot_chat_id, driver.id)
+        if member.status not in [ChatMember.MEMBER, ChatMember.CREATOR, ChatMember.ADMINISTRATOR]:
+            self.scheduler.send_message(self.updater.bot,
+                                        chat_id=driver.id,
+                                        priority=PRIORITY_DRIVERS,
+                                        text='⛔️ Геопозиция принимается только от водителей')
+            return
+
+        self.driver_locator.update_location(driver.id, driver.name, location.latitude, location.longitude,
+                                            location.live_period)
+        self.scheduler.send_message(self.updater.bot,
+                                    chat_id=driver.id,
+                                    priority=PRIORITY_DRIVERS,
+                                    text='📍 Геопозиция получена, ближайшие заказы будут приходить вам в личные сообщения')
+
+    def offer_order(self, order: dict, message_for_drivers: str, ring: int) -> tuple:
+
+        """Sends the order to the nearest drivers of the first ring (from `ring` on) that has any.
+        Returns that ring and [(driver_id, Future)], no offers once the rings are exhausted."""
+        pickup = parse_location(order.get('from_location'))
+        if pickup is None:
+            return len(self.dispatch_rings), []
+
+        offered_ids = [offer.get('driver_id') for offer in order.get('offers', [])]
+        while ring < len(self.dispatch_rings):
+            drivers = self.driver_locator.nearest(pickup[0], pickup[1], self.dispatch_drivers_per_ring,
+                                                  self.dispatch_rings[ring], offered_ids)
+            if drivers:
+                break
+            ring += 1
+        else:
+            return ring, []
+
+        offers_sent = []
+        for driver in drivers:
+            message_sent = self.scheduler.send_message(self.updater.bot,
+                                                       chat_id=driver.get('driver_id'),
+                                                       priority=PRIORITY_DRIVERS,
+                                                       text=message_for_drivers + f'\n📍 До клиента: {driver.get("distance") / 1000:.1f} км',
+                                                       parse_mode=ParseMode.HTML,
+                                                       reply_markup=self.generate_order_keyboard(order.get('order_id')),
+                                                       disable_web_page_preview=True)
+            offers_sent.append((driver.get('driver_id'), message_sent))
+        return ring, offers_sent
+
+    def repost_order(self, order: dict, message_for_drivers: str) -> tuple:
+
+        """Moves the group post of an order nobody has accepted to the bottom of the chat.
+        Returns the Futures (deleted, sent), None for an order that isn't in the group yet."""
+        if not order.get('message_id'):
+            return None
+        message_deleted = self.scheduler.delete_message(self.updater.bot,
+                                                        chat_id=self.bot_chat_id,
+                                                        message_id=order.get('message_id'))
+        message_sent = self.scheduler.send_message(self.updater.bot,
+                                                   chat_id=self.bot_chat_id,
+                                                   priority=PRIORITY_DRIVERS,
+                                                   text=message_for_drivers,
+                                                   parse_mode=ParseMode.HTML,
+                                                   reply_markup=self.generate_order_keyboard(order.get('order_id')),
+                                                   disable_web_page_preview=True)
+        return message_deleted, message_sent
+
+    def escalate_order(self, order: dict, message_for_drivers: str, waiting: float):
+
+        # The admins are told about an order that is still waiting for a driver
+        return self.scheduler.send_message(self.updater.bot,
+                                           chat_id=SETTINGS.current.get('bot_admin_group_orders_id'),
+                                           priority=PRIORITY_ADMIN,
+                                           text=f'⏳ <b>Не принят уже {waiting / 60:.0f} мин.</b>\n\n' + message_for_drivers,
+                                           parse_mode=ParseMode.HTML,
+                                           disable_web_page_preview=True)
+
+    def withdraw_order(self, order: dict) -> list:
+
+        """Deletes the messages of the order (group post and private offers), except the one
+        the driver who accepted it has tapped (already deleted). Returns the Futures."""
+        accepted_chat_id = order.get('accepted_chat_id')
+        messages = [(offer.get('driver_id'), offer.get('message_id')) for offer in order.get('offers', [])]
+        messages.append((self.bot_chat_id, order.get('message_id')))
+
+        messages_deleted = []
+        for chat_id, message_id in messages:
+            if message_id and str(chat_id) != str(accepted_chat_id):
+                messages_deleted.append(self.scheduler.delete_message(self.updater.bot,
+                                                                      chat_id=chat_id,
+                                                                      message_id=message_id))
+        return messages_deleted
 
 
 if __name__ == '__main__':
@@ -0,0 +1,177 @@
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+import mongomock
+import pytest
+
+# The modules live in the root of the repository
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from config import SETTINGS
+from database import SequenceAllocator
+from i18n import TEXTS
+from outbox import Outbox
+from telegramBot import OrdersManager
+
+# Settings and texts of the repository, wherever pytest runs from
+SETTINGS.load(os.path.join(REPO_DIR, 'settings.json'))
+TEXTS.load(os.path.join(REPO_DIR, 'all_text.json'))
+
+
+class SerializedCursor:
+
+    def __init__(self, cursor, lock):
+
+        # Results are computed on the first next(), under the lock of the database
+        self.cursor = cursor
+        self.lock = lock
+
+    def __getattr__(self, name: str):
+
+        attribute = getattr(self.cursor, name)
+
+        def call(*args, **kwargs):
+            with self.lock:
+                result = attribute(*args, **kwargs)
+            # sort(), limit()... return the cursor itself
+            return SerializedCursor(result, self.lock) if result is self.cursor else result
+
+        return call
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self.lock:
+            return next(self.cursor)
+
+
+class SerializedCollection:
+
+    def __init__(self, collection, lock):
+        self.collection = collection
+        self.lock = lock
+
+    def __getattr__(self, name: str):
+
+        attribute = getattr(self.collection, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            with self.lock:
+                result = attribute(*args, **kwargs)
+            return SerializedCursor(result, self.lock) if isinstance(result, mongomock.collection.Cursor) else result
+
+        return call
+
+
+class SerializedDatabase:
+
+    def __init__(self, database):
+
+        """mongomock doesn't make an operation atomic the way the server does (find_one_and_update is a
+        find and an update, documents are copied while other threads change them): the operations of the
+        threads of a test run one at a time, like on a single document of a real server."""
+        self.database = database
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name: str) -> SerializedCollection:
+        return SerializedCollection(self.database[name], self.lock)
+
+    def __getitem__(self, name: str) -> SerializedCollection:
+        return SerializedCollection(self.database[name], self.lock)
+
+
+@pytest.fixture
+def database() -> SerializedDatabase:
+    return SerializedDatabase(mongomock.MongoClient().taxi_bot)
+
+
+@pytest.fixture
+def orders_manager(database) -> OrdersManager:
+    return OrdersManager(database.taxi_orders, SequenceAllocator(database.taxi_counters, 'order_id'),
+                         Outbox(database.taxi_outbox), lambda transition: transition(None))
+
+
+class FakeMapMd:
+
+    def __init__(self):
+
+        # map.md's /near and /search with fixed answers, after `latency` seconds. While `status` isn't 200
+        # it is answered instead, `hits` counts the requests
+        self.latency = 0.0
+        self.status = 200
+        self.hits = 0
+        self.lock = threading.Lock()
+        self.server = None
+
+    def start(self) -> 'FakeMapMd':
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.request_handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='FakeMapMd', daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def handle(self, path: str, params: dict) -> tuple:
+
+        with self.lock:
+            self.hits += 1
+        time.sleep(self.latency)
+        if self.status != 200:
+            return self.status, {'error': 'failing'}
+        if path.endswith('/near'):
+            return 200, {'building': {'location': 'Chişinău', 'street_name': 'bd. Dacia',
+                                      'number': str(int(float(params.get('lat')) * 1000) % 100 + 1)}}
+        # The same address always has the same centroid
+        digest = hashlib.md5(params.get('q', '').encode()).digest()
+        return 200, {'selected': {'centroid': {'lat': 47.0245 + (digest[0] - 128) / 2000,
+                                               'lon': 28.8322 + (digest[1] - 128) / 2000}}}
+
+    def request_handler(self):
+
+        fake_map_md = self
+
+        class FakeRequestHandler(BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self) -> None:
+                url = urlsplit(self.path)
+                status, result = fake_map_md.handle(url.path, dict(parse_qsl(url.query)))
+                body = json.dumps(result).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client has given up waiting (timeouts of the map.md client)
+                    self.close_connection = True
+
+            def log_message(self, format: str, *args) -> None:
+                pass
+
+        return FakeRequestHandler
+
+
+@pytest.fixture
+def map_md() -> FakeMapMd:
+    server = FakeMapMd().start()
+    yield server
+    server.stop()
@@ -0,0 +1,130 @@
+import threading
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from driverLocator import DriverLocator
+from outbox import ORDER_ACCEPTED
+from sendQueue import PRIORITY_ADMIN
+from telegramBot import OrdersManager
+from telegramChatBot import TelegramChatBot, ACCEPT_ORDER
+
+DRIVERS = 20
+
+
+class RecordingScheduler:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = []
+
+    def send_message(self, bot, **kwargs):
+        with self.lock:
+            self.calls.append(('send_message', kwargs))
+
+    def delete_message(self, bot, **kwargs):
+        with self.lock:
+            self.calls.append(('delete_message', kwargs))
+
+
+class Query:
+
+    def __init__(self, order_id: int, message):
+        self.data = f'{ACCEPT_ORDER}:{order_id}'
+        self.message = message
+        self.answers = []
+
+    def answer(self, text: str = None, show_alert: bool = False) -> None:
+        self.answers.append(text)
+
+
+def chat_bot(orders_manager: OrdersManager, scheduler: RecordingScheduler, driver_locator: DriverLocator) -> TelegramChatBot:
+    # Only what accept_order needs, without an Updater
+    bot = TelegramChatBot.__new__(TelegramChatBot)
+    bot.orders_manager = orders_manager
+    bot.scheduler = scheduler
+    bot.updater = SimpleNamespace(bot=None)
+    bot.driver_locator = driver_locator
+    return bot
+
+
+def test_one_of_many_concurrent_drivers_wins(orders_manager, database):
+    order_id = orders_manager.create_order(42, 'rider')
+    orders_manager.open_order(order_id, {})
+    scheduler = RecordingScheduler()
+    bot = chat_bot(orders_manager, scheduler, DriverLocator(database.taxi_driver_locations))
+
+    message = SimpleNamespace(chat_id=-100, message_id=7, text_html=f'<b>Новый заказ</b> ‼️ №{order_id}\n')
+    queries = [Query(order_id, message) for _ in range(DRIVERS)]
+    barrier = threading.Barrier(DRIVERS)
+
+    def tap(driver_id: int, query: Query) -> None:
+        update = SimpleNamespace(callback_query=query, effective_message=message,
+                                 effective_user=SimpleNamespace(id=driver_id, name=f'@driver{driver_id}'))
+        barrier.wait()
+        bot.accept_order(update, None)
+
+    for index in range(DRIVERS):
+        bot.driver_locator.update_location(1000 + index, f'@driver{1000 + index}', 47.0, 28.8)
+    threads = [threading.Thread(target=tap, args=(1000 + index, query)) for index, query in enumerate(queries)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    answers = [query.answers for query in queries]
+    winners = [index for index, answer in enumerate(answers) if answer == [None]]
+    assert len(winners) == 1
+    assert sum(1 for answer in answers if len(answer) == 1 and answer[0] and 'уже принят' in answer[0]) == DRIVERS - 1
+
+    order = orders_manager.get_order_info(order_id)
+    assert order.get('status') == 'accepted'
+    assert order.get('driver_id') == 1000 + winners[0]
+    assert orders_manager.outbox.db_outbox.count_documents({'kind': ORDER_ACCEPTED}) == 1
+
+    # The group post is deleted and the admins are told once
+    assert [name for name, _ in scheduler.calls].count('delete_message') == 1
+    assert sum(1 for name, kwargs in scheduler.calls if kwargs.get('priority') == PRIORITY_ADMIN) == 1
+
+    # Only the winner is taken off the offers
+    busy = [driver.get('driver_id') for driver in bot.driver_locator.db_driver_locations.find({'order_id': {'$ne': None}})]
+    assert busy == [1000 + winners[0]]
+
+
+def test_accepting_a_declined_order_is_refused(orders_manager):
+    order_id = orders_manager.create_order(42, 'rider')
+    orders_manager.open_order(order_id, {})
+    orders_manager.decline_open_orders(42)
+
+    assert orders_manager.accept_order(order_id, '@driver', 1000) is None
+    assert orders_manager.get_order_info(order_id).get('status') == 'declined'
+
+
+def test_busy_driver_is_free_again_after_sharing_a_location(database):
+    locator = DriverLocator(database.taxi_driver_locations)
+    locator.update_location(1000, '@driver', 47.0, 28.8, live_period=3600)
+    locator.set_busy(1000, 7)
+
+    # The live location goes on, the driver stays busy
+    assert locator.update_location(1000, '@driver', 47.1, 28.9, 3600, upsert=False)
+    assert locator.db_driver_locations.find_one({'driver_id': 1000}).get('order_id') == 7
+
+    locator.update_location(1000, '@driver', 47.1, 28.9)
+    assert locator.db_driver_locations.find_one({'driver_id': 1000}).get('order_id') is None
+
+    # Sharing stopped: the edits of the old live location don't bring the driver back
+    locator.remove_driver(1000)
+    assert not locator.update_location(1000, '@driver', 47.1, 28.9, 3600, upsert=False)
+
+
+def test_busy_driver_sharing_a_live_location_is_offered_orders_again_after_the_ride(database):
+    locator = DriverLocator(database.taxi_driver_locations, busy_period=1800)
+    locator.update_location(1000, '@driver', 47.0, 28.8, live_period=8 * 3600)
+    locator.set_busy(1000, 7)
+
+    def available(now: datetime) -> list:
+        return [driver.get('driver_id') for driver in locator.db_driver_locations.find(locator.available(now))]
+
+    # The live location goes on during the ride and after it
+    assert locator.update_location(1000, '@driver', 47.1, 28.9, 8 * 3600, upsert=False)
+    assert available(datetime.utcnow()) == []
+    assert available(datetime.utcnow() + timedelta(seconds=1801)) == [1000]
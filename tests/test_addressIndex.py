@@ -0,0 +1,41 @@
+from addressIndex import AddressIndex
+
+
+def index(rows: list) -> AddressIndex:
+    return AddressIndex(AddressIndex.build(rows))
+
+
+def test_street_without_house_numbers_is_located_by_its_rows():
+    address_index = index([
+        {'street': 'Strada Ismail', 'house': '', 'latitude': '47.00', 'longitude': '28.80'},
+        {'street': 'Strada Ismail', 'house': None, 'latitude': '47.02', 'longitude': '28.84'}
+    ])
+
+    found = address_index.lookup('str. Ismail')
+    assert found.get('exact')
+    assert abs(found.get('latitude') - 47.01) < 1e-9
+    assert abs(found.get('longitude') - 28.82) < 1e-9
+
+    # An unknown house number falls back to the centroid too, not as an exact hit
+    found = address_index.lookup('Ismail 5')
+    assert not found.get('exact')
+    assert abs(found.get('latitude') - 47.01) < 1e-9
+
+
+def test_centroid_counts_every_row_of_the_street():
+    address_index = index([
+        {'street': 'bd. Dacia', 'house': '1', 'latitude': '47.00', 'longitude': '28.80'},
+        {'street': 'bd. Dacia', 'house': '', 'latitude': '47.03', 'longitude': '28.86'}
+    ])
+    found = address_index.lookup('Dacia')
+    assert abs(found.get('latitude') - 47.015) < 1e-9
+    assert address_index.lookup('Dacia 1').get('latitude') == 47.0
+
+
+def test_street_without_any_coordinates_is_left_to_the_geocoder():
+    address_index = index([
+        {'street': 'Strada Ismail', 'house': '', 'latitude': '', 'longitude': ''},
+        {'street': 'bd. Dacia', 'house': '1', 'latitude': '47.00', 'longitude': '28.80'}
+    ])
+    assert address_index.lookup('Ismail') is None
+    assert address_index.lookup('Dacia 1').get('street') == 'bd. Dacia'
@@ -0,0 +1,145 @@
+import re
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+import pytest
+
+from main import deliver_accepted_orders, deliver_expired_orders, generate_message_for_drivers, store_group_post
+from telegramBot import OrdersManager, TAXI_FROM, TAXI_FROM_LOCATION, TAXI_TO, TAXI_TO_LOCATION, TAXI_CONTACT, TAXI_COMMENT
+
+
+def sent(message_id: int = 1) -> Future:
+    future = Future()
+    future.set_result(SimpleNamespace(message_id=message_id))
+    return future
+
+
+class UserManager:
+
+    def __init__(self, broken_user_id: int):
+        self.broken_user_id = broken_user_id
+        self.incremented = []
+
+    def get_user_field(self, user_id: int, field: str):
+        if user_id == self.broken_user_id:
+            raise RuntimeError('broken user')
+        return 'ro'
+
+    def increment_user_field(self, user_id: int, field: str) -> None:
+        self.incremented.append(user_id)
+
+
+class Scheduler:
+
+    def __init__(self):
+        self.messages = []
+
+    def send_message(self, bot, **kwargs) -> Future:
+        self.messages.append(kwargs)
+        return sent()
+
+    def wait_sent(self, futures: list) -> None:
+        pass
+
+
+def bots(orders_manager: OrdersManager, broken_user_id: int = None) -> tuple:
+    telegram_bot = SimpleNamespace(orders_manager=orders_manager,
+                                   user_manager=UserManager(broken_user_id),
+                                   scheduler=Scheduler(),
+                                   updater=SimpleNamespace(bot=None))
+    telegram_chat_bot = SimpleNamespace(withdraw_order=lambda order: [sent()])
+    return telegram_bot, telegram_chat_bot
+
+
+def open_order(orders_manager: OrdersManager, user_id: int, from_address: str = 'bd. Dacia 1',
+               comment: str = '') -> int:
+    # The steps of the order wizard
+    order_id = orders_manager.create_order(user_id, f'rider{user_id}', {TAXI_FROM: from_address,
+                                                                        TAXI_FROM_LOCATION: '28.85,47.00'})
+    orders_manager.set_order_fields(order_id, {TAXI_TO: 'str. Ismail 23', TAXI_TO_LOCATION: ''})
+    orders_manager.set_order_field(order_id, TAXI_CONTACT, '+37369000000')
+    orders_manager.open_order(order_id, {TAXI_COMMENT: comment, 'fare_estimate': 85, 'fare_class': 'adjacent_districts',
+                                         'distance_km': 7.4})
+    return order_id
+
+
+def accept(orders_manager: OrdersManager, order_id: int) -> None:
+    orders_manager.accept_order(order_id, '@driver', 1000, -1001)
+
+
+def expire(orders_manager: OrdersManager, order_id: int) -> None:
+    orders_manager.expire_order(order_id)
+
+
+DELIVERIES = [(deliver_accepted_orders, accept), (deliver_expired_orders, expire)]
+
+
+@pytest.mark.parametrize('deliver, finish', DELIVERIES)
+def test_missing_orders_are_acked(orders_manager, deliver, finish):
+    order_id = open_order(orders_manager, 20)
+    finish(orders_manager, order_id)
+    telegram_bot, telegram_chat_bot = bots(orders_manager)
+    entries = [{'_id': 'entry:missing', 'order_id': order_id + 100}, {'_id': 'entry:order', 'order_id': order_id}]
+
+    assert sorted(deliver(telegram_bot, telegram_chat_bot, entries)) == ['entry:missing', 'entry:order']
+
+
+@pytest.mark.parametrize('deliver, finish', DELIVERIES)
+def test_one_broken_order_fails_alone(orders_manager, deliver, finish):
+    order_ids = [open_order(orders_manager, user_id) for user_id in (10, 20, 30)]
+    for order_id in order_ids:
+        finish(orders_manager, order_id)
+    telegram_bot, telegram_chat_bot = bots(orders_manager, broken_user_id=20)
+    entries = [{'_id': f'entry:{order_id}', 'order_id': order_id} for order_id in order_ids]
+
+    assert sorted(deliver(telegram_bot, telegram_chat_bot, entries)) == [f'entry:{order_ids[0]}', f'entry:{order_ids[2]}']
+
+
+@pytest.mark.parametrize('deliver, finish', DELIVERIES)
+def test_rider_is_told_about_their_order(orders_manager, deliver, finish):
+    order_id = open_order(orders_manager, 10)
+    finish(orders_manager, order_id)
+    telegram_bot, telegram_chat_bot = bots(orders_manager)
+
+    deliver(telegram_bot, telegram_chat_bot, [{'_id': 'entry', 'order_id': order_id}])
+    [message] = telegram_bot.scheduler.messages
+    assert message.get('chat_id') == 10
+    assert 'bd. Dacia 1 -> str. Ismail 23' in message.get('text')
+    if finish is accept:
+        assert '@driver' in message.get('text')
+        assert telegram_bot.user_manager.incremented == [10]
+
+
+def test_group_post_of_a_taken_order_is_deleted_once_out(orders_manager):
+    order_id = open_order(orders_manager, 10)
+    deleted = []
+    telegram_bot = SimpleNamespace(orders_manager=orders_manager)
+    telegram_chat_bot = SimpleNamespace(bot_chat_id=-1001, updater=SimpleNamespace(bot=None),
+                                        scheduler=SimpleNamespace(delete_message=lambda bot, **kwargs: deleted.append(kwargs)))
+
+    # Still open: only the message ID is stored
+    store_group_post(telegram_bot, telegram_chat_bot, order_id, sent(5))
+    assert orders_manager.get_order_info(order_id).get('message_id') == 5 and not deleted
+
+    # Taken while the post was queued
+    message_sent = Future()
+    store_group_post(telegram_bot, telegram_chat_bot, order_id, message_sent)
+    accept(orders_manager, order_id)
+    message_sent.set_result(SimpleNamespace(message_id=6))
+    assert orders_manager.get_order_info(order_id).get('message_id') == 6
+    assert deleted == [{'chat_id': -1001, 'message_id': 6}]
+
+
+def test_message_for_drivers_escapes_what_the_rider_typed(orders_manager):
+    order_id = open_order(orders_manager, 10, 'Dacia 1 <bloc 2>', 'a<b>c</b> & co')
+    orders_manager.set_order_field(order_id, TAXI_CONTACT, '<069>')
+    message = generate_message_for_drivers(orders_manager.get_order_info(order_id), '')
+
+    assert '>Dacia 1 &lt;bloc 2&gt;</a>' in message
+    assert '>str. Ismail 23</a>' in message
+    assert 'Связь: &lt;069&gt;' in message
+    assert '@rider10' in message
+    assert '~85 лей (7.4 км)' in message
+    assert '<i>a&lt;b&gt;c&lt;/b&gt; &amp; co</i>' in message
+    # The only tags left are the ones of the template
+    assert set(re.findall(r'</?(\w+)', message)) == {'b', 'a', 'i'}
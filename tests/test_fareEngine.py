@@ -0,0 +1,37 @@
+import csv
+import io
+from types import SimpleNamespace
+
+import numpy as np
+from bson import ObjectId
+
+from archive import OrderArchive
+from fareEngine import reprice_orders
+
+
+def estimate_many(from_longitudes, from_latitudes, to_longitudes, to_latitudes) -> dict:
+    count = len(from_longitudes)
+    return {'from_district': np.zeros(count, int), 'to_district': np.ones(count, int),
+            'tariff_class': np.array(['same_district'] * count), 'distance_km': np.full(count, 2.5),
+            'price': np.full(count, 50)}
+
+
+def test_archived_orders_are_repriced_once(database):
+    archive = OrderArchive(database.taxi_orders_archive, lambda month: database[f'taxi_orders_{month}'])
+
+    def order(order_id: int, created: str) -> dict:
+        return {'_id': ObjectId(f'{created}{order_id:016x}'), 'order_id': order_id, 'status': 'accepted',
+                'from_location': '28.80,47.00', 'to_location': '28.85,47.02', 'fare_estimate': 45}
+
+    # Two months archived, one order copied by an interrupted batch and still live, one typed address
+    archive.store([order(1, '5e0c0a00'), order(2, '5e3a9d00'), order(3, '5e3a9d00')])
+    database.taxi_orders.insert_many([order(3, '5e3a9d00'), order(4, '65a00000'),
+                                      dict(order(5, '65a00000'), to_location='')])
+
+    output = io.StringIO()
+    reprice_orders(SimpleNamespace(estimate_many=estimate_many),
+                   [database.taxi_orders] + archive.month_collections(), output)
+
+    rows = list(csv.DictReader(io.StringIO(output.getvalue())))
+    assert sorted(int(row.get('order_id')) for row in rows) == [1, 2, 3, 4]
+    assert {row.get('price') for row in rows} == {'50'}
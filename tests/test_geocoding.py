@@ -0,0 +1,95 @@
+import time
+from types import SimpleNamespace
+
+import mongomock
+
+from geocoding import GeocodingCache
+from mapClient import MapClient
+from telegramBot import TelegramMenu
+
+
+class Fetcher:
+
+    def __init__(self, value='Chisinau, bd. Dacia 1'):
+        self.value = value
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.value
+
+
+def test_memory_hit_in_the_same_cell():
+    cache = GeocodingCache(grid_size=15)
+    fetch = Fetcher()
+
+    assert cache.reverse(47.02450, 28.83220, fetch) == fetch.value
+    # A few meters away, same grid cell
+    assert cache.reverse(47.02451, 28.83221, fetch) == fetch.value
+    assert fetch.calls == 1
+    assert cache.stats().get('memory_hits') == 1
+
+
+def test_persistent_hit_after_restart():
+    db_geocoding = mongomock.MongoClient().taxi_bot.taxi_geocoding
+    fetch = Fetcher()
+    GeocodingCache(db_geocoding).search('bd. Dacia 1', fetch)
+
+    # A new process: empty memory tier, the address is normalized the same way
+    cache = GeocodingCache(db_geocoding)
+    assert cache.search('  BD. DACIA, 1 ', fetch) == fetch.value
+    assert fetch.calls == 1
+    assert cache.stats().get('persistent_hits') == 1
+
+
+def test_ttl_expiry():
+    db_geocoding = mongomock.MongoClient().taxi_bot.taxi_geocoding
+    cache = GeocodingCache(db_geocoding, ttl=0.05)
+    fetch = Fetcher()
+
+    cache.search('str. Ismail 23', fetch)
+    time.sleep(0.1)
+    cache.search('str. Ismail 23', fetch)
+    assert fetch.calls == 2
+
+
+def test_lru_eviction():
+    cache = GeocodingCache(max_size=2)
+    fetchers = {address: Fetcher(address) for address in ('a', 'b', 'c')}
+
+    cache.search('a', fetchers.get('a'))
+    cache.search('b', fetchers.get('b'))
+    # "a" is used again, so "b" is the least recently used when "c" comes in
+    cache.search('a', fetchers.get('a'))
+    cache.search('c', fetchers.get('c'))
+    cache.search('a', fetchers.get('a'))
+    cache.search('b', fetchers.get('b'))
+
+    assert fetchers.get('a').calls == 1
+    assert fetchers.get('b').calls == 2
+
+
+def test_failed_lookups_are_not_cached():
+    cache = GeocodingCache()
+    fetch = Fetcher(None)
+
+    assert cache.search('nowhere', fetch) is None
+    assert cache.search('nowhere', fetch) is None
+    assert fetch.calls == 2
+
+
+def test_slow_map_md_falls_back_and_recovers(map_md):
+    map_client = MapClient('token', f'{map_md.url}/api', timeout=0.2, retries=0)
+    menu = TelegramMenu(SimpleNamespace(set_conversation=None), None, None, map_client, GeocodingCache())
+
+    map_md.latency = 1.0
+    started = time.monotonic()
+    assert menu.get_address_from_location(47.0245, 28.8322) == 'Не определен'
+    assert menu.get_location_from_address('bd. Dacia 1') == ''
+    # Answered within the deadlines, not after map.md
+    assert time.monotonic() - started < 1.0
+
+    # The fallback wasn't cached: the next lookups reach map.md again
+    map_md.latency = 0.0
+    assert menu.get_address_from_location(47.0245, 28.8322).startswith('Chisinau, bd. Dacia')
+    assert menu.get_location_from_address('bd. Dacia 1') != ''
@@ -0,0 +1,16 @@
+from i18n import TEXTS, LANGUAGES
+
+
+def test_fare_estimate_shows_the_price_and_the_distance():
+    # The fields of a FareEngine quote
+    fare = {'price': 85, 'tariff_class': 'standard', 'distance_km': 7.4}
+    for language in LANGUAGES:
+        text = TEXTS.current.text('fare_estimate', language, fare=fare)
+        assert '<b>85 ' in text
+        assert '(7.4 ' in text
+
+
+def test_user_values_are_escaped():
+    order = {'from': '<b>Main</b>', 'to': 'A & B'}
+    text = TEXTS.current.text('expired_order', 'ru', order=order)
+    assert '&lt;b&gt;Main&lt;/b&gt; -> A &amp; B' in text
@@ -0,0 +1,102 @@
+import threading
+import time
+
+from mapClient import CircuitBreaker, MapClient
+
+
+def test_breaker_opens_half_opens_and_closes():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.1)
+
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    # Open
+    assert not breaker.allow()
+
+    # Half-open: a single trial request after the timeout
+    time.sleep(0.15)
+    assert breaker.allow()
+    assert not breaker.allow()
+
+    # A successful trial closes it
+    breaker.record_success()
+    assert breaker.allow()
+    assert breaker.allow()
+
+
+def test_failed_trial_opens_the_breaker_again():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.1)
+    breaker.record_failure()
+    time.sleep(0.15)
+    assert breaker.allow()
+
+    breaker.record_failure()
+    assert not breaker.allow()
+    time.sleep(0.15)
+    assert breaker.allow()
+
+
+def test_failing_map_md_opens_the_circuit(map_md):
+    client = MapClient('token', f'{map_md.url}/api', timeout=1.0, retries=0, failure_threshold=2, reset_timeout=0.2)
+
+    map_md.status = 503
+    assert client.near(47.0245, 28.8322) is None
+    assert client.near(47.0245, 28.8322) is None
+    assert map_md.hits == 2
+
+    # Open: answered at once, map.md isn't called
+    assert client.search('bd. Dacia 1') is None
+    assert map_md.hits == 2
+
+    # Half-open after the timeout, the trial succeeds and closes the circuit
+    map_md.status = 200
+    time.sleep(0.25)
+    assert client.search('bd. Dacia 1') is not None
+    assert client.near(47.0245, 28.8322) is not None
+    assert map_md.hits == 4
+
+
+def test_retries_stay_within_the_deadline(map_md):
+    client = MapClient('token', f'{map_md.url}/api', timeout=0.3, retries=5, backoff=0.05)
+
+    map_md.status = 503
+    map_md.latency = 0.1
+    started = time.monotonic()
+    assert client.search('bd. Dacia 1') is None
+    assert time.monotonic() - started < 0.5
+    assert 1 < map_md.hits <= 6
+
+
+def test_slow_map_md_times_out(map_md):
+    client = MapClient('token', f'{map_md.url}/api', timeout=0.2, retries=1)
+
+    map_md.latency = 1.0
+    started = time.monotonic()
+    assert client.near(47.0245, 28.8322) is None
+    assert time.monotonic() - started < 0.5
+
+
+def test_client_errors_do_not_trip_the_breaker(map_md):
+    client = MapClient('token', f'{map_md.url}/api', timeout=1.0, retries=2, failure_threshold=1)
+
+    # A 4xx is the request's fault: no retry, the circuit stays closed
+    map_md.status = 404
+    assert client.search('bd. Dacia 1') is None
+    assert map_md.hits == 1
+    map_md.status = 200
+    assert client.search('bd. Dacia 1') is not None
+
+
+def test_identical_lookups_share_one_request(map_md):
+    client = MapClient('token', f'{map_md.url}/api', timeout=2.0)
+    map_md.latency = 0.3
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(client.near(47.0245, 28.8322))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(results) == 5 and all(result is not None for result in results)
+    assert map_md.hits == 1
@@ -0,0 +1,67 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from sendQueue import MessageScheduler, send_error
+
+
+class Bot:
+
+    def __init__(self, delay: float = 0):
+        self.delay = delay
+        self.sent = []
+
+    def send_message(self, chat_id, **kwargs):
+        time.sleep(self.delay)
+        self.sent.append(chat_id)
+        return SimpleNamespace(message_id=len(self.sent))
+
+
+@pytest.fixture
+def scheduler():
+    scheduler = MessageScheduler(global_rate=1000, chat_rate=1000, group_rate=1000, send_timeout=0.5).start()
+    yield scheduler
+    scheduler.stop()
+
+
+def test_channel_usernames_are_sent_with_the_group_limit(scheduler):
+    bot = Bot()
+    futures = [scheduler.send_message(bot, chat_id=chat_id, text='hi') for chat_id in ('@channel', -100, 42)]
+    scheduler.wait_sent(futures)
+
+    assert [send_error(future) for future in futures] == [None, None, None]
+    assert scheduler.chat_bucket('@channel').rate == scheduler.group_rate
+    assert scheduler.chat_bucket(42).rate == scheduler.chat_rate
+
+
+def test_a_chat_that_cant_be_scheduled_fails_alone(scheduler):
+    bot = Bot()
+    chat_bucket = scheduler.chat_bucket
+
+    def failing_chat_bucket(chat_id):
+        if chat_id == 13:
+            raise ValueError('broken chat')
+        return chat_bucket(chat_id)
+
+    scheduler.chat_bucket = failing_chat_bucket
+    failed = scheduler.send_message(bot, chat_id=13, text='hi')
+    assert isinstance(failed.exception(5), ValueError)
+
+    # The scheduler goes on
+    sent = scheduler.send_message(bot, chat_id=42, text='hi')
+    assert sent.result(5).message_id == 1
+
+
+def test_sends_not_out_in_time_are_cancelled(scheduler):
+    bot = Bot(delay=1)
+    # One at a time per chat: the second one is still queued when the wait times out
+    futures = [scheduler.send_message(bot, chat_id=42, text='hi') for _ in range(2)]
+    started = time.monotonic()
+    scheduler.wait_sent(futures)
+
+    assert time.monotonic() - started < 0.9
+    assert all(send_error(future) is not None for future in futures)
+    futures[0].exception(5)
+    time.sleep(0.1)
+    assert bot.sent == [42]
@@ -0,0 +1,52 @@
+import threading
+from datetime import datetime
+
+import mongomock
+
+from timers import TimerService, TimerStore
+
+
+class CountingStore(TimerStore):
+
+    def __init__(self, db_timers):
+        super().__init__(db_timers)
+        self.refreshes = 0
+
+    def due(self, until: datetime, limit: int) -> list:
+        self.refreshes += 1
+        return super().due(until, limit)
+
+
+def run_for(service: TimerService, seconds: float) -> None:
+    thread = threading.Thread(target=service.run, daemon=True)
+    thread.start()
+    service.stop_event.wait(seconds)
+    service.stop()
+    thread.join()
+
+
+def test_full_batch_due_later_is_slept_on():
+    store = CountingStore(mongomock.MongoClient().taxi_bot.taxi_timers)
+    for key in range(20):
+        store.schedule('order_repost', key, 3.0)
+    fired = []
+    service = TimerService(store, {'order_repost': fired.append}, refresh_interval=5.0, batch_size=10)
+
+    run_for(service, 0.5)
+
+    assert store.refreshes == 1
+    assert not fired
+
+
+def test_backlog_larger_than_a_batch_is_fired_at_once():
+    store = CountingStore(mongomock.MongoClient().taxi_bot.taxi_timers)
+    for key in range(25):
+        store.schedule('order_repost', key, 0)
+    fired = []
+    service = TimerService(store, {'order_repost': lambda timer: fired.append(timer.get('key'))},
+                           refresh_interval=5.0, batch_size=10)
+
+    run_for(service, 0.5)
+
+    assert sorted(fired) == list(range(25))
+    assert store.db_timers.count_documents({}) == 0
@@ -0,0 +1,72 @@
+import threading
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+from conversation import ConversationStore
+from telegramBot import UserManager
+from userSession import PROCESS_ID, SessionCache
+
+THREADS = 16
+PER_THREAD = 50
+
+
+@pytest.fixture
+def user_manager(database):
+    db_user_info = database.taxi_user_info
+    user_manager = UserManager(db_user_info, None, SessionCache(), ConversationStore(db_user_info, PROCESS_ID))
+    user_manager.create_user(SimpleNamespace(id=42, full_name='Ion', link=''))
+    return user_manager
+
+
+def run_concurrently(target) -> None:
+    barrier = threading.Barrier(THREADS)
+
+    def worker(thread_index: int) -> None:
+        barrier.wait()
+        for index in range(PER_THREAD):
+            target(thread_index, index)
+
+    threads = [threading.Thread(target=worker, args=(thread_index,)) for thread_index in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_concurrent_increments_are_not_lost(user_manager):
+    run_concurrently(lambda thread_index, index: user_manager.increment_user_field(42, 'orders_count'))
+
+    assert user_manager.db_user_info.find_one({'user_id': 42}).get('orders_count') == THREADS * PER_THREAD
+    # The cached session has the value of the last write
+    assert user_manager.get_user_field(42, 'orders_count') == THREADS * PER_THREAD
+
+
+def test_concurrent_set_additions_are_not_lost(user_manager):
+    run_concurrently(lambda thread_index, index: user_manager.add_to_user_set(42, 'contacts', f'+373{thread_index:02d}{index:04d}'))
+    # The same values again change nothing
+    run_concurrently(lambda thread_index, index: user_manager.add_to_user_set(42, 'contacts', f'+373{thread_index:02d}{index:04d}'))
+
+    contacts = user_manager.db_user_info.find_one({'user_id': 42}).get('contacts')
+    assert len(contacts) == len(set(contacts)) == THREADS * PER_THREAD
+
+
+def test_capped_set_keeps_the_most_recent_values(user_manager):
+    run_concurrently(lambda thread_index, index: user_manager.add_to_user_set(42, 'contacts', f'+373{thread_index:02d}{index:04d}', 10))
+
+    contacts = user_manager.db_user_info.find_one({'user_id': 42}).get('contacts')
+    assert len(contacts) == len(set(contacts)) == 10
+
+
+def test_atomic_updates_are_stamped(user_manager):
+    user_manager.db_user_info.update_one({'user_id': 42}, {'$set': {'updated_at': datetime.utcnow() - timedelta(days=1),
+                                                                    'updated_by': 'another process'}})
+    # A caller's own $set is kept next to the stamps
+    user_manager.update_user_atomically({'user_id': 42}, {'$inc': {'orders_count': 1}, '$set': {'language': 'ro'}},
+                                        'orders_count')
+
+    user_info = user_manager.db_user_info.find_one({'user_id': 42})
+    assert user_info.get('language') == 'ro'
+    assert user_info.get('updated_by') == PROCESS_ID
+    assert datetime.utcnow() - user_info.get('updated_at') < timedelta(minutes=1)
@@ -0,0 +1,47 @@
+import threading
+import time
+from types import SimpleNamespace
+
+from userSession import UserLocks
+
+
+def update(chat_id: int) -> SimpleNamespace:
+    return SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id))
+
+
+def test_updates_of_a_user_go_one_at_a_time_others_run_alongside():
+    running = {}
+    overlaps = {'same': 0, 'other': 0}
+    lock = threading.Lock()
+
+    def handler(update, context) -> None:
+        chat_id = update.effective_chat.id
+        with lock:
+            if running.get(chat_id):
+                overlaps['same'] += 1
+            if any(count for other_id, count in running.items() if other_id != chat_id):
+                overlaps['other'] += 1
+            running[chat_id] = running.get(chat_id, 0) + 1
+        time.sleep(0.01)
+        with lock:
+            running[chat_id] -= 1
+
+    user_locks = UserLocks()
+    in_order = user_locks.in_order(handler)
+    barrier = threading.Barrier(16)
+
+    def worker(chat_id: int) -> None:
+        barrier.wait()
+        for _ in range(5):
+            in_order(update(chat_id), None)
+
+    threads = [threading.Thread(target=worker, args=(index % 2,)) for index in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert overlaps.get('same') == 0
+    assert overlaps.get('other') > 0
+    # Nobody waits anymore, nothing is kept
+    assert user_locks.locks == {}
@@ -0,0 +1,129 @@
+import heapq
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from pymongo import DeleteOne, UpdateOne
+
+# Timer kinds
+ORDER_REPOST = 'order_repost'
+ORDER_EXPIRE = 'order_expire'
+# Recurring sweep of abandoned wizard state
+GARBAGE_COLLECTION = 'garbage_collection'
+# Recurring move of the finished orders into the archive
+ORDER_ARCHIVAL = 'order_archival'
+
+
+class TimerStore:
+
+    def __init__(self, db_timers):
+
+        # One document per pending timer, shared by every process: {_id: kind:key, kind, key, fire_at, fired}
+        self.db_timers = db_timers
+
+    def schedule(self, kind: str, key, delay: float, session=None, keep_existing: bool = False) -> None:
+
+        """(Re)schedules the timer `kind` of `key` in `delay` seconds. With keep_existing an already
+        scheduled timer is left as it is (recurring timers seeded on every start)."""
+        fields = {'kind': kind, 'key': key, 'fire_at': datetime.utcnow() + timedelta(seconds=delay), 'fired': 0}
+        value_to_update = {'$setOnInsert': fields} if keep_existing else {'$set': fields}
+        self.db_timers.update_one({'_id': f'{kind}:{key}'}, value_to_update, upsert=True, session=session)
+
+    def cancel(self, key, session=None) -> None:
+        # Every timer of the key (e.g. all the timers of an order)
+        self.db_timers.delete_many({'key': key}, session=session)
+
+    def cancel_many(self, keys: list, session=None) -> None:
+        self.db_timers.delete_many({'key': {'$in': keys}}, session=session)
+
+    def due(self, until: datetime, limit: int) -> list:
+        return list(self.db_timers.find({'fire_at': {'$lte': until}}).sort('fire_at', 1).limit(limit))
+
+    def complete(self, timers: list) -> None:
+
+        """[(timer, delay)]: fired timers are removed, or rescheduled when delay isn't None. A timer
+        rescheduled by somebody else in between (different fire_at) is left alone."""
+        if not timers:
+            return
+        now = datetime.utcnow()
+        requests_list = []
+        for timer, delay in timers:
+            timer_filter = {'_id': timer.get('_id'), 'fire_at': timer.get('fire_at')}
+            if delay is None:
+                requests_list.append(DeleteOne(timer_filter))
+            else:
+                requests_list.append(UpdateOne(timer_filter, {'$set': {'fire_at': now + timedelta(seconds=delay)},
+                                                              '$inc': {'fired': 1}}))
+        self.db_timers.bulk_write(requests_list, ordered=False)
+
+    def postpone(self, timer: dict, delay: float) -> None:
+        # Failed firing: tried again later, without counting it
+        self.db_timers.update_one({'_id': timer.get('_id'), 'fire_at': timer.get('fire_at')},
+                                  {'$set': {'fire_at': datetime.utcnow() + timedelta(seconds=delay)}})
+
+
+class TimerService:
+
+    def __init__(self, store: TimerStore, handlers: dict, refresh_interval: float = 5.0, retry_delay: float = 30.0,
+                 batch_size: int = 100):
+
+        # Kind -> handler(timer) returning the delay of its next firing, None when it is done
+        self.store = store
+        self.handlers = handlers
+        self.refresh_interval = refresh_interval
+        self.retry_delay = retry_delay
+        self.batch_size = batch_size
+
+        self.logger = logging.getLogger(__name__)
+        self.stop_event = threading.Event()
+        # Timers due before the next refresh: (fire_at, _id, timer)
+        self.heap = []
+
+    def run(self) -> None:
+
+        """Fires the timers from an in-memory heap, reloaded from the store every refresh_interval (timers
+        scheduled by other processes, cancellations). Only one process (the leader) may run it."""
+        while not self.stop_event.is_set():
+            try:
+                # A full batch that is due already means more timers are waiting behind it (a full batch
+                # due later is slept on like any other)
+                if self.refresh() >= self.batch_size and self.heap[0][0] <= datetime.utcnow():
+                    self.fire_due()
+                    continue
+                refresh_at = time.monotonic() + self.refresh_interval
+                while not self.stop_event.is_set() and time.monotonic() < refresh_at:
+                    self.fire_due()
+                    wait = refresh_at - time.monotonic()
+                    if self.heap:
+                        wait = min(wait, (self.heap[0][0] - datetime.utcnow()).total_seconds())
+                    self.stop_event.wait(max(wait, 0))
+            except Exception as error:
+                self.logger.exception('Timers failed: %s', error)
+                self.stop_event.wait(self.refresh_interval)
+
+    def refresh(self) -> int:
+
+        timers = self.store.due(datetime.utcnow() + timedelta(seconds=self.refresh_interval), self.batch_size)
+        self.heap = [(timer.get('fire_at'), timer.get('_id'), timer) for timer in timers]
+        heapq.heapify(self.heap)
+        return len(timers)
+
+    def fire_due(self) -> None:
+
+        completed = []
+        now = datetime.utcnow()
+        while self.heap and self.heap[0][0] <= now:
+            _, _, timer = heapq.heappop(self.heap)
+            try:
+                completed.append((timer, self.handlers[timer.get('kind')](timer)))
+            except Exception as error:
+                self.logger.exception('Timer %s failed: %s', timer.get('_id'), error)
+                self.store.postpone(timer, self.retry_delay)
+        self.store.complete(completed)
+
+    def stop(self) -> None:
+        self.stop_event.set()
+
+
+if __name__ == '__main__':
+    print('Only for import!')
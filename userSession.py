@@ -0,0 +1,154 @@
+import functools
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from pymongo.errors import OperationFailure, PyMongoError
+
+# Every write is stamped with the ID of the process, so it can skip its own change events
+PROCESS_ID = uuid.uuid4().hex
+
+
+class UserSession:
+
+    def __init__(self, user_id: str, document: dict):
+
+        self.user_id = user_id
+        self.document = document
+        self.pending = {}
+        self.loaded_at = time.monotonic()
+
+    def get(self, field: str) -> str | list:
+        return self.document.get(field)
+
+    def set(self, field: str, new_value: str | list) -> None:
+        self.document[field] = new_value
+        self.pending[field] = new_value
+
+
+class SessionCache:
+
+    def __init__(self, max_size: int = 10000, ttl: float = 60.0):
+
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self.logger = logging.getLogger(__name__)
+        self.lock = threading.Lock()
+        self.sessions = OrderedDict()
+        # Document _id -> user_id (change events only carry the _id)
+        self.document_ids = {}
+
+    def get(self, user_id: str) -> UserSession | None:
+
+        with self.lock:
+            session = self.sessions.get(user_id)
+            if session is None:
+                return None
+            if time.monotonic() - session.loaded_at > self.ttl and not session.pending:
+                self.remove(user_id)
+                return None
+            self.sessions.move_to_end(user_id)
+            return session
+
+    def put(self, session: UserSession) -> None:
+
+        with self.lock:
+            self.sessions[session.user_id] = session
+            self.sessions.move_to_end(session.user_id)
+            self.document_ids[session.document.get('_id')] = session.user_id
+            # Least recently used sessions are dropped first
+            while len(self.sessions) > self.max_size:
+                old_user_id = next(iter(self.sessions))
+                self.remove(old_user_id)
+
+    def evict(self, user_id: str) -> None:
+
+        with self.lock:
+            self.remove(user_id)
+
+    def evict_document(self, document_id) -> None:
+
+        with self.lock:
+            user_id = self.document_ids.get(document_id)
+            if user_id is not None:
+                self.remove(user_id)
+
+    def remove(self, user_id: str) -> None:
+
+        session = self.sessions.pop(user_id, None)
+        if session is not None:
+            self.document_ids.pop(session.document.get('_id'), None)
+
+    def watch_invalidations(self, db_user_info) -> None:
+
+        # Sessions changed by other bot processes are dropped from the cache
+        thread = threading.Thread(target=self.invalidation_loop, args=(db_user_info,),
+                                  name='session-invalidation', daemon=True)
+        thread.start()
+
+    def invalidation_loop(self, db_user_info) -> None:
+
+        pipeline = [
+            {'$match': {'$or': [
+                {'operationType': {'$in': ['replace', 'delete']}, 'fullDocument.updated_by': {'$ne': PROCESS_ID}},
+                {'operationType': 'update', 'updateDescription.updatedFields.updated_by': {'$ne': PROCESS_ID}}
+            ]}}
+        ]
+        while True:
+            try:
+                with db_user_info.watch(pipeline) as stream:
+                    for change in stream:
+                        self.evict_document(change.get('documentKey').get('_id'))
+            except OperationFailure as error:
+                self.logger.warning('Change streams are not available (%s), sessions expire after %ss', error, self.ttl)
+                return
+            except PyMongoError as error:
+                self.logger.warning('Session invalidation stream failed (%s), reopening', error)
+                # Changes missed while the stream was down
+                with self.lock:
+                    self.sessions.clear()
+                    self.document_ids.clear()
+                time.sleep(1)
+
+
+class UserLocks:
+
+    def __init__(self):
+
+        # User ID -> [lock, updates holding or waiting for it], dropped once nobody needs it
+        self.lock = threading.Lock()
+        self.locks = {}
+
+    @contextmanager
+    def hold(self, user_id):
+
+        with self.lock:
+            entry = self.locks.setdefault(user_id, [threading.RLock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.locks[user_id]
+
+    def in_order(self, callback):
+
+        # Handlers run on the dispatcher's pool, the updates of one chat still go one at a time
+        @functools.wraps(callback)
+        def wrapper(update, context):
+            if update.effective_chat is None:
+                return callback(update, context)
+            with self.hold(update.effective_chat.id):
+                return callback(update, context)
+
+        return wrapper
+
+
+if __name__ == '__main__':
+    print('Only for import!')
@@ -0,0 +1,98 @@
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from telegram import Update
+
+
+class WebhookServer:
+
+    def __init__(self, listen: str, port: int, url: str, secret_token: str = None):
+
+        # One HTTP ingress for every bot, TLS is terminated by the reverse proxy in front of it
+        self.listen = listen
+        self.port = port
+        self.url = url.rstrip('/')
+        self.secret_token = secret_token or None
+
+        self.logger = logging.getLogger(__name__)
+        # URL path -> (updater, allowed updates)
+        self.routes = {}
+        self.server = None
+
+    def add_bot(self, updater, allowed_updates: list = None) -> None:
+        self.routes[f'/{updater.bot.token}'] = (updater, allowed_updates)
+
+    def start(self) -> None:
+
+        self.start_dispatchers()
+        for path, (updater, allowed_updates) in self.routes.items():
+            updater.bot.set_webhook(url=f'{self.url}{path}',
+                                    allowed_updates=allowed_updates,
+                                    secret_token=self.secret_token)
+
+        self.server = ThreadingHTTPServer((self.listen, self.port), self.request_handler())
+        self.server.daemon_threads = True
+        thread = threading.Thread(target=self.server.serve_forever, name='webhook', daemon=True)
+        thread.start()
+
+        print(f'WEBHOOK listening on {self.listen}:{self.port}')
+
+    def start_dispatchers(self) -> None:
+
+        # Dispatchers consume the updates put into their queues by the ingress
+        for updater, _ in self.routes.values():
+            thread = threading.Thread(target=updater.dispatcher.start, name=f'dispatcher-{updater.bot.id}', daemon=True)
+            thread.start()
+
+    def stop(self) -> None:
+
+        if self.server is not None:
+            self.server.shutdown()
+        for updater, _ in self.routes.values():
+            updater.dispatcher.stop()
+
+    def route(self, path: str, headers, body: bytes) -> int:
+
+        """Puts the update into the dispatcher of the bot it was sent to, returns the HTTP status."""
+        status, updater, update = self.parse(path, headers, body)
+        if update is not None:
+            updater.dispatcher.update_queue.put(update)
+        return status
+
+    def parse(self, path: str, headers, body: bytes) -> tuple:
+
+        route = self.routes.get(path)
+        if route is None:
+            return 404, None, None
+        if self.secret_token is not None and headers.get('X-Telegram-Bot-Api-Secret-Token') != self.secret_token:
+            return 403, None, None
+
+        updater, _ = route
+        try:
+            update = Update.de_json(json.loads(body), updater.bot)
+        except ValueError as error:
+            self.logger.warning('Malformed update: %s', error)
+            return 400, None, None
+        return 200, updater, update
+
+    def request_handler(self):
+
+        webhook_server = self
+
+        class WebhookRequestHandler(BaseHTTPRequestHandler):
+
+            def do_POST(self) -> None:
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                self.send_response(webhook_server.route(self.path, self.headers, body))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format: str, *args) -> None:
+                webhook_server.logger.debug(format, *args)
+
+        return WebhookRequestHandler
+
+
+if __name__ == '__main__':
+    print('Only for import!')